@@ -33,6 +33,87 @@ app.config['IS_PYTHONANYWHERE'] = os.environ.get('PYTHONANYWHERE', False)
 app.config['USE_BACKGROUND_THREADS'] = not (app.config['IS_SERVERLESS'] or app.config['IS_PYTHONANYWHERE'])
 app.config['USE_S3_STORAGE'] = os.environ.get('USE_S3_STORAGE', 'False').lower() == 'true'
 
+# SMTP connection pool settings
+app.config['SMTP_POOL_ENABLED'] = os.environ.get('SMTP_POOL_ENABLED', 'True').lower() == 'true'
+app.config['SMTP_POOL_IDLE_TIMEOUT'] = int(os.environ.get('SMTP_POOL_IDLE_TIMEOUT', '60'))  # seconds
+app.config['SMTP_POOL_NOOP_INTERVAL'] = int(os.environ.get('SMTP_POOL_NOOP_INTERVAL', '15'))  # seconds
+
+# Send lane settings - one lane per account, at most SEND_MAX_LANES running at once
+app.config['SEND_MAX_LANES'] = int(os.environ.get('SEND_MAX_LANES', '8'))
+
+# Send rate limits - token buckets per account and per SMTP host. Unset uses the provider
+# defaults in app/utils/rate_limiter.py, a rate of 0 disables the limit
+app.config['SEND_ACCOUNT_RATE_LIMIT'] = (
+    (float(os.environ['SEND_ACCOUNT_RATE']), int(os.environ.get('SEND_ACCOUNT_BURST', '1')))
+    if os.environ.get('SEND_ACCOUNT_RATE') else None
+)
+app.config['SEND_HOST_RATE_LIMIT'] = (
+    (float(os.environ['SEND_HOST_RATE']), int(os.environ.get('SEND_HOST_BURST', '10')))
+    if os.environ.get('SEND_HOST_RATE') else None
+)
+
+# Send engine - 'threaded' runs a thread per account lane, 'asyncio' drives all lanes from one event loop (needs aiosmtplib)
+app.config['SEND_ENGINE'] = os.environ.get('SEND_ENGINE', 'threaded').lower()
+app.config['SEND_ASYNC_MAX_INFLIGHT'] = int(os.environ.get('SEND_ASYNC_MAX_INFLIGHT', '200'))
+app.config['SEND_ASYNC_PER_ACCOUNT'] = int(os.environ.get('SEND_ASYNC_PER_ACCOUNT', '1'))
+
+# Send retry policy - transient failures are retried with exponential backoff, authentication failures suspend the account
+app.config['SEND_RETRY_MAX_ATTEMPTS'] = int(os.environ.get('SEND_RETRY_MAX_ATTEMPTS', '5'))
+app.config['SEND_RETRY_BASE_SECONDS'] = int(os.environ.get('SEND_RETRY_BASE_SECONDS', '60'))
+app.config['SEND_RETRY_MAX_SECONDS'] = int(os.environ.get('SEND_RETRY_MAX_SECONDS', '3600'))
+app.config['SEND_AUTH_SUSPEND_SECONDS'] = int(os.environ.get('SEND_AUTH_SUSPEND_SECONDS', '1800'))
+
+# Host circuit breakers - skip an SMTP/IMAP host after consecutive connection failures, probe it again after the cool-down
+app.config['CIRCUIT_FAILURE_THRESHOLD'] = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+app.config['CIRCUIT_COOLDOWN_SECONDS'] = int(os.environ.get('CIRCUIT_COOLDOWN_SECONDS', '300'))
+
+# Seconds SMTP/IMAP host addresses are cached between connections (0 looks them up every time)
+app.config['NET_DNS_CACHE_TTL'] = int(os.environ.get('NET_DNS_CACHE_TTL', '300'))
+
+# Reply checking - only new IMAP messages are read; a first sync or one after UIDVALIDITY changed looks back IMAP_RESYNC_DAYS
+app.config['IMAP_RESYNC_DAYS'] = int(os.environ.get('IMAP_RESYNC_DAYS', '30'))
+# UIDs per IMAP FETCH command when reading new messages
+app.config['IMAP_FETCH_BATCH_SIZE'] = int(os.environ.get('IMAP_FETCH_BATCH_SIZE', '200'))
+# Reply searches ask the server only for mail from awaited recipients' domains, unless there are more than this (0 always reads all new mail)
+app.config['IMAP_SEARCH_MAX_SENDERS'] = int(os.environ.get('IMAP_SEARCH_MAX_SENDERS', '200'))
+# Reply bodies - bytes downloaded per message and characters of text stored at most (0 for no limit)
+app.config['REPLY_MAX_FETCH_BYTES'] = int(os.environ.get('REPLY_MAX_FETCH_BYTES', '262144'))
+app.config['REPLY_MAX_TEXT_LENGTH'] = int(os.environ.get('REPLY_MAX_TEXT_LENGTH', '20000'))
+
+# Reply polling - accounts are checked concurrently, each for at most REPLY_CHECK_TIMEOUT_SECONDS (also the IMAP socket timeout)
+app.config['REPLY_CHECK_MAX_WORKERS'] = int(os.environ.get('REPLY_CHECK_MAX_WORKERS', '8'))
+app.config['REPLY_CHECK_TIMEOUT_SECONDS'] = int(os.environ.get('REPLY_CHECK_TIMEOUT_SECONDS', '90'))
+
+# IMAP session pool - keep each account's logged-in session with the inbox selected between reply checks
+app.config['IMAP_POOL_ENABLED'] = os.environ.get('IMAP_POOL_ENABLED', 'False' if app.config['IS_SERVERLESS'] else 'True').lower() == 'true'
+app.config['IMAP_POOL_MAX_SESSIONS'] = int(os.environ.get('IMAP_POOL_MAX_SESSIONS', '50'))
+app.config['IMAP_POOL_IDLE_TIMEOUT'] = int(os.environ.get('IMAP_POOL_IDLE_TIMEOUT', '600'))  # seconds
+
+# IMAP IDLE listeners - hold an IDLE session per IMAP-enabled account and read new mail as it arrives; polling covers the rest
+app.config['IMAP_IDLE_ENABLED'] = os.environ.get('IMAP_IDLE_ENABLED', 'False').lower() == 'true' and not app.config['IS_SERVERLESS']
+app.config['IMAP_IDLE_SECONDS'] = int(os.environ.get('IMAP_IDLE_SECONDS', '1500'))
+
+# Send dispatcher - sends emails when they become due and re-checks the database every SEND_DISPATCH_RECONCILE_SECONDS
+app.config['SEND_DISPATCH_RECONCILE_SECONDS'] = int(os.environ.get('SEND_DISPATCH_RECONCILE_SECONDS', '60'))
+app.config['SEND_DISPATCH_LOOKAHEAD'] = int(os.environ.get('SEND_DISPATCH_LOOKAHEAD', '100'))
+
+# Send lease settings - due emails are claimed in batches so several queue runners can share the queue
+app.config['SEND_CLAIM_BATCH_SIZE'] = int(os.environ.get('SEND_CLAIM_BATCH_SIZE', '500'))
+app.config['SEND_LEASE_SECONDS'] = int(os.environ.get('SEND_LEASE_SECONDS', '900'))
+
+# Send status write-behind - final statuses are committed in groups, with accepted sends journaled to disk first
+app.config['SEND_STATUS_BATCH_SIZE'] = int(os.environ.get('SEND_STATUS_BATCH_SIZE', '50'))
+app.config['SEND_STATUS_FLUSH_MS'] = int(os.environ.get('SEND_STATUS_FLUSH_MS', '500'))
+app.config['SEND_JOURNAL_DIR'] = os.environ.get('SEND_JOURNAL_DIR', '/tmp/send_journal' if app.config['IS_SERVERLESS'] else 'logs/send_journal')
+app.config['SEND_JOURNAL_FSYNC'] = os.environ.get('SEND_JOURNAL_FSYNC', 'True').lower() == 'true'
+
+# Render final messages into the spool when emails are scheduled, instead of at send time
+app.config['SEND_PRERENDER'] = os.environ.get('SEND_PRERENDER', 'True').lower() == 'true'
+
+# Send transport for accounts without their own - 'smtp', 'file' (maildir per account under SEND_SPOOL_DIR) or 'null' (discard)
+app.config['SEND_TRANSPORT'] = os.environ.get('SEND_TRANSPORT', 'smtp').lower()
+app.config['SEND_SPOOL_DIR'] = os.environ.get('SEND_SPOOL_DIR', '/tmp/mail_spool' if app.config['IS_SERVERLESS'] else 'logs/mail_spool')
+
 # Set PythonAnywhere writable directories if needed
 if app.config['IS_PYTHONANYWHERE']:
     # PythonAnywhere username from environment or default placeholder
@@ -117,7 +198,51 @@ with app.app_context():
         
     except Exception as e:
         app.logger.error(f"Error updating database schema: {str(e)}")
-        
+
+# Columns added to existing tables after their initial release
+SCHEMA_ADDITIONS = {
+    'email': {
+        'claimed_by': 'VARCHAR(100)',
+        'lease_expires_at': 'DATETIME',
+        'last_error': 'TEXT',
+        'attempt_count': 'INTEGER DEFAULT 0',
+        'message_id': 'VARCHAR(255)',
+        'reserved_on': 'DATE',
+    },
+    'email_account': {
+        'transport': 'VARCHAR(20)',
+    },
+}
+
+# Indexes on added columns, created when missing
+SCHEMA_INDEX_ADDITIONS = {
+    'ix_email_message_id': ('email', 'message_id'),
+}
+
+# Ensure older databases have every added column
+with app.app_context():
+    try:
+        inspector = db.inspect(db.engine)
+        with db.engine.begin() as conn:
+            for table_name, columns in SCHEMA_ADDITIONS.items():
+                existing_columns = [col['name'] for col in inspector.get_columns(table_name)]
+                for column_name, column_type in columns.items():
+                    if column_name not in existing_columns:
+                        conn.execute(db.text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"))
+                        app.logger.info(f"{column_name} column added to {table_name} table")
+
+            for index_name, (table_name, column_name) in SCHEMA_INDEX_ADDITIONS.items():
+                conn.execute(db.text(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({column_name})"))
+
+        # PostgreSQL stores EmailStatus as a native enum type that needs new members added
+        if db.engine.dialect.name == 'postgresql':
+            with db.engine.connect() as conn:
+                autocommit_conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+                for status in models.EmailStatus:
+                    autocommit_conn.execute(db.text(f"ALTER TYPE emailstatus ADD VALUE IF NOT EXISTS '{status.name}'"))
+    except Exception as e:
+        app.logger.error(f"Error adding new columns to database schema: {str(e)}")
+
 # Force SQLAlchemy to reflect tables from the database
 with app.app_context():
     try:
@@ -1,8 +1,6 @@
 from flask import jsonify
 from app import app
-from app.models.models import EmailAccount, Email
-from sqlalchemy import func
-from datetime import datetime
+from app.models.models import EmailAccount, AccountDailyUsage
 
 @app.route('/api/accounts/info', methods=['GET'])
 def get_accounts_info():
@@ -11,14 +9,11 @@ def get_accounts_info():
         accounts = EmailAccount.query.filter_by(is_active=True).all()
         accounts_data = []
         
+        # Get sent emails today for all accounts in one query
+        sent_counts = AccountDailyUsage.get_sent_counts([account.id for account in accounts])
+        
         for account in accounts:
-            # Get sent emails today
-            today = datetime.now().date()
-            sent_today = Email.query.filter(
-                Email.account_id == account.id,
-                Email.sent_at.isnot(None),
-                func.date(Email.sent_at) == today
-            ).count()
+            sent_today = sent_counts.get(account.id, 0)
             
             accounts_data.append({
                 'id': account.id,
@@ -12,11 +12,14 @@ from datetime import datetime, timedelta
 from functools import wraps
 from flask import render_template, request, redirect, url_for, flash, jsonify
 from werkzeug.utils import secure_filename
-from sqlalchemy import func, text
 from app import app, db, socketio
-from app.models.models import EmailAccount, EmailTemplate, Recipient, Email, EmailStatus, ImportLog, Campaign
+from app.models.models import EmailAccount, EmailTemplate, Recipient, Email, EmailStatus, ImportLog, Campaign, AccountDailyUsage, ImapSyncState
 from app.utils.csv_utils import import_csv
 from app.utils.scheduler_utils import schedule_email_batch, update_email_status, reschedule_email, check_all_replies, get_local_time, process_email_queue
+from app.utils.dispatcher import wake_dispatcher
+from app.utils.retry_policy import account_suspensions
+from app.utils.circuit_breaker import get_circuit_breakers
+from app.utils.transports import TRANSPORT_NAMES
 from app.utils.email_utils import extract_first_name, validate_email, send_email, check_for_replies, verify_imap_credentials
 
 # Set up logging
@@ -50,13 +53,9 @@ def index():
             failed_result = conn.execute("SELECT COUNT(*) FROM email WHERE status = 'failed'")
             failed_count = failed_result.scalar() or 0
             
-            # Get sent today count
-            today = datetime.now().date()
-            sent_today_result = conn.execute(
-                "SELECT COUNT(*) FROM email WHERE date(sent_at) = :today",
-                {"today": today.strftime('%Y-%m-%d')}
-            )
-            sent_today_count = sent_today_result.scalar() or 0
+            # Get sent today count from the per-account daily counters
+            account_ids = [account_id for (account_id,) in db.session.query(EmailAccount.id).all()]
+            sent_today_count = sum(AccountDailyUsage.get_sent_counts(account_ids).values())
             
             # Get response rate
             response_rate = 0
@@ -238,7 +237,17 @@ def delete_recipient(id):
 def accounts():
     """List all email accounts"""
     accounts_list = EmailAccount.query.all()
-    return render_template('accounts.html', accounts=accounts_list)
+    
+    # Circuit breaker state of each account's SMTP and IMAP hosts
+    circuit_breakers = get_circuit_breakers()
+    host_status = {
+        account.id: {
+            'smtp': circuit_breakers.status('smtp', account.smtp_server),
+            'imap': circuit_breakers.status('imap', account.imap_server) if account.imap_enabled and account.imap_server else None
+        }
+        for account in accounts_list
+    }
+    return render_template('accounts.html', accounts=accounts_list, host_status=host_status)
 
 @app.route('/accounts/add', methods=['GET', 'POST'])
 def add_account():
@@ -251,6 +260,7 @@ def add_account():
         smtp_username = request.form.get('smtp_username')
         smtp_password = request.form.get('smtp_password')
         daily_limit = int(request.form.get('daily_limit', 50))
+        transport = request.form.get('transport') if request.form.get('transport') in TRANSPORT_NAMES else None
         
         # IMAP settings
         imap_enabled = 'imap_enabled' in request.form
@@ -284,7 +294,8 @@ def add_account():
             imap_port=imap_port,
             imap_username=imap_username,
             imap_password=imap_password,
-            daily_limit=daily_limit
+            daily_limit=daily_limit,
+            transport=transport
         )
         db.session.add(account)
         db.session.commit()
@@ -293,7 +304,7 @@ def add_account():
         return redirect(url_for('accounts'))
         
     # GET request - show add form
-    return render_template('add_account.html')
+    return render_template('add_account.html', default_transport=app.config['SEND_TRANSPORT'])
 
 @app.route('/accounts/<int:id>/edit', methods=['GET', 'POST'])
 def edit_account(id):
@@ -308,6 +319,7 @@ def edit_account(id):
         smtp_username = request.form.get('smtp_username')
         smtp_password = request.form.get('smtp_password') or account.smtp_password
         daily_limit = int(request.form.get('daily_limit', 50))
+        transport = request.form.get('transport') if request.form.get('transport') in TRANSPORT_NAMES else None
         is_active = 'is_active' in request.form
         
         # IMAP settings
@@ -332,6 +344,10 @@ def edit_account(id):
             flash('Email already exists for another account', 'error')
             return redirect(request.url)
             
+        # Reply checking positions belong to the old mailbox
+        if imap_server != account.imap_server or imap_username != account.imap_username:
+            ImapSyncState.query.filter_by(account_id=account.id).delete()
+            
         # Update account
         account.name = name
         account.email = email
@@ -345,14 +361,18 @@ def edit_account(id):
         account.imap_username = imap_username
         account.imap_password = imap_password
         account.daily_limit = daily_limit
+        account.transport = transport
         account.is_active = is_active
         db.session.commit()
         
+        # New credentials may fix an authentication failure, let the account send again
+        account_suspensions.resume(account.id)
+        
         flash('Email account updated successfully', 'success')
         return redirect(url_for('accounts'))
         
     # GET request - show edit form
-    return render_template('edit_account.html', account=account)
+    return render_template('edit_account.html', account=account, default_transport=app.config['SEND_TRANSPORT'])
 
 @app.route('/accounts/<int:id>/deactivate', methods=['POST'])
 def deactivate_account(id):
@@ -410,9 +430,14 @@ def force_delete_account(id):
             # Set campaign_id to NULL where account_id matches
             conn.execute(db.text(f"UPDATE email SET campaign_id = NULL WHERE account_id = {id}"))
             
-            # Delete all emails associated with this account
+            # Delete pre-rendered messages, then all emails associated with this account
+            conn.execute(db.text(f"DELETE FROM email_spool WHERE email_id IN (SELECT id FROM email WHERE account_id = {id})"))
             conn.execute(db.text(f"DELETE FROM email WHERE account_id = {id}"))
             
+            # Delete the account's daily send counters and IMAP sync positions
+            conn.execute(db.text(f"DELETE FROM account_daily_usage WHERE account_id = {id}"))
+            conn.execute(db.text(f"DELETE FROM imap_sync_state WHERE account_id = {id}"))
+            
             # Now we can safely delete the account
             conn.execute(db.text(f"DELETE FROM email_account WHERE id = {id}"))
             
@@ -639,17 +664,10 @@ def new_campaign():
                 return redirect(request.url)
             
             # Verify account limits
-            for account_id in account_ids:
-                account = EmailAccount.query.get(account_id)
-                if not account:
-                    continue
-                    
-                # Get sent count for account using ORM instead of raw SQL
-                sent_today = Email.query.filter(
-                    Email.account_id == account.id,
-                    Email.status == EmailStatus.SENT,
-                    func.date(Email.sent_at) == datetime.now().date()
-                ).count()
+            selected_accounts = EmailAccount.query.filter(EmailAccount.id.in_(account_ids)).all()
+            sent_counts = AccountDailyUsage.get_sent_counts([account.id for account in selected_accounts])
+            for account in selected_accounts:
+                sent_today = sent_counts.get(account.id, 0)
                 
                 if len(recipient_ids) > (account.daily_limit - sent_today):
                     flash(f'Account {account.email} would exceed daily limit. Reduce recipients or select more accounts.', 'error')
@@ -704,8 +722,9 @@ def new_campaign():
                 else:
                     flash(f'Successfully scheduled {total_scheduled} emails at {interval_minutes}-minute intervals!', 'success')
                 
-                # Trigger email processing to start sending
-                process_email_queue()
+                # Wake the dispatcher, or start sending right away when there is none
+                if not wake_dispatcher():
+                    process_email_queue()
                 return redirect(url_for('campaigns'))
             else:
                 flash('Failed to schedule emails', 'error')
@@ -723,24 +742,17 @@ def new_campaign():
     try:
         accounts = EmailAccount.query.filter_by(is_active=True).all()
         
-        # Pre-calculate sent emails for each account
+        # Pre-calculate sent emails for each account from the daily counters
+        try:
+            sent_counts = AccountDailyUsage.get_sent_counts([account.id for account in accounts])
+        except Exception as e:
+            app.logger.error(f"Error calculating sent emails: {str(e)}")
+            sent_counts = {}
+            
         for account in accounts:
-            # Calculate sent emails today using raw SQL
-            try:
-                with db.engine.connect() as conn:
-                    result = conn.execute(
-                        text("SELECT COUNT(*) FROM email WHERE account_id = :account_id AND status = 'sent' AND date(sent_at) = :today"),
-                        {"account_id": account.id, "today": datetime.now().date().strftime('%Y-%m-%d')}
-                    )
-                    sent_today = result.scalar() or 0
-                    
-                    # Add as attributes to account object
-                    account.sent_today = sent_today
-                    account.remaining_today = account.daily_limit - sent_today
-            except Exception as e:
-                app.logger.error(f"Error calculating sent emails: {str(e)}")
-                account.sent_today = 0
-                account.remaining_today = account.daily_limit
+            # Add as attributes to account object
+            account.sent_today = sent_counts.get(account.id, 0)
+            account.remaining_today = account.daily_limit - account.sent_today
         
         templates = EmailTemplate.query.filter_by(is_active=True).all()
         recipients = Recipient.query.filter_by(is_active=True).all()
@@ -810,6 +822,7 @@ def resume_campaign(id):
         campaign = Campaign.query.get_or_404(id)
         campaign.status = 'active'
         db.session.commit()
+        wake_dispatcher()
         
         # Instead of using campaign_id, we'll skip resuming emails for now
         # since they aren't linked to campaigns yet
@@ -866,6 +879,7 @@ def resume_email(id):
     else:
         email.status = EmailStatus.PENDING
         db.session.commit()
+        wake_dispatcher()
         flash(f'Email to {email.recipient.email} resumed successfully', 'success')
     
     return redirect(url_for('schedule'))
@@ -958,6 +972,7 @@ def send_email_now(id):
 
     # Attempt to send the email with force_send=True to bypass test mode
     success, message = send_email(email.id, force_send=True)
+    wake_dispatcher()
     
     if success:
         flash(f'Email sent successfully! {message}', 'success')
@@ -1111,8 +1126,9 @@ def reschedule_email_route(id):
         if reschedule_email(id, scheduled_at):
             flash(f'Email to {email.recipient.email} rescheduled to {scheduled_at.strftime("%Y-%m-%d %H:%M")}', 'success')
             
-            # Immediately process email queue if the email is scheduled for now or in the past
-            if scheduled_at <= now:
+            # Let the dispatcher pick up the new due time, or process the queue
+            # immediately if there is no dispatcher and the email is due now
+            if not wake_dispatcher() and scheduled_at <= now:
                 app.logger.info(f"Email {id} rescheduled to a time in the past, processing immediately")
                 process_email_queue()
         else:
@@ -1179,13 +1195,7 @@ def check_account():
         return jsonify({'status': 'error', 'message': 'Account not found'})
         
     # Get sent count for today
-    today = datetime.datetime.utcnow().date()
-    midnight = datetime.datetime.combine(today, datetime.datetime.min.time())
-    sent_today = Email.query.filter(
-        Email.account_id == account_id,
-        Email.status == EmailStatus.SENT,
-        Email.sent_at >= midnight
-    ).count()
+    sent_today = account.get_sent_today()
     
     return jsonify({
         'status': 'success',
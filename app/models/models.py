@@ -2,20 +2,27 @@
 Database models for the Beakon Solutions platform.
 """
 
-from datetime import datetime
+from datetime import datetime, date, timedelta
+from contextlib import nullcontext
 from app import db
+from sqlalchemy import select, update, insert, func, case
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.hybrid import hybrid_property
 import enum
 
 class EmailStatus(enum.Enum):
     """Email status enum for tracking email states"""
     PENDING = "pending"
+    SENDING = "sending"  # Claimed by a queue runner and currently being sent
     SENT = "sent"
     RESPONDED = "responded"
     FAILED = "failed"
     PAUSED = "paused"  # Added for pausing emails
     DELIVERED = "delivered"  # Added for tracking delivered emails
 
+# Statuses of emails that count against an account's daily limit
+COUNTED_STATUSES = (EmailStatus.SENT, EmailStatus.RESPONDED, EmailStatus.DELIVERED)
+
 class EmailAccount(db.Model):
     """Email account model for storing SMTP settings"""
     __table_args__ = {'extend_existing': True}
@@ -40,12 +47,15 @@ class EmailAccount(db.Model):
     
     # Account Settings
     daily_limit = db.Column(db.Integer, default=50)
+    transport = db.Column(db.String(20), nullable=True)  # smtp, file or null - None uses SEND_TRANSPORT
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    # Relationship
+    # Relationships
     emails = db.relationship('Email', backref='account', lazy=True)
+    daily_usage = db.relationship('AccountDailyUsage', backref='account', lazy=True, cascade='all, delete-orphan')
+    imap_sync_states = db.relationship('ImapSyncState', backref='account', lazy=True, cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<EmailAccount {self.name} ({self.email})>'
@@ -57,18 +67,7 @@ class EmailAccount(db.Model):
         Returns:
             int: Number of emails sent today
         """
-        from app.models.models import Email, EmailStatus
-        
-        today = datetime.now().date()
-        midnight = datetime.combine(today, datetime.min.time())
-        
-        sent_today = Email.query.filter(
-            Email.account_id == self.id,
-            Email.status == EmailStatus.SENT,
-            Email.sent_at >= midnight
-        ).count()
-        
-        return sent_today
+        return AccountDailyUsage.get_sent_count(self.id)
 
 class Recipient(db.Model):
     """Recipient model for storing email recipient information"""
@@ -127,7 +126,10 @@ class EmailTemplate(db.Model):
 
 class Email(db.Model):
     """Email model for tracking individual emails"""
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        db.Index('ix_email_status_scheduled_at', 'status', 'scheduled_at'),
+        {'extend_existing': True}
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     account_id = db.Column(db.Integer, db.ForeignKey('email_account.id'), nullable=False)
@@ -145,6 +147,18 @@ class Email(db.Model):
     # Response fields
     response_subject = db.Column(db.String(255), nullable=True)
     response_content = db.Column(db.Text, nullable=True)  # Store the reply content here
+    # Message-ID the email was sent with, for threading replies to it
+    message_id = db.Column(db.String(255), nullable=True, index=True)
+    
+    # Send lease fields - set while a queue runner holds the email in SENDING state
+    claimed_by = db.Column(db.String(100), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    # Day the claim holds daily-limit capacity for; whoever clears it gives the capacity back or uses it
+    reserved_on = db.Column(db.Date, nullable=True)
+    
+    # Send attempts made so far and the error text from the last failed one
+    attempt_count = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text, nullable=True)
     
     is_follow_up = db.Column(db.Boolean, default=False)
     parent_email_id = db.Column(db.Integer, db.ForeignKey('email.id'))
@@ -164,9 +178,48 @@ class Email(db.Model):
     # Relationship to campaign
     campaign = db.relationship('Campaign', backref=db.backref('emails', lazy='dynamic'))
     
+    # Pre-rendered message, if one was built at schedule time
+    spool = db.relationship('EmailSpool', backref='email', uselist=False, cascade='all, delete-orphan')
+    
     def __repr__(self):
         return f'<Email {self.id} to {self.recipient.email} ({self.status.value})>'
 
+class EmailSpool(db.Model):
+    """
+    Final RFC 5322 bytes of a scheduled email, rendered ahead of the send.
+    The fingerprint covers everything the bytes were built from, so an entry
+    is ignored once the email is edited, moved to another account or re-personalized.
+    """
+    __table_args__ = {'extend_existing': True}
+    
+    email_id = db.Column(db.Integer, db.ForeignKey('email.id'), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    message = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<EmailSpool email={self.email_id}>'
+
+class ImapSyncState(db.Model):
+    """
+    How far reply checking has read an account's IMAP folder.
+    last_uid is only meaningful while the folder's UIDVALIDITY stays the same.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('account_id', 'folder', name='uq_imap_sync_state_account_folder'),
+        {'extend_existing': True}
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('email_account.id'), nullable=False)
+    folder = db.Column(db.String(255), nullable=False, default='INBOX')
+    uidvalidity = db.Column(db.BigInteger, nullable=True)
+    last_uid = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ImapSyncState account={self.account_id} folder={self.folder} uid={self.last_uid}>'
+
 class ImportLog(db.Model):
     """Import log model for tracking CSV imports"""
     __table_args__ = {'extend_existing': True}
@@ -197,4 +250,283 @@ class Campaign(db.Model):
     template = db.relationship('EmailTemplate')
     
     def __repr__(self):
-        return f'<Campaign {self.name}>' 
\ No newline at end of file
+        return f'<Campaign {self.name}>' 
+
+class AccountDailyUsage(db.Model):
+    """
+    Per-account, per-day send counter used to enforce daily limits.
+    
+    sent_count is incremented in the same transaction that marks an email SENT,
+    and reserved_count holds capacity claimed by send lanes that are still running.
+    Rows are created on first use, seeded from the email table for that day.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('account_id', 'day', name='uq_account_daily_usage_account_day'),
+        {'extend_existing': True}
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('email_account.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    sent_count = db.Column(db.Integer, nullable=False, default=0)
+    reserved_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # (account_id, day) pairs known to have a row, so the hot path skips the existence check.
+    # Only today's and later days are kept; writes that find no row re-seed it.
+    _known_rows = set()
+    
+    def __repr__(self):
+        return f'<AccountDailyUsage account={self.account_id} day={self.day} sent={self.sent_count}>'
+    
+    @classmethod
+    def ensure_row(cls, account_id, day=None):
+        """
+        Create the counter row for an account and day if it doesn't exist yet.
+        Runs on its own connection so the seed is visible to other workers at once -
+        call it before opening a write transaction, or SQLite would wait on its own lock.
+        
+        Args:
+            account_id (int): ID of the email account
+            day (date): Day of the counter, defaults to today
+        """
+        day = day or date.today()
+        if (account_id, day) in cls._known_rows:
+            return
+            
+        with db.engine.begin() as conn:
+            cls._seed_row(conn, account_id, day)
+            
+        today = date.today()
+        cls._known_rows.difference_update([key for key in cls._known_rows if key[1] < today])
+        cls._known_rows.add((account_id, day))
+    
+    @classmethod
+    def _seed_row(cls, conn, account_id, day):
+        """
+        Insert the counter row for an account and day on a connection, unless it exists
+        
+        Args:
+            conn (Connection): Connection or session to write on
+            account_id (int): ID of the email account
+            day (date): Day of the counter
+        """
+        table = cls.__table__
+        exists = conn.execute(
+            select(table.c.id).where(table.c.account_id == account_id, table.c.day == day)
+        ).first()
+        if exists:
+            return
+            
+        # Seed from emails already sent that day, e.g. before the counter existed
+        day_start = datetime.combine(day, datetime.min.time())
+        email_table = Email.__table__
+        sent = conn.execute(
+            select(func.count(email_table.c.id)).where(
+                email_table.c.account_id == account_id,
+                email_table.c.status.in_(COUNTED_STATUSES),
+                email_table.c.sent_at >= day_start,
+                email_table.c.sent_at < day_start + timedelta(days=1)
+            )
+        ).scalar() or 0
+        
+        try:
+            with conn.begin_nested():
+                conn.execute(insert(table).values(
+                    account_id=account_id,
+                    day=day,
+                    sent_count=sent,
+                    reserved_count=0,
+                    updated_at=datetime.utcnow()
+                ))
+        except IntegrityError:
+            # Another worker created the row first
+            pass
+    
+    @classmethod
+    def get_sent_count(cls, account_id, day=None):
+        """
+        Get the number of emails an account sent on a day
+        
+        Args:
+            account_id (int): ID of the email account
+            day (date): Day to look up, defaults to today
+            
+        Returns:
+            int: Number of emails sent
+        """
+        return cls.get_sent_counts([account_id], day).get(account_id, 0)
+    
+    @classmethod
+    def get_sent_counts(cls, account_ids, day=None):
+        """
+        Get the number of emails sent on a day for several accounts in one query
+        
+        Args:
+            account_ids (list): IDs of the email accounts
+            day (date): Day to look up, defaults to today
+            
+        Returns:
+            dict: Account ID -> number of emails sent
+        """
+        day = day or date.today()
+        for account_id in account_ids:
+            cls.ensure_row(account_id, day)
+            
+        rows = db.session.execute(
+            select(cls.account_id, cls.sent_count).where(cls.account_id.in_(account_ids), cls.day == day)
+        ).all()
+        return {account_id: sent_count for account_id, sent_count in rows}
+    
+    @classmethod
+    def reserve(cls, account_id, requested, limit, day=None, connection=None):
+        """
+        Atomically reserve send capacity for an account against its daily limit.
+        Uses a compare-and-swap update so concurrent workers never over-reserve.
+        
+        Args:
+            account_id (int): ID of the email account
+            requested (int): Number of sends wanted
+            limit (int): The account's daily limit
+            day (date): Day to reserve on, defaults to today
+            connection (Connection): Connection whose transaction the reservation joins,
+                                     instead of committing it on its own
+            
+        Returns:
+            int: Number of sends granted (0 if the limit is reached)
+        """
+        day = day or date.today()
+        cls.ensure_row(account_id, day)
+        table = cls.__table__
+        reseeded = False
+        
+        while True:
+            with (nullcontext(connection) if connection is not None else db.engine.begin()) as conn:
+                row = conn.execute(
+                    select(table.c.sent_count, table.c.reserved_count)
+                    .where(table.c.account_id == account_id, table.c.day == day)
+                ).first()
+                if row is None:
+                    if reseeded:
+                        return 0
+                    # The cached row was rolled back or removed
+                    cls._known_rows.discard((account_id, day))
+                    cls._seed_row(conn, account_id, day)
+                    reseeded = True
+                    continue
+                    
+                granted = min(requested, limit - row.sent_count - row.reserved_count)
+                if granted <= 0:
+                    return 0
+                    
+                result = conn.execute(
+                    update(table)
+                    .where(
+                        table.c.account_id == account_id,
+                        table.c.day == day,
+                        table.c.sent_count == row.sent_count,
+                        table.c.reserved_count == row.reserved_count
+                    )
+                    .values(reserved_count=table.c.reserved_count + granted, updated_at=datetime.utcnow())
+                )
+                if result.rowcount == 1:
+                    return granted
+    
+    @classmethod
+    def release(cls, account_id, count, day=None, connection=None):
+        """
+        Give back reserved capacity that was not used
+        
+        Args:
+            account_id (int): ID of the email account
+            count (int): Number of reserved sends to release
+            day (date): Day the capacity was reserved on, defaults to today
+            connection (Connection): Connection or session to write on instead of committing now
+        """
+        if count <= 0:
+            return
+            
+        day = day or date.today()
+        table = cls.__table__
+        with (nullcontext(connection) if connection is not None else db.engine.begin()) as conn:
+            conn.execute(
+                update(table)
+                .where(table.c.account_id == account_id, table.c.day == day)
+                .values(
+                    reserved_count=case(
+                        (table.c.reserved_count > count, table.c.reserved_count - count),
+                        else_=0
+                    ),
+                    updated_at=datetime.utcnow()
+                )
+            )
+    
+    @classmethod
+    def take_reservations(cls, email_ids, day, connection=None):
+        """
+        Clear the reservation emails hold for `day`. Only the rows this call
+        changes still held one, so their capacity is the caller's to use or
+        give back - a reclaimed email's reservation was already given back.
+        
+        Args:
+            email_ids (list): IDs of the emails
+            day (date): Day the capacity was reserved on
+            connection (Connection): Connection to write on instead of the session
+            
+        Returns:
+            int: Number of emails that held a reservation
+        """
+        if day is None or not email_ids:
+            return 0
+        email_table = Email.__table__
+        executor = connection if connection is not None else db.session
+        result = executor.execute(
+            update(email_table)
+            .where(email_table.c.id.in_(email_ids), email_table.c.reserved_on == day)
+            .values(reserved_on=None)
+        )
+        return result.rowcount
+    
+    @classmethod
+    def record_sent(cls, account_id, reserved_on=None, count=1, connection=None, reserved=None):
+        """
+        Count sent emails in the caller's session, so the increment commits
+        together with the status change that marks the emails SENT. Callers
+        mark the emails SENT first and call ensure_row before their transaction.
+        
+        Args:
+            account_id (int): ID of the email account
+            reserved_on (date): Day capacity was reserved for these sends, if any
+            count (int): Number of sent emails to count
+            connection (Connection): Connection to write on instead of the session
+            reserved (int): How many of the sends still held a reservation
+                            (see take_reservations), defaults to all of them
+        """
+        today = date.today()
+        table = cls.__table__
+        executor = connection if connection is not None else db.session
+        reserved = count if reserved is None else reserved
+        if not reserved:
+            reserved_on = None
+        
+        released = case((table.c.reserved_count > reserved, table.c.reserved_count - reserved), else_=0)
+        values = {'sent_count': table.c.sent_count + count, 'updated_at': datetime.utcnow()}
+        if reserved_on == today:
+            values['reserved_count'] = released
+            
+        today_row = update(table).where(table.c.account_id == account_id, table.c.day == today)
+        if executor.execute(today_row.values(**values)).rowcount == 0:
+            # The cached row was rolled back or removed. Seed it in this transaction -
+            # the seed already counts these sends, which the caller marked SENT first
+            cls._known_rows.discard((account_id, today))
+            cls._seed_row(executor, account_id, today)
+            values.pop('sent_count')
+            executor.execute(today_row.values(**values))
+        
+        if reserved_on is not None and reserved_on != today:
+            # The lane reserved capacity before midnight
+            executor.execute(
+                update(table)
+                .where(table.c.account_id == account_id, table.c.day == reserved_on)
+                .values(reserved_count=released)
+            )
@@ -0,0 +1,319 @@
+"""
+asyncio send engine for the Beakon Solutions platform.
+
+Drives the SMTP conversations of every account lane from one event loop instead
+of one thread per lane, so a single process can keep hundreds of sends in flight.
+Enabled with SEND_ENGINE=asyncio and requires aiosmtplib; without it the
+threaded engine is used. Database bookkeeping (reservations, status writes) is
+short and runs on the loop thread, the SMTP network waits do not block it.
+"""
+
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+from app import app, db, socketio
+from app.models.models import EmailStatus
+from app.utils.email_utils import get_message_bytes, save_send_status, save_send_failure, describe_send_error
+from app.utils.scheduler_utils import (ensure_personalization, run_send_lanes, release_claims, lane_resumes_at,
+                                      reserve_capacity, release_reservations, SEND_LEASE_SAFETY_MARGIN)
+from app.utils.retry_policy import account_suspensions
+from app.utils.rate_limiter import get_rate_limiter, THROTTLE_CODES
+from app.utils.circuit_breaker import get_circuit_breakers
+from app.utils.net_utils import get_ssl_context
+from app.utils.transports import get_transport
+
+logger = logging.getLogger(__name__)
+
+# SMTP reply codes after which the server will not accept further commands
+SESSION_CLOSING_CODES = (421,)
+
+
+class AsyncSMTPSessions:
+    """Authenticated aiosmtplib sessions for one engine run, kept per account"""
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._idle = {}
+        self._context = get_ssl_context()
+
+    async def acquire(self, account):
+        """
+        Get a connected session for an account, reusing an idle one when possible
+
+        Returns:
+            tuple: (client, reused)
+        """
+        idle = self._idle.get(account.id, [])
+        while idle:
+            client = idle.pop()
+            if client.is_connected:
+                return client, True
+
+        client = aiosmtplib.SMTP(
+            hostname=account.smtp_server,
+            port=account.smtp_port,
+            use_tls=True,
+            tls_context=self._context,
+            timeout=self.timeout
+        )
+        await client.connect()
+        try:
+            await client.login(account.smtp_username, account.smtp_password)
+        except Exception:
+            client.close()
+            raise
+        return client, False
+
+    def release(self, account_id, client, reusable=True):
+        """Return a session for reuse, or close it if it is broken"""
+        if reusable and client.is_connected:
+            self._idle.setdefault(account_id, []).append(client)
+        else:
+            client.close()
+
+    async def close_all(self):
+        """Close every idle session"""
+        for clients in self._idle.values():
+            for client in clients:
+                try:
+                    await client.quit()
+                except Exception:
+                    client.close()
+        self._idle.clear()
+
+
+async def send_message(smtp_sessions, account, recipient_email, message_bytes):
+    """
+    Send a serialized message over a session for the account. A reused session
+    that turns out to be disconnected is replaced once with a fresh connection.
+    """
+    while True:
+        client, reused = await smtp_sessions.acquire(account)
+        try:
+            await client.sendmail(account.email, [recipient_email], message_bytes)
+        except aiosmtplib.SMTPServerDisconnected:
+            smtp_sessions.release(account.id, client, reusable=False)
+            if not reused:
+                raise
+            logger.info(f"SMTP session for account {account.id} was disconnected, retrying on a new session")
+            continue
+        except aiosmtplib.SMTPResponseException as e:
+            smtp_sessions.release(account.id, client, reusable=e.code not in SESSION_CLOSING_CODES)
+            raise
+        except aiosmtplib.SMTPRecipientsRefused:
+            smtp_sessions.release(account.id, client)
+            raise
+        except Exception:
+            smtp_sessions.release(account.id, client, reusable=False)
+            raise
+
+        smtp_sessions.release(account.id, client)
+        return
+
+
+async def deliver_email_async(email, smtp_sessions, reserved_on=None, status_buffer=None):
+    """
+    Send a claimed email and save its final status
+
+    Args:
+        email (Email): The email to send, with recipient and account loaded
+        smtp_sessions (AsyncSMTPSessions): Sessions shared by the engine run
+        reserved_on (date): Day daily-limit capacity was reserved for this send
+        status_buffer (StatusWriteBuffer): Buffer for the final status
+
+    Returns:
+        bool: True if the email was sent successfully, False otherwise
+    """
+    account = email.account
+    ensure_personalization(email)
+
+    if os.environ.get('EMAIL_TEST_MODE', 'False').lower() == 'true':
+        logger.info(f"TEST MODE: Email would be sent to {email.recipient.email}")
+        save_send_status(email, EmailStatus.SENT, reserved_on=reserved_on, status_buffer=status_buffer)
+        return True
+
+    transport = get_transport(account)
+    try:
+        if transport.name == 'smtp':
+            await send_message(smtp_sessions, account, email.recipient.email, get_message_bytes(email))
+        else:
+            # File and null sinks are local and quick, no need to leave the loop
+            transport.send(account, account.email, [email.recipient.email], get_message_bytes(email))
+    except Exception as e:
+        if isinstance(e, aiosmtplib.SMTPResponseException) and e.code in THROTTLE_CODES:
+            get_rate_limiter().record_throttle(account, e.code)
+        # Count connection failures against the SMTP host
+        if transport.name == 'smtp':
+            get_circuit_breakers().record('smtp', account.smtp_server, e)
+        error_msg = describe_send_error(e, account)
+        logger.error(f"Failed to send email {email.id} from {account.email}: {error_msg}")
+        # Retry, fail or suspend the account depending on the error
+        save_send_failure(email, e, error_msg, status_buffer=status_buffer)
+        return False
+
+    get_rate_limiter().record_success(account)
+    if transport.name == 'smtp':
+        get_circuit_breakers().record('smtp', account.smtp_server)
+    try:
+        save_send_status(email, EmailStatus.SENT, reserved_on=reserved_on, status_buffer=status_buffer)
+    except Exception as e:
+        # The server took the message - never report it as unsent
+        db.session.rollback()
+        logger.error(f"Email {email.id} sent but its status could not be saved: {str(e)}")
+
+    logger.info(f"Email {email.id} sent successfully to {email.recipient.email}")
+    return True
+
+
+async def process_account_lane_async(emails, worker_id, send_deadline, smtp_sessions, in_flight, status_buffer=None):
+    """
+    Send the claimed emails of a single account, at most SEND_ASYNC_PER_ACCOUNT at a time
+
+    Args:
+        emails (list): Claimed emails for this account in send order, attached to the session
+        worker_id (str): Identifier of the queue run holding the claims
+        send_deadline (datetime): No send may start after this
+        smtp_sessions (AsyncSMTPSessions): Sessions shared by the engine run
+        in_flight (Semaphore): Limit on sends in flight across all lanes
+        status_buffer (StatusWriteBuffer): Buffer for final statuses
+
+    Returns:
+        int: Number of emails sent
+    """
+    account = emails[0].account
+    if not account or not account.is_active:
+        logger.warning(f"Account {emails[0].account_id} is inactive or not found - skipping {len(emails)} emails")
+        return 0
+
+    reserved_on = date.today()
+    reserved_emails = []
+    results = []
+    try:
+        if account_suspensions.is_suspended(account.id):
+            logger.warning(f"Sending for account {account.id} is suspended - skipping {len(emails)} emails")
+            return 0
+
+        # Only SMTP sends report to the host's circuit, other transports never close a probe
+        circuit_breakers = get_circuit_breakers()
+        uses_circuit = get_transport(account).name == 'smtp'
+        if uses_circuit and circuit_breakers.is_skipped('smtp', account.smtp_server):
+            logger.warning(f"SMTP host {account.smtp_server} is unreachable - skipping {len(emails)} emails for account {account.id}")
+            return 0
+
+        # Reserve daily-limit capacity so concurrent runners can't overshoot it
+        reserved_emails = reserve_capacity(account, emails, worker_id, reserved_on)
+        if not reserved_emails:
+            logger.warning(f"Account {account.id} has reached daily limit - skipping {len(emails)} emails")
+            return 0
+
+        account_slots = asyncio.Semaphore(app.config['SEND_ASYNC_PER_ACCOUNT'])
+        rate_limiter = get_rate_limiter()
+
+        async def send_one(email):
+            async with account_slots:
+                if email.status != EmailStatus.SENDING or email.claimed_by != worker_id:
+                    return False
+                if account_suspensions.is_suspended(account.id):
+                    return False
+
+                # Wait for this account's and SMTP host's rate limits only
+                wait = rate_limiter.reserve(account)
+                if datetime.now() + timedelta(seconds=wait) >= send_deadline:
+                    rate_limiter.give_back(account)
+                    return False
+                if wait:
+                    await asyncio.sleep(wait)
+
+                # Only one probe gets through while the host's circuit is half-open
+                if uses_circuit and not circuit_breakers.allow('smtp', account.smtp_server):
+                    rate_limiter.give_back(account)
+                    return False
+
+                async with in_flight:
+                    return await deliver_email_async(email, smtp_sessions, reserved_on, status_buffer)
+
+        results = await asyncio.gather(*(send_one(email) for email in reserved_emails))
+        return sum(1 for success in results if success)
+    finally:
+        # Successful sends consume their reservation when their status is written, give back the rest
+        sent_ids = {email.id for email, success in zip(reserved_emails, results) if success}
+        release_reservations(account.id, [email.id for email in reserved_emails if email.id not in sent_ids],
+                             reserved_on)
+
+        # Emails of a suspended account or unreachable host wait until they may be tried again
+        resumes_at = lane_resumes_at(account)
+        if resumes_at is not None:
+            release_claims(worker_id, [email.id for email in emails if email.status == EmailStatus.SENDING],
+                           scheduled_at=resumes_at)
+
+
+async def send_all_lanes(emails_by_account, worker_id, lease_expires_at, status_buffer=None):
+    """Run every account lane on the current event loop"""
+    session = db.session()
+    session.expire_on_commit = False
+
+    smtp_sessions = AsyncSMTPSessions()
+    in_flight = asyncio.Semaphore(app.config['SEND_ASYNC_MAX_INFLIGHT'])
+    # Stop early enough that no send can still be running when the lease expires
+    send_deadline = lease_expires_at - timedelta(seconds=SEND_LEASE_SAFETY_MARGIN)
+
+    lanes = {
+        account_id: [session.merge(email, load=False) for email in emails]
+        for account_id, emails in emails_by_account.items()
+    }
+    try:
+        results = await asyncio.gather(*(
+            process_account_lane_async(emails, worker_id, send_deadline, smtp_sessions, in_flight, status_buffer)
+            for emails in lanes.values()
+        ), return_exceptions=True)
+    finally:
+        await smtp_sessions.close_all()
+
+    processed_count = 0
+    for account_id, result in zip(lanes, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error in async send lane for account {account_id}: {str(result)}")
+        else:
+            processed_count += result
+    return processed_count
+
+
+def run_async_send_lanes(emails_by_account, worker_id, lease_expires_at, status_buffer=None):
+    """
+    Send due emails on the asyncio engine, falling back to threaded lanes
+    when aiosmtplib is not installed. Unsent claims are left for the caller
+    to release.
+
+    Args:
+        emails_by_account (dict): Account ID -> list of claimed, detached emails in send order
+        worker_id (str): Identifier of the queue run holding the claims
+        lease_expires_at (datetime): When the claims expire
+        status_buffer (StatusWriteBuffer): Buffer for final statuses
+
+    Returns:
+        int: Number of emails sent across all lanes
+    """
+    if aiosmtplib is None:
+        logger.warning("SEND_ENGINE is 'asyncio' but aiosmtplib is not installed - using threaded send lanes")
+        return run_send_lanes(emails_by_account, worker_id, lease_expires_at, status_buffer)
+
+    def run():
+        with app.app_context():
+            return asyncio.run(send_all_lanes(emails_by_account, worker_id, lease_expires_at, status_buffer))
+
+    if socketio.async_mode == 'eventlet':
+        # Run the event loop on a native thread so the eventlet hub keeps serving requests
+        from eventlet import tpool
+        return tpool.execute(run)
+
+    # Use a fresh thread so the loop never collides with a loop already running in this one
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(run).result()
@@ -0,0 +1,244 @@
+"""
+Host circuit breakers for the Beakon Solutions platform.
+
+When a mail provider is down, every account on it would otherwise spend a full
+connect timeout per attempt. A breaker per SMTP/IMAP host opens after a run of
+consecutive connection failures, skips the host for a cool-down, then lets a
+single probe through to decide whether to close again.
+"""
+
+import time
+import smtplib
+import imaplib
+import logging
+import threading
+from datetime import datetime, timedelta
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def is_connection_failure(error):
+    """
+    Whether an error means the host could not be reached or dropped the connection,
+    as opposed to the server answering with a refusal
+
+    Args:
+        error (Exception): The exception raised while talking to the host
+
+    Returns:
+        bool: True for connection-level failures
+    """
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, imaplib.IMAP4.abort)):
+        return True
+    if isinstance(error, smtplib.SMTPException):
+        # Every other SMTP error carries a server reply
+        return False
+    if aiosmtplib is not None and isinstance(error, aiosmtplib.SMTPException):
+        return isinstance(error, (aiosmtplib.SMTPConnectError, aiosmtplib.SMTPServerDisconnected,
+                                  aiosmtplib.SMTPTimeoutError))
+    # DNS failures, refused connections, timeouts and TLS errors
+    return isinstance(error, OSError)
+
+
+class CircuitBreaker:
+    """
+    Breaker for a single host
+
+    Args:
+        failure_threshold (int): Consecutive connection failures that open the breaker
+        cooldown_seconds (int): How long the breaker stays open before a probe
+    """
+
+    def __init__(self, failure_threshold=5, cooldown_seconds=300):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Whether a connection may be attempted now. After the cool-down only one
+        caller is let through as the probe until it reports its outcome.
+
+        Returns:
+            bool: True if the caller may connect
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now - self.opened_at < self.cooldown_seconds:
+                    return False
+                self.state = HALF_OPEN
+                self.probe_started_at = now
+                return True
+
+            # Half-open: let another probe through if the last one never reported back
+            if now - self.probe_started_at >= self.cooldown_seconds:
+                self.probe_started_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self.probe_started_at = None
+
+    def record_failure(self, error=None):
+        """
+        Count a connection failure
+
+        Returns:
+            bool: True if this failure opened the breaker
+        """
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error) if error is not None else None
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.probe_started_at = None
+                return True
+            return False
+
+    def _remaining(self):
+        """Seconds until a probe may run, or None if the breaker is closed"""
+        if self.state == CLOSED:
+            return None
+        started = self.opened_at if self.state == OPEN else self.probe_started_at
+        return max(0.0, started + self.cooldown_seconds - time.monotonic())
+
+    def is_skipping(self):
+        """Whether callers are being turned away right now"""
+        with self._lock:
+            remaining = self._remaining()
+        return remaining is not None and remaining > 0
+
+    def retry_at(self):
+        """
+        Returns:
+            datetime: When the next probe may run, or None if the breaker is closed
+        """
+        with self._lock:
+            remaining = self._remaining()
+        if remaining is None:
+            return None
+        return datetime.now() + timedelta(seconds=remaining)
+
+
+class HostCircuitBreakers:
+    """Circuit breakers keyed by protocol ('smtp' or 'imap') and host name"""
+
+    def __init__(self, failure_threshold=5, cooldown_seconds=300):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def _breaker(self, protocol, host):
+        key = (protocol, (host or '').lower())
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker(self.failure_threshold, self.cooldown_seconds)
+            return self._breakers[key]
+
+    def allow(self, protocol, host):
+        """
+        Whether a connection to a host may be attempted now
+
+        Args:
+            protocol (str): 'smtp' or 'imap'
+            host (str): Server host name
+
+        Returns:
+            bool: False while the host's breaker is open
+        """
+        return self._breaker(protocol, host).allow()
+
+    def is_skipped(self, protocol, host):
+        """Whether the host is being skipped, without claiming the half-open probe"""
+        return self._breaker(protocol, host).is_skipping()
+
+    def record(self, protocol, host, error=None):
+        """
+        Report the outcome of talking to a host. Only connection failures count
+        against it - a server that answers, even with a refusal, is up.
+
+        Args:
+            protocol (str): 'smtp' or 'imap'
+            host (str): Server host name
+            error (Exception): The error raised, or None on success
+        """
+        breaker = self._breaker(protocol, host)
+        if error is None or not is_connection_failure(error):
+            if breaker.state != CLOSED:
+                logger.info(f"Circuit for {protocol} host {host} closed")
+            breaker.record_success()
+        elif breaker.record_failure(error):
+            logger.warning(f"Circuit for {protocol} host {host} opened after {breaker.failures} connection failures "
+                           f"- skipping it for {breaker.cooldown_seconds}s")
+
+    def retry_at(self, protocol, host):
+        """
+        Returns:
+            datetime: When the host will be probed again, or None if it isn't being skipped
+        """
+        breaker = self._breaker(protocol, host)
+        if not breaker.is_skipping():
+            return None
+        return breaker.retry_at()
+
+    def status(self, protocol, host):
+        """
+        Breaker state for display
+
+        Returns:
+            dict: state, consecutive failures, last error and next probe time
+        """
+        breaker = self._breaker(protocol, host)
+        return {
+            'state': breaker.state,
+            'failures': breaker.failures,
+            'last_error': breaker.last_error,
+            'retry_at': breaker.retry_at(),
+        }
+
+
+_breakers = None
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breakers():
+    """
+    Get the process-wide host circuit breakers
+
+    Returns:
+        HostCircuitBreakers: The shared breakers
+    """
+    global _breakers
+    if _breakers is None:
+        from app import app
+        with _breakers_lock:
+            if _breakers is None:
+                _breakers = HostCircuitBreakers(
+                    failure_threshold=app.config['CIRCUIT_FAILURE_THRESHOLD'],
+                    cooldown_seconds=app.config['CIRCUIT_COOLDOWN_SECONDS']
+                )
+    return _breakers
@@ -0,0 +1,147 @@
+"""
+Due-time dispatcher for the Beakon Solutions platform.
+
+Instead of polling the queue on a fixed interval, the dispatcher keeps a
+min-heap of upcoming scheduled_at times and sleeps until the earliest one is
+due. Routes wake it when they create, reschedule or resume emails, and it
+reconciles against the database periodically to pick up anything else.
+"""
+
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import select, or_, and_
+
+from app import app, db
+from app.models.models import Email, EmailStatus
+
+logger = logging.getLogger(__name__)
+
+
+class DueTimeDispatcher:
+    """
+    Runs the send queue when emails become due
+
+    Args:
+        run_queue (callable): Processes the queue and returns the number of emails sent
+        reconcile_seconds (int): Longest time between database checks
+        lookahead (int): Number of upcoming due times loaded into the heap per check
+    """
+
+    def __init__(self, run_queue, reconcile_seconds=60, lookahead=100):
+        self.run_queue = run_queue
+        self.reconcile_seconds = reconcile_seconds
+        self.lookahead = lookahead
+        self._heap = []
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the dispatcher thread"""
+        self._thread = threading.Thread(target=self._run, name='email-dispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wake(self):
+        """Re-check the database now, e.g. after emails were scheduled or resumed"""
+        self._wake.set()
+
+    def _reconcile(self):
+        """
+        Reload upcoming due times from the database
+
+        Returns:
+            bool: True if some emails are due now (or hold expired send leases)
+        """
+        with app.app_context():
+            now = datetime.now()
+            upcoming = db.session.execute(
+                select(Email.scheduled_at)
+                .where(Email.status == EmailStatus.PENDING, Email.scheduled_at > now)
+                .order_by(Email.scheduled_at)
+                .limit(self.lookahead)
+            ).scalars().all()
+
+            due = db.session.execute(
+                select(Email.id).where(or_(
+                    and_(Email.status == EmailStatus.PENDING, Email.scheduled_at <= now),
+                    and_(Email.status == EmailStatus.SENDING, Email.lease_expires_at < now)
+                )).limit(1)
+            ).first()
+
+        self._heap = list(upcoming)
+        heapq.heapify(self._heap)
+        return due is not None
+
+    def _dispatch(self):
+        """Run the queue, again right away while it keeps finding work"""
+        while self.run_queue() and self._reconcile():
+            pass
+
+    def _seconds_until_next(self, next_reconcile):
+        wait = next_reconcile - time.monotonic()
+        if self._heap:
+            wait = min(wait, (self._heap[0] - datetime.now()).total_seconds())
+        return max(0.0, wait)
+
+    def _run(self):
+        logger.info("Email dispatcher started")
+        next_reconcile = 0.0
+        while True:
+            try:
+                if self._wake.is_set() or time.monotonic() >= next_reconcile:
+                    self._wake.clear()
+                    next_reconcile = time.monotonic() + self.reconcile_seconds
+                    if self._reconcile():
+                        self._dispatch()
+                elif self._heap and self._heap[0] <= datetime.now():
+                    now = datetime.now()
+                    while self._heap and self._heap[0] <= now:
+                        heapq.heappop(self._heap)
+                    self._dispatch()
+            except Exception as e:
+                logger.error(f"Error in email dispatcher: {str(e)}")
+                # Don't spin on a persistent error such as the database being down
+                self._heap = []
+
+            self._wake.wait(self._seconds_until_next(next_reconcile))
+
+
+_dispatcher = None
+
+
+def start_dispatcher(run_queue):
+    """
+    Start the process-wide dispatcher
+
+    Args:
+        run_queue (callable): Processes the queue and returns the number of emails sent
+
+    Returns:
+        DueTimeDispatcher: The running dispatcher
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = DueTimeDispatcher(
+            run_queue,
+            reconcile_seconds=app.config['SEND_DISPATCH_RECONCILE_SECONDS'],
+            lookahead=app.config['SEND_DISPATCH_LOOKAHEAD']
+        )
+        _dispatcher.start()
+    return _dispatcher
+
+
+def wake_dispatcher():
+    """
+    Tell the dispatcher that due times changed
+
+    Returns:
+        bool: False if no dispatcher runs in this process (e.g. on PythonAnywhere)
+    """
+    if _dispatcher is None:
+        return False
+    _dispatcher.wake()
+    return True
@@ -3,20 +3,36 @@ Email utility functions for the Beakon Solutions platform.
 """
 
 import smtplib
-import ssl
 import imaplib
-import email as email_lib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.generator import BytesGenerator
 import re
 from datetime import datetime, timedelta
 import logging
 import os
+import io
+import hashlib
 import traceback
 from app import app, db, socketio
-from app.models.models import Email, EmailStatus, EmailAccount
-from email.header import decode_header
+from app.models.models import Email, EmailStatus, EmailAccount, AccountDailyUsage
+from app.utils.rate_limiter import get_rate_limiter, THROTTLE_CODES
+from app.utils.retry_policy import classify_send_error, retry_delay, account_suspensions, AUTH, TRANSIENT
+from app.utils.circuit_breaker import get_circuit_breakers
+from app.utils.imap_pool import get_imap_pool
+from app.utils.transports import get_transport
+from app.utils.reply_index import SentEmailIndex
+from app.utils.status_buffer import get_status_buffer, unsaved_values
+from app.utils.imap_utils import (select_folder, get_sync_state, find_new_uids, advance_watermark,
+                                  plan_reply_searches, narrow_uids, iter_header_batches, fetch_text_bodies,
+                                  truncate_text)
 import socket
+from sqlalchemy.orm import joinedload
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
 
 logger = logging.getLogger(__name__)
 
@@ -104,24 +120,293 @@ def personalize_email(template, recipient):
     
     return personalized
 
-def send_email(email_id, force_send=False):
+def send_email(email_id, force_send=False, reserved_on=None):
     """
     Send an email using SMTP
     
     Args:
         email_id (int): ID of the email to send
         force_send (bool): If True, will send the email even in test mode
+        reserved_on (date): Day daily-limit capacity was already reserved for this send
         
     Returns:
         tuple: (success, message) where success is a boolean and message contains details
     """
     try:
-        # Get email from database
-        email = Email.query.get(email_id)
-        if not email:
-            logger.error(f"Email with ID {email_id} not found")
-            return False, "Email not found in database"
-            
+        # Get email from database together with its recipient, account, spooled message and thread parent
+        email = Email.query.options(
+            joinedload(Email.recipient),
+            joinedload(Email.account),
+            joinedload(Email.spool),
+            joinedload(Email.parent)
+        ).filter(Email.id == email_id).first()
+    except Exception as e:
+        error_msg = f"Error loading email {email_id}: {str(e)}"
+        logger.error(error_msg)
+        return False, error_msg
+        
+    if not email:
+        logger.error(f"Email with ID {email_id} not found")
+        return False, "Email not found in database"
+        
+    return deliver_email(email, force_send=force_send, reserved_on=reserved_on)
+
+def build_message(email):
+    """
+    Build the MIME message for an email
+    
+    Args:
+        email (Email): The email, with recipient and account loaded
+        
+    Returns:
+        MIMEMultipart: The message ready to send
+    """
+    msg = MIMEMultipart()
+    msg['From'] = email.account.email
+    msg['To'] = email.recipient.email
+    msg['Subject'] = email.subject
+    msg['Message-ID'] = make_message_id(email)
+    
+    # Thread follow-ups under the emails they follow up on
+    ancestors = thread_ancestors(email)
+    if ancestors:
+        msg['In-Reply-To'] = ancestors[-1]
+        msg['References'] = ' '.join(ancestors)
+        
+    # Attach HTML content
+    msg.attach(MIMEText(email.body, 'html'))
+    return msg
+
+def make_message_id(email):
+    """
+    The Message-ID of an email
+    
+    It is derived from the email's ID and creation time, so every render of
+    the same email carries the same ID and the spool stays valid.
+    
+    Args:
+        email (Email): The email, with its account loaded
+        
+    Returns:
+        str: Message-ID including the angle brackets
+    """
+    if email.message_id:
+        return email.message_id
+    seed = f"{app.config['SECRET_KEY']}:{email.id}:{email.created_at.isoformat() if email.created_at else ''}"
+    token = hashlib.sha256(seed.encode('utf-8')).hexdigest()[:32]
+    domain = email.account.email.rsplit('@', 1)[-1] if '@' in email.account.email else 'localhost'
+    try:
+        domain = domain.encode('idna').decode('ascii')
+    except UnicodeError:
+        domain = 'localhost'
+    return f"<{token}@{domain}>"
+
+def thread_ancestors(email):
+    """
+    Message-IDs of the emails a follow-up continues, oldest first
+    
+    Args:
+        email (Email): The email
+        
+    Returns:
+        list: Message-IDs for the References header, empty for a first email
+    """
+    ancestors = []
+    parent = email.parent if email.parent_email_id else None
+    while parent is not None and len(ancestors) < 20:
+        ancestors.insert(0, make_message_id(parent))
+        parent = parent.parent if parent.parent_email_id else None
+    return ancestors
+
+def render_message(email):
+    """
+    Serialize an email to the bytes sent over SMTP
+    
+    Args:
+        email (Email): The email, with recipient and account loaded
+        
+    Returns:
+        bytes: The RFC 5322 message with CRLF line endings
+    """
+    msg = build_message(email)
+    output = io.BytesIO()
+    BytesGenerator(output, policy=msg.policy).flatten(msg, linesep='\r\n')
+    return output.getvalue()
+
+def message_fingerprint(email):
+    """
+    Fingerprint everything a rendered message is built from
+    
+    Args:
+        email (Email): The email, with recipient and account loaded
+        
+    Returns:
+        str: Hex digest that changes whenever the rendered bytes would
+    """
+    digest = hashlib.sha256()
+    for part in (email.account.email, email.recipient.email, email.subject, email.body,
+                 make_message_id(email), ' '.join(thread_ancestors(email))):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def get_message_bytes(email):
+    """
+    Get the bytes to send for an email, from the spool when its entry is still current
+    
+    Args:
+        email (Email): The email, with recipient, account and spool loaded
+        
+    Returns:
+        bytes: The RFC 5322 message
+    """
+    spool = email.spool
+    if spool is not None and spool.fingerprint == message_fingerprint(email):
+        return spool.message
+    return render_message(email)
+
+def save_send_status(email, status, reserved_on=None, error=None, retry_at=None, status_buffer=None):
+    """
+    Write the outcome of a send attempt, together with the daily counter for sent emails.
+    
+    Args:
+        email (Email): The email that was attempted
+        status (EmailStatus): SENT, FAILED, or PENDING to retry it later
+        reserved_on (date): Day daily-limit capacity was reserved for the send
+        error (str): Error text for a failed attempt
+        retry_at (datetime): When to retry, for PENDING
+        status_buffer (StatusWriteBuffer): Buffer to hand the write to instead of committing now
+    """
+    values = {
+        'status': status,
+        'lease_expires_at': None,
+        'last_error': error,
+        'attempt_count': (email.attempt_count or 0) + 1
+    }
+    if status == EmailStatus.SENT:
+        values['sent_at'] = datetime.now()
+        # Replies are matched to the email by the Message-ID it went out with
+        values['message_id'] = make_message_id(email)
+    elif status == EmailStatus.PENDING:
+        # Back in the queue for another attempt
+        values['scheduled_at'] = retry_at
+        values['claimed_by'] = None
+        
+    if status_buffer is not None:
+        status_buffer.record(email, values, reserved_on=reserved_on)
+        return
+        
+    email_id, account_id = email.id, email.account_id
+    if status == EmailStatus.SENT:
+        # Kept in case the commit fails, with personalization made for the send
+        buffered_values = unsaved_values(email, dict(values))
+        # Counter rows are created on their own connection, before the session takes the write lock
+        AccountDailyUsage.ensure_row(account_id)
+    for key, value in values.items():
+        setattr(email, key, value)
+    try:
+        if status == EmailStatus.SENT:
+            # Write the status first, a counter row re-seeded in this transaction counts it
+            db.session.flush()
+            # Use the reservation only if the email still holds it, e.g. its lease wasn't reclaimed
+            reserved = AccountDailyUsage.take_reservations([email_id], reserved_on)
+            AccountDailyUsage.record_sent(account_id, reserved_on=reserved_on, reserved=reserved)
+            # The pre-rendered message is no longer needed
+            email.spool = None
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        if status != EmailStatus.SENT:
+            raise
+        # The server took the message - journal it and let the write-behind buffer
+        # keep retrying, so the email is never sent again
+        logger.error(f"Email {email_id} sent but its status could not be committed, buffering it: {str(e)}")
+        get_status_buffer().record_values(email_id, account_id, buffered_values, reserved_on=reserved_on)
+
+def describe_send_error(error, account):
+    """
+    Human readable description of a failed send
+    
+    Args:
+        error (Exception): The exception raised while sending
+        account (EmailAccount): Account the send was made from
+        
+    Returns:
+        str: The error message
+    """
+    # The asyncio engine raises aiosmtplib's counterparts of smtplib's errors
+    auth_errors, connect_errors, disconnect_errors = (
+        (smtplib.SMTPAuthenticationError,), (smtplib.SMTPConnectError,), (smtplib.SMTPServerDisconnected,)
+    )
+    if aiosmtplib is not None:
+        auth_errors += (aiosmtplib.SMTPAuthenticationError,)
+        connect_errors += (aiosmtplib.SMTPConnectError,)
+        disconnect_errors += (aiosmtplib.SMTPServerDisconnected,)
+        
+    if isinstance(error, socket.gaierror):
+        return f"SMTP Connection Error: Could not resolve hostname '{account.smtp_server}'"
+    if isinstance(error, auth_errors):
+        return f"SMTP Authentication Error: Username or password incorrect for {account.smtp_username}"
+    if isinstance(error, connect_errors):
+        return f"SMTP Connection Error: Could not connect to {account.smtp_server}:{account.smtp_port}"
+    if isinstance(error, disconnect_errors):
+        return "SMTP Server Disconnected: The server unexpectedly disconnected"
+    return f"SMTP Error: {str(error)}"
+
+def save_send_failure(email, error, error_msg, status_buffer=None):
+    """
+    Apply the retry policy to a failed send: reschedule transient failures with
+    backoff, fail permanent ones, and suspend the account on authentication failures.
+    
+    Args:
+        email (Email): The email that failed
+        error (Exception): The exception raised while sending
+        error_msg (str): Description of the failure
+        status_buffer (StatusWriteBuffer): Buffer to hand the write to instead of committing now
+        
+    Returns:
+        str: The failure class - TRANSIENT, PERMANENT or AUTH
+    """
+    kind = classify_send_error(error)
+    attempts = (email.attempt_count or 0) + 1
+    
+    if kind == AUTH:
+        # Not this message's fault - stop the account and retry once it may send again
+        suspend_seconds = app.config['SEND_AUTH_SUSPEND_SECONDS']
+        account_suspensions.suspend(email.account_id, suspend_seconds)
+        retry_at = datetime.now() + timedelta(seconds=suspend_seconds)
+        save_send_status(email, EmailStatus.PENDING, error=error_msg, retry_at=retry_at, status_buffer=status_buffer)
+    elif kind == TRANSIENT and attempts < app.config['SEND_RETRY_MAX_ATTEMPTS']:
+        retry_at = datetime.now() + retry_delay(
+            attempts,
+            app.config['SEND_RETRY_BASE_SECONDS'],
+            app.config['SEND_RETRY_MAX_SECONDS']
+        )
+        logger.info(f"Email {email.id} failed with a transient error (attempt {attempts}), retrying at {retry_at}")
+        save_send_status(email, EmailStatus.PENDING, error=error_msg, retry_at=retry_at, status_buffer=status_buffer)
+    else:
+        save_send_status(email, EmailStatus.FAILED, error=error_msg, status_buffer=status_buffer)
+        
+    return kind
+
+def deliver_email(email, force_send=False, reserved_on=None, status_buffer=None):
+    """
+    Send an already loaded email using SMTP.
+    Works on the email's loaded recipient and account, and writes the final
+    status together with the daily counter in a single commit, or hands it
+    to a write-behind buffer when one is given.
+    
+    Args:
+        email (Email): The email to send, with recipient and account loaded
+        force_send (bool): If True, will send the email even in test mode
+        reserved_on (date): Day daily-limit capacity was already reserved for this send
+        status_buffer (StatusWriteBuffer): Buffer for the final status, e.g. from a send lane
+        
+    Returns:
+        tuple: (success, message) where success is a boolean and message contains details
+    """
+    email_id = email.id
+    try:
         # Check if email is paused
         if email.status == EmailStatus.PAUSED:
             logger.info(f"Email {email_id} is paused, skipping")
@@ -133,101 +418,81 @@ def send_email(email_id, force_send=False):
             logger.error(f"Account {account.id if account else 'None'} not active or found")
             return False, "Email account not active or not found"
         
+        recipient_email = email.recipient.email
+        
         # Check if we're in test mode
         is_test_mode = os.environ.get('EMAIL_TEST_MODE', 'False').lower() == 'true'
         
         # Log the attempt
-        logger.info(f"Attempting to send email {email_id} to {email.recipient.email} from {account.email}")
+        logger.info(f"Attempting to send email {email_id} to {recipient_email} from {account.email}")
         logger.info(f"SMTP Settings: {account.smtp_server}:{account.smtp_port}, Username: {account.smtp_username}")
         
         # If in test mode and not forcing, just log and return success without actually sending
         if is_test_mode and not force_send:
-            logger.info(f"TEST MODE: Email would be sent to {email.recipient.email}")
+            logger.info(f"TEST MODE: Email would be sent to {recipient_email}")
             logger.info(f"Email subject: {email.subject}")
             logger.info(f"Email content (preview): {email.body[:100]}...")
             
             # Update email status
-            email.status = EmailStatus.SENT
-            email.sent_at = datetime.now()
-            db.session.commit()
+            save_send_status(email, EmailStatus.SENT, reserved_on=reserved_on, status_buffer=status_buffer)
             
             return True, "Email marked as sent (TEST MODE)"
         else:
-            logger.info(f"==== REAL SENDING MODE ACTIVE ==== Email will be sent for real to {email.recipient.email}")
-        
-        # Check if we've reached daily limit (only for regular sends, not forced test sends)
-        if not force_send:
-            today = datetime.now().date()
-            midnight = datetime.combine(today, datetime.min.time())
-            sent_today = Email.query.filter(
-                Email.account_id == account.id,
-                Email.status == EmailStatus.SENT,
-                Email.sent_at >= midnight
-            ).count()
-            
-            if sent_today >= account.daily_limit:
+            logger.info(f"==== REAL SENDING MODE ACTIVE ==== Email will be sent for real to {recipient_email}")
+        
+        # Check if we've reached daily limit (only for regular sends without a reservation, not forced test sends)
+        if not force_send and reserved_on is None:
+            if account.get_sent_today() >= account.daily_limit:
                 logger.warning(f"Daily limit reached for account {account.id}")
-                # Reschedule for tomorrow
+                # Reschedule for tomorrow and give up any send lease held on it
                 tomorrow = datetime.now() + timedelta(days=1)
                 email.scheduled_at = tomorrow
+                email.status = EmailStatus.PENDING
+                email.claimed_by = None
+                email.lease_expires_at = None
                 db.session.commit()
                 return False, "Daily email limit reached for this account"
         
-        # Prepare email
-        msg = MIMEMultipart()
-        msg['From'] = account.email
-        msg['To'] = email.recipient.email
-        msg['Subject'] = email.subject
-        
-        # Attach HTML content
-        msg.attach(MIMEText(email.body, 'html'))
+        # Prepare email - use the message pre-rendered at schedule time if it is still current
+        message_bytes = get_message_bytes(email)
         
-        # Create secure SSL context
-        context = ssl.create_default_context()
+        # Hand the message to the account's transport - SMTP, or a file/null sink for dry runs
+        transport = get_transport(account)
         
         # Send email with verbose logging
+        accepted = False
         try:
-            logger.info(f"REAL SEND: Connecting to SMTP server: {account.smtp_server}:{account.smtp_port}")
-            try:
-                with smtplib.SMTP_SSL(account.smtp_server, account.smtp_port, context=context) as server:
-                    logger.info(f"Logging in with username: {account.smtp_username}")
-                    server.login(account.smtp_username, account.smtp_password)
-                    
-                    logger.info(f"Sending email from {account.email} to {email.recipient.email}")
-                    server.send_message(msg)
-                    logger.info("Email sent successfully")
-                
-                # Update email status
-                email.status = EmailStatus.SENT
-                email.sent_at = datetime.now()
-                db.session.commit()
-                
-                logger.info(f"Email {email_id} sent successfully to {email.recipient.email}")
-                return True, "Email sent successfully"
-            except socket.gaierror:
-                error_msg = f"SMTP Connection Error: Could not resolve hostname '{account.smtp_server}'"
-                logger.error(error_msg)
-                return False, error_msg
-            except smtplib.SMTPAuthenticationError:
-                error_msg = f"SMTP Authentication Error: Username or password incorrect for {account.smtp_username}"
-                logger.error(error_msg)
-                return False, error_msg
-            except smtplib.SMTPConnectError:
-                error_msg = f"SMTP Connection Error: Could not connect to {account.smtp_server}:{account.smtp_port}"
-                logger.error(error_msg)
-                return False, error_msg
-            except smtplib.SMTPServerDisconnected:
-                error_msg = f"SMTP Server Disconnected: The server unexpectedly disconnected"
-                logger.error(error_msg)
-                return False, error_msg
+            transport.send(account, account.email, [recipient_email], message_bytes)
+            logger.info("Email sent successfully")
+            accepted = True
+            get_rate_limiter().record_success(account)
+            if transport.name == 'smtp':
+                get_circuit_breakers().record('smtp', account.smtp_server)
+            
+            # Update email status and the daily counter in one transaction
+            save_send_status(email, EmailStatus.SENT, reserved_on=reserved_on, status_buffer=status_buffer)
+            
+            logger.info(f"Email {email_id} sent successfully to {recipient_email}")
+            return True, "Email sent successfully"
         except Exception as e:
-            error_msg = f"SMTP Error: {str(e)}"
+            error_msg = describe_send_error(e, account)
             logger.error(error_msg)
             logger.error(f"Stack trace: {traceback.format_exc()}")
             
-            # Update email status to failed
-            email.status = EmailStatus.FAILED
-            db.session.commit()
+            if isinstance(e, smtplib.SMTPResponseException) and e.smtp_code in THROTTLE_CODES:
+                get_rate_limiter().record_throttle(account, e.smtp_code)
+            
+            if accepted:
+                # The server took the message - never report it as unsent
+                db.session.rollback()
+                return True, f"Email sent but its status could not be saved: {str(e)}"
+            
+            # Count connection failures against the SMTP host
+            if transport.name == 'smtp':
+                get_circuit_breakers().record('smtp', account.smtp_server, e)
+            
+            # Retry, fail or suspend the account depending on the error
+            save_send_failure(email, e, error_msg, status_buffer=status_buffer)
             
             return False, error_msg
         
@@ -237,9 +502,12 @@ def send_email(email_id, force_send=False):
         logger.error(f"Stack trace: {traceback.format_exc()}")
         
         # Update email status
-        if email:
-            email.status = EmailStatus.FAILED
-            db.session.commit()
+        try:
+            db.session.rollback()
+            save_send_status(email, EmailStatus.FAILED, error=error_msg, status_buffer=status_buffer)
+        except Exception as db_error:
+            db.session.rollback()
+            logger.error(f"Could not mark email {email_id} as failed: {str(db_error)}")
             
         return False, error_msg
 
@@ -292,234 +560,280 @@ def verify_imap_credentials(account_id):
     """
     Verify IMAP credentials for an email account
     
+    The session opened for the check is kept in the IMAP pool, so a reply
+    check right after it doesn't log in again.
+    
     Args:
         account_id (int): ID of the email account
         
     Returns:
-        bool: True if credentials are valid, False otherwise
+        tuple: (success, message) where success is a boolean and message contains details
     """
     try:
-        from app import db
-        from app.models.models import EmailAccount
-        
         with app.app_context():
             account = EmailAccount.query.get(account_id)
-            if not account or not account.imap_enabled:
-                return False
+            if not account:
+                return False, "Email account not found"
+            if not account.imap_enabled or not account.imap_server:
+                return False, "IMAP is not enabled for this account"
                 
-            # Try to connect to IMAP server
+            imap_pool = get_imap_pool()
             try:
-                imap = imaplib.IMAP4_SSL(account.imap_server, account.imap_port)
-                imap.login(account.imap_username, account.imap_password)
-                imap.logout()
-                
-                # Update verification timestamp
-                account.imap_verified_at = datetime.now()
-                db.session.commit()
-                
-                return True
+                session = imap_pool.acquire(account)
             except Exception as e:
+                get_circuit_breakers().record('imap', account.imap_server, e)
                 logger.error(f"IMAP verification failed for account {account_id}: {str(e)}")
-                return False
+                return False, str(e)
+            get_circuit_breakers().record('imap', account.imap_server)
+            imap_pool.release(session)
+            
+            # Update verification timestamp
+            account.imap_verified_at = datetime.now()
+            db.session.commit()
+            
+            return True, "IMAP credentials verified"
     except Exception as e:
         logger.error(f"Error verifying IMAP credentials: {str(e)}")
-        return False
+        return False, str(e)
 
-def check_for_replies(account_id):
+def check_for_replies(account_id, raise_errors=False, timeout=None):
     """
-    Check for replies to emails sent from a specific account
+    Check for replies to emails sent from a specific account.
+    Only messages that arrived since the last check are read, see imap_utils.
     
     Args:
         account_id (int): ID of the email account
+        raise_errors (bool): Raise connection and processing errors instead of returning 0
+        timeout (float): Socket timeout for the IMAP session
         
     Returns:
         int: Number of new replies found
     """
     try:
-        from app import db
-        from app.models.models import EmailAccount, Email, EmailStatus
-        
         with app.app_context():
             account = EmailAccount.query.get(account_id)
             if not account or not account.imap_enabled or not account.imap_server:
                 logger.warning(f"IMAP not configured for account {account_id}")
                 return 0
                 
-            # Connect to IMAP server
-            try:
-                imap = imaplib.IMAP4_SSL(account.imap_server, account.imap_port)
-                imap.login(account.imap_username, account.imap_password)
-                
-                # Select inbox
-                imap.select('INBOX')
+            # Only emails still waiting for an answer can receive one
+            sent_emails = emails_awaiting_reply(account.id)
+            if not sent_emails:
+                logger.debug(f"No sent emails awaiting replies for account {account_id}")
+                return 0
                 
-                # Search for recent emails (last 30 days)
-                date = (datetime.now() - timedelta(days=30)).strftime("%d-%b-%Y")
-                result, data = imap.search(None, f'(SINCE {date})')
+            # Don't wait out a connect timeout on a host that is known to be down
+            circuit_breakers = get_circuit_breakers()
+            if not circuit_breakers.allow('imap', account.imap_server):
+                logger.warning(f"IMAP host {account.imap_server} is unreachable - skipping reply check for account {account_id}")
+                return 0
                 
-                if result != 'OK':
-                    logger.warning(f"IMAP search failed for account {account_id}")
-                    imap.logout()
+            # Reuse the account's pooled session; one that went stale is replaced once
+            imap_pool = get_imap_pool()
+            while True:
+                try:
+                    session = imap_pool.acquire(account, timeout=timeout)
+                except Exception as e:
+                    circuit_breakers.record('imap', account.imap_server, e)
+                    logger.error(f"Error connecting to IMAP server: {str(e)}")
+                    if raise_errors:
+                        raise
                     return 0
-                    
-                mail_ids = data[0].split()
+                circuit_breakers.record('imap', account.imap_server)
                 
-                # No emails found
-                if not mail_ids:
-                    imap.logout()
-                    return 0
-
-            except Exception as e:
-                logger.error(f"Error connecting to IMAP server: {str(e)}")
-                imap.logout()
-                return 0
-
-            replies_found = 0
-            try:
-                # Process emails in reverse order (newest first)
-                for email_id in reversed(mail_ids):
-                    try:
-                        # Fetch email message
-                        status, msg_data = imap.fetch(email_id, '(RFC822)')
-                        if status != 'OK' or not msg_data or not msg_data[0]:
-                            logger.warning(f"Failed to fetch message {email_id}")
-                            continue
-
-                        email_body = msg_data[0][1]
-                        email_message = email.message_from_bytes(email_body)
-
-                        # Get sender
-                        from_header = decode_header(email_message['From'])[0]
-                        sender_email = extract_email_from_header(from_header[0])
-                        logger.debug(f"Checking email from: {sender_email}")
-
-                        # Get subject
-                        subject_header = decode_header(email_message['Subject'] or '(No subject)')[0]
-                        subject = subject_header[0]
-                        if isinstance(subject, bytes):
-                            subject = subject.decode('utf-8', errors='replace')
-                        logger.debug(f"Subject: {subject}")
-
-                        # Get message content
-                        content = ""
-                        if email_message.is_multipart():
-                            for part in email_message.walk():
-                                content_type = part.get_content_type()
-                                content_disposition = str(part.get("Content-Disposition") or '')
-                                
-                                # Skip attachments
-                                if "attachment" in content_disposition:
-                                    continue
-                                    
-                                if content_type == "text/plain":
-                                    try:
-                                        part_content = part.get_payload(decode=True)
-                                        charset = part.get_content_charset() or 'utf-8'
-                                        content = part_content.decode(charset, errors='replace')
-                                        break
-                                    except Exception as e:
-                                        logger.warning(f"Failed to decode part: {str(e)}")
-                                        continue
-                        else:
-                            try:
-                                part_content = email_message.get_payload(decode=True)
-                                charset = email_message.get_content_charset() or 'utf-8'
-                                content = part_content.decode(charset, errors='replace') if part_content else ""
-                            except Exception as e:
-                                logger.warning(f"Failed to decode email content: {str(e)}")
-                                content = ""
-
-                        # Check if this is a reply to any of our sent emails
-                        for sent_email in sent_emails:
-                            recipient_email = sent_email['recipient_id']
-                            original_subject = sent_email['subject']
-                            
-                            # More flexible sender matching
-                            is_from_recipient = False
-                            
-                            # Exact match
-                            if sender_email.lower() == recipient_email:
-                                is_from_recipient = True
-                            else:
-                                # Try to extract just the domain parts for comparison
-                                try:
-                                    sender_domain = sender_email.lower().split('@')[1]
-                                    recipient_domain = recipient_email.split('@')[1]
-                                    if sender_domain == recipient_domain:
-                                        # Domains match, might be same person with different prefix
-                                        is_from_recipient = True
-                                except:
-                                    pass
-                            
-                            # More flexible subject matching
-                            current_subject = subject.lower()
-                            
-                            # Clean subjects (remove Re:, Fwd:, etc.)
-                            cleaned_original = re.sub(r'^(re|fwd|fw):\s*', '', original_subject)
-                            cleaned_current = re.sub(r'^(re|fwd|fw):\s*', '', current_subject)
-                            
-                            # Consider subject match if:
-                            # 1. Current has "Re:" and contains original
-                            # 2. Cleaned subjects match or significantly overlap
-                            # 3. For Hostinger, be even more flexible
-                            is_reply_subject = (
-                                ("re:" in current_subject and cleaned_original in cleaned_current) or
-                                (cleaned_current in cleaned_original or cleaned_original in cleaned_current)
-                            )
-                            
-                            # For Hostinger, we might need to be more flexible with matching
-                            if is_hostinger and not is_reply_subject:
-                                # If sender email matches exactly, accept with looser subject matching
-                                if sender_email.lower() == recipient_email:
-                                    # Just check if there's any word overlap (at least 3 chars)
-                                    orig_words = set(w for w in re.findall(r'\b\w+\b', cleaned_original) if len(w) > 3)
-                                    curr_words = set(w for w in re.findall(r'\b\w+\b', cleaned_current) if len(w) > 3)
-                                    if orig_words.intersection(curr_words):
-                                        is_reply_subject = True
-                                        logger.info(f"Hostinger special match: sender matches and found word overlap in subjects")
-                            
-                            logger.debug(f"Comparing: recipient={recipient_email}, sender={sender_email}, match={is_from_recipient}")
-                            logger.debug(f"Comparing: original subject={original_subject}, current subject={current_subject}, match={is_reply_subject}")
-                            
-                            if is_from_recipient and (is_reply_subject or "re:" in current_subject.lower()):
-                                # Update email status
-                                sent_email['status'] = EmailStatus.RESPONDED
-                                sent_email['response_received_at'] = datetime.now()
-                                sent_email['response_subject'] = subject
-                                sent_email['response_content'] = content
-                                db.session.commit()
-
-                                # Broadcast the new reply
-                                broadcast_new_reply(sent_email)
-                                
-                                logger.info(f"Found reply to email {sent_email['id']} from {sender_email}")
-
-                                replies_found += 1
-                                break
-
-                    except Exception as e:
-                        logger.error(f"Error processing email {email_id}: {str(e)}")
-                        logger.error(traceback.format_exc())
-                        continue
-
-            finally:
-                try:
-                    imap.close()
-                except:
-                    pass
                 try:
-                    imap.logout()
-                except:
-                    pass
+                    replies_found = read_new_replies(account, session.imap, sent_emails, uidvalidity=session.uidvalidity)
+                except (imaplib.IMAP4.abort, OSError):
+                    imap_pool.release(session, reusable=False)
+                    if not session.reused:
+                        raise
+                    logger.info(f"Pooled IMAP session for account {account.id} was disconnected, retrying on a new session")
+                    continue
+                except Exception:
+                    imap_pool.release(session, reusable=False)
+                    raise
+                imap_pool.release(session)
+                break
 
             logger.info(f"Completed check for account {account.email}, found {replies_found} replies")
             return replies_found
 
     except Exception as e:
+        if raise_errors:
+            raise
+        db.session.rollback()
         logger.error(f"Error checking for replies: {str(e)}")
         logger.error(traceback.format_exc())
         return 0
 
+def emails_awaiting_reply(account_id):
+    """
+    Get an account's sent emails that have not been answered yet
+    
+    Args:
+        account_id (int): ID of the email account
+        
+    Returns:
+        list: Emails with their recipients loaded
+    """
+    return Email.query.options(joinedload(Email.recipient)).filter(
+        Email.account_id == account_id,
+        Email.status == EmailStatus.SENT
+    ).all()
+
+def read_new_replies(account, imap, sent_emails, uidvalidity=None):
+    """
+    Read the messages that arrived since the last check and record the replies among them
+    
+    Args:
+        account (EmailAccount): The account whose mailbox is read
+        imap (IMAP4): Authenticated session on the account's IMAP server
+        sent_emails (list): The account's emails awaiting a reply, with recipients loaded
+        uidvalidity (int): UIDVALIDITY of the inbox when the session already has it selected
+        
+    Returns:
+        int: Number of new replies found
+    """
+    replies_found = 0
+    # Find the messages that arrived since the last check
+    folder = 'INBOX'
+    if uidvalidity is None:
+        uidvalidity = select_folder(imap, folder, readonly=True)
+    state = get_sync_state(account.id, folder)
+    uids = find_new_uids(imap, state, uidvalidity, app.config['IMAP_RESYNC_DAYS'])
+    logger.info(f"{len(uids)} new messages in {folder} for account {account.email}")
+
+    # Let the server leave out messages that can't be replies
+    candidates = uids
+    searches = plan_reply_searches(*reply_senders(sent_emails), max_senders=app.config['IMAP_SEARCH_MAX_SENDERS'])
+    if uids and searches is not None:
+        candidates = narrow_uids(imap, uids, searches)
+        logger.info(f"{len(candidates)} of them may be replies ({len(searches)} searches)")
+
+    # Headers first, in batches matched as they arrive; bodies only for matched messages
+    batch_size = app.config['IMAP_FETCH_BATCH_SIZE']
+    is_hostinger = 'hostinger' in account.imap_server.lower()
+    # Built on the first message that needs sender/subject matching
+    sent_index = None
+    answered = set()
+    for messages in iter_header_batches(imap, candidates, batch_size):
+        threads = find_threaded_emails(account.id, messages)
+        matched = []
+        for message in messages:
+            try:
+                logger.debug(f"Checking email from: {message.sender}, subject: {message.subject}, size: {message.size}")
+
+                referenced = [threads[message_id] for message_id in message.thread_ids if message_id in threads]
+                if referenced:
+                    # Part of a thread we started - never guess beyond it
+                    sent_email = next((email for email in referenced
+                                       if email.status == EmailStatus.SENT and email.id not in answered), None)
+                else:
+                    if sent_index is None:
+                        # Leave out emails answered earlier in this cycle
+                        sent_index = SentEmailIndex([email for email in sent_emails
+                                                     if email.status == EmailStatus.SENT and email.id not in answered])
+                    sent_email = sent_index.match(message.sender, message.subject, is_hostinger)
+                if sent_email is not None:
+                    # Claimed now, so a later message in the batch can't answer it again
+                    answered.add(sent_email.id)
+                    if sent_index is not None:
+                        sent_index.discard(sent_email)
+                    matched.append((message, sent_email))
+            except Exception as e:
+                logger.error(f"Error processing message UID {message.uid}: {str(e)}")
+                logger.error(traceback.format_exc())
+
+        contents = fetch_text_bodies(
+            imap, [message for message, _ in matched], batch_size,
+            max_bytes=app.config['REPLY_MAX_FETCH_BYTES'], max_length=app.config['REPLY_MAX_TEXT_LENGTH']
+        ) if matched else {}
+        for message, sent_email in matched:
+            try:
+                record_reply(sent_email, message.subject, contents.get(message.uid, ''))
+                logger.info(f"Found reply to email {sent_email.id} from {message.sender}")
+                replies_found += 1
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error processing message UID {message.uid}: {str(e)}")
+                logger.error(traceback.format_exc())
+
+        # Don't read a message again, even one that couldn't be processed
+        if messages:
+            advance_watermark(state, messages[-1].uid)
+            db.session.commit()
+
+    # UIDs expunged between SEARCH and FETCH are done too
+    if uids:
+        advance_watermark(state, uids[-1])
+    db.session.commit()
+    return replies_found
+
+def reply_senders(sent_emails):
+    """
+    Where replies to emails awaiting one can come from
+    
+    Replies are matched on the recipient's domain as well as their address,
+    so the domain is what the server is asked to look for.
+    
+    Args:
+        sent_emails (list): Emails awaiting a reply, with recipients loaded
+        
+    Returns:
+        tuple: (senders, thread_domains) - recipient domains (or addresses
+            without one) and the domains of the emails' Message-IDs
+    """
+    senders = set()
+    thread_domains = set()
+    for email in sent_emails:
+        if email.status != EmailStatus.SENT:
+            continue
+        address = email.recipient.email.strip().lower()
+        senders.add(address.rsplit('@', 1)[1] if '@' in address else address)
+        if email.message_id and '@' in email.message_id:
+            thread_domains.add(email.message_id.rsplit('@', 1)[1].rstrip('>'))
+    return senders, thread_domains
+
+def find_threaded_emails(account_id, messages):
+    """
+    Look up the account's emails that incoming messages reference by Message-ID
+    
+    Args:
+        account_id (int): ID of the email account
+        messages (list): MessageHeaders of the new messages
+        
+    Returns:
+        dict: Message-ID to Email, with recipients loaded
+    """
+    message_ids = list({message_id for message in messages for message_id in message.thread_ids})
+    threads = {}
+    # Keep the IN list well below database parameter limits
+    for start in range(0, len(message_ids), 500):
+        emails = Email.query.options(joinedload(Email.recipient)).filter(
+            Email.account_id == account_id,
+            Email.message_id.in_(message_ids[start:start + 500])
+        ).all()
+        threads.update((email.message_id, email) for email in emails)
+    return threads
+
+def record_reply(sent_email, subject, content):
+    """
+    Mark a sent email as answered and tell connected dashboards
+    
+    Args:
+        sent_email (Email): The email that was replied to
+        subject (str): Subject of the reply
+        content (str): Text of the reply
+    """
+    sent_email.status = EmailStatus.RESPONDED
+    sent_email.response_received_at = datetime.now()
+    sent_email.response_subject = subject[:255]
+    sent_email.response_content = truncate_text(content, app.config['REPLY_MAX_TEXT_LENGTH'])
+    db.session.commit()
+    
+    # Broadcast the new reply
+    broadcast_new_reply(sent_email)
+
 def extract_email_from_header(header):
     """Extract email address from a header value"""
     import re
@@ -546,16 +860,16 @@ def broadcast_new_reply(sent_email):
         try:
             reply_data = {
                 'type': 'new_reply',
-                'email_id': sent_email['id'],
-                'recipient_email': sent_email['recipient_id'],
-                'subject': sent_email['response_subject'],
-                'content': sent_email['response_content'],
-                'received_at': sent_email['response_received_at'].isoformat() if sent_email['response_received_at'] else ""
+                'email_id': sent_email.id,
+                'recipient_email': sent_email.recipient.email,
+                'subject': sent_email.response_subject,
+                'content': sent_email.response_content,
+                'received_at': sent_email.response_received_at.isoformat() if sent_email.response_received_at else ""
             }
             
             # Broadcast to all connected clients using socketio
             socketio.emit('new_reply', reply_data)
-            logger.info(f"Broadcasted new reply for email {sent_email['id']}")
+            logger.info(f"Broadcasted new reply for email {sent_email.id}")
         except Exception as e:
             logger.error(f"Error creating reply data: {str(e)}")
         
@@ -0,0 +1,302 @@
+"""
+IMAP IDLE listeners for the Beakon Solutions platform.
+
+With IMAP_IDLE_ENABLED, every active IMAP-enabled account gets a thread that
+keeps one session open in IDLE on its inbox. When the server announces new
+mail (an untagged EXISTS) the listener leaves IDLE, reads the new UIDs with the
+same code as the poller and goes back to IDLE. IDLE is re-issued every
+IMAP_IDLE_SECONDS, before servers drop idle sessions (RFC 2177 allows 30
+minutes). Accounts whose server lacks IDLE, or whose listener is reconnecting,
+are still checked by the regular reply poll.
+"""
+
+import re
+import time
+import select
+import imaplib
+import logging
+import threading
+
+from app import app
+from app.models.models import EmailAccount
+from app.utils.circuit_breaker import get_circuit_breakers
+from app.utils.net_utils import connect_imap
+from app.utils.email_utils import emails_awaiting_reply, read_new_replies
+
+logger = logging.getLogger(__name__)
+
+EXISTS_RE = re.compile(rb'^\* \d+ EXISTS')
+
+# How often a waiting listener checks whether it was asked to stop
+STOP_CHECK_SECONDS = 5
+
+# Socket timeout of listener sessions; IDLE waits don't read until data arrived
+SOCKET_TIMEOUT = 120
+
+
+class SocketReader:
+    """
+    Buffered reader over a socket that can tell whether data is waiting,
+    used as the IMAP session's file so IDLE can wait with select()
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def _recv(self):
+        data = self.sock.recv(65536)
+        self.buffer += data
+        return bool(data)
+
+    def has_data(self):
+        """Whether a read can return without waiting on the network"""
+        pending = getattr(self.sock, 'pending', None)
+        return bool(self.buffer) or bool(pending and pending())
+
+    def wait(self, timeout):
+        """
+        Wait until data can be read
+
+        Returns:
+            bool: True if data is available, False on timeout
+        """
+        if self.has_data():
+            return True
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def readline(self, limit=-1):
+        while b'\n' not in self.buffer and (limit < 0 or len(self.buffer) < limit):
+            if not self._recv():
+                break
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        if limit >= 0:
+            end = min(end, limit)
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            if not self._recv():
+                break
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        pass
+
+
+def idle(imap, seconds, stop_event):
+    """
+    Wait in IDLE until new mail arrives, `seconds` pass or `stop_event` is set
+
+    Args:
+        imap (IMAP4): Session with a folder selected, using a SocketReader
+        seconds (float): Longest time to stay in IDLE
+        stop_event (threading.Event): Set to end the wait early
+
+    Returns:
+        bool: True if the server announced new messages
+    """
+    tag = imap._new_tag()
+    imap.send(tag + b' IDLE\r\n')
+    line = imap.readline()
+    if not line.startswith(b'+'):
+        raise imaplib.IMAP4.error(f"IDLE refused: {line.decode(errors='replace').strip()}")
+
+    new_mail = False
+    deadline = time.monotonic() + seconds
+    while not new_mail and not stop_event.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not imap.file.wait(min(remaining, STOP_CHECK_SECONDS)):
+            continue
+        line = imap.readline()
+        if not line or line.startswith(b'* BYE'):
+            raise imaplib.IMAP4.abort(f"Server ended the IDLE session: {line.decode(errors='replace').strip()}")
+        if EXISTS_RE.match(line):
+            new_mail = True
+
+    imap.send(b'DONE\r\n')
+    while True:
+        line = imap.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed while leaving IDLE")
+        if line.startswith(tag):
+            if not line[len(tag):].strip().upper().startswith(b'OK'):
+                raise imaplib.IMAP4.error(f"IDLE failed: {line.decode(errors='replace').strip()}")
+            return new_mail
+        if EXISTS_RE.match(line):
+            new_mail = True
+
+
+def account_settings(account):
+    """The IMAP settings a listener session was opened with"""
+    return (account.imap_server, account.imap_port, account.imap_username, account.imap_password)
+
+
+class IdleListener:
+    """
+    Keeps one IDLE session open for an account and reads new mail as it arrives
+
+    Args:
+        account_id (int): ID of the email account
+        settings (tuple): IMAP settings, see account_settings()
+        idle_seconds (int): Longest time in one IDLE command
+    """
+
+    def __init__(self, account_id, settings, idle_seconds=1500):
+        self.account_id = account_id
+        self.settings = settings
+        self.idle_seconds = idle_seconds
+        # connecting, idling, unsupported or failed
+        self.state = 'connecting'
+        self.failures = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f'imap-idle-{self.account_id}')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._session()
+            except Exception as e:
+                self.failures += 1
+                self.state = 'failed'
+                logger.warning(f"IDLE session for account {self.account_id} failed: {str(e)}")
+
+            if self.state == 'unsupported':
+                return
+            # Back off while the server keeps failing; polling covers the account meanwhile
+            self._stop.wait(min(300, 5 * 2 ** min(self.failures, 6)))
+
+    def _session(self):
+        host, port, username, password = self.settings
+        circuit_breakers = get_circuit_breakers()
+        if not circuit_breakers.allow('imap', host):
+            return
+
+        try:
+            imap = connect_imap(host, port, timeout=SOCKET_TIMEOUT)
+            imap.login(username, password)
+        except Exception as e:
+            circuit_breakers.record('imap', host, e)
+            raise
+        circuit_breakers.record('imap', host)
+
+        try:
+            # Servers may only list IDLE once logged in
+            _, data = imap.capability()
+            capabilities = data[-1].decode(errors='replace').upper().split() if data and data[-1] else imap.capabilities
+            if 'IDLE' not in capabilities:
+                logger.info(f"IMAP server {host} doesn't support IDLE - account {self.account_id} stays on polling")
+                self.state = 'unsupported'
+                return
+
+            # Read through the session's own buffer so IDLE can wait on the socket
+            imap.file.close()
+            imap.file = SocketReader(imap.sock)
+
+            logger.info(f"Listening for new mail with IDLE for account {self.account_id}")
+            new_mail = True
+            while not self._stop.is_set():
+                if new_mail:
+                    with app.app_context():
+                        account = EmailAccount.query.get(self.account_id)
+                        if account is None:
+                            self.stop()
+                            return
+                        sent_emails = emails_awaiting_reply(account.id)
+                        if sent_emails:
+                            replies = read_new_replies(account, imap, sent_emails)
+                            if replies:
+                                logger.info(f"IDLE found {replies} new replies for account {account.email}")
+                        else:
+                            imap.select('INBOX', readonly=True)
+                    self.state = 'idling'
+                    self.failures = 0
+                new_mail = idle(imap, self.idle_seconds, self._stop)
+        finally:
+            if self.state == 'idling':
+                self.state = 'connecting'
+            try:
+                imap.logout()
+            except Exception:
+                pass
+
+
+class IdleManager:
+    """
+    Runs an IdleListener for every active IMAP-enabled account
+
+    Args:
+        idle_seconds (int): Longest time in one IDLE command
+    """
+
+    def __init__(self, idle_seconds=1500):
+        self.idle_seconds = idle_seconds
+        self._listeners = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Start listeners for new accounts and restart or stop those whose settings changed"""
+        with app.app_context():
+            accounts = EmailAccount.query.filter_by(is_active=True, imap_enabled=True).all()
+            wanted = {account.id: account_settings(account) for account in accounts if account.imap_server}
+
+        with self._lock:
+            for account_id, listener in list(self._listeners.items()):
+                if wanted.get(account_id) != listener.settings or (not listener.alive and listener.state != 'unsupported'):
+                    listener.stop()
+                    del self._listeners[account_id]
+
+            for account_id, settings in wanted.items():
+                if account_id not in self._listeners:
+                    listener = IdleListener(account_id, settings, self.idle_seconds)
+                    self._listeners[account_id] = listener
+                    listener.start()
+
+    def listening_account_ids(self):
+        """IDs of the accounts that currently have a working IDLE session"""
+        with self._lock:
+            return {account_id for account_id, listener in self._listeners.items() if listener.state == 'idling'}
+
+    def stop_all(self):
+        with self._lock:
+            for listener in self._listeners.values():
+                listener.stop()
+            self._listeners.clear()
+
+
+_idle_manager = None
+_idle_manager_lock = threading.Lock()
+
+
+def get_idle_manager():
+    """
+    Get the process-wide IDLE manager
+
+    Returns:
+        IdleManager: The shared manager
+    """
+    global _idle_manager
+    if _idle_manager is None:
+        with _idle_manager_lock:
+            if _idle_manager is None:
+                _idle_manager = IdleManager(idle_seconds=app.config['IMAP_IDLE_SECONDS'])
+    return _idle_manager
@@ -0,0 +1,225 @@
+"""
+IMAP session pooling for the Beakon Solutions platform.
+
+Keeps an authenticated IMAP session per email account open between reply
+checks, with the inbox already selected, so a check only costs a NOOP instead
+of a TLS handshake, LOGIN and SELECT. Many providers throttle repeated logins.
+"""
+
+import time
+import atexit
+import logging
+import threading
+
+from app.utils.net_utils import connect_imap
+from app.utils.imap_utils import select_folder
+
+logger = logging.getLogger(__name__)
+
+
+class PooledIMAPSession:
+    """An authenticated IMAP session owned by the pool"""
+
+    def __init__(self, account_id, imap, settings_key):
+        self.account_id = account_id
+        self.imap = imap
+        self.settings_key = settings_key
+        self.folder = None
+        self.uidvalidity = None
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.reused = False
+
+    def idle_seconds(self):
+        return time.monotonic() - self.last_used
+
+    def select(self, folder):
+        """Select a folder read-only, remembering its UIDVALIDITY for the life of the session"""
+        self.uidvalidity = select_folder(self.imap, folder, readonly=True)
+        self.folder = folder
+
+    def close(self):
+        """Log out, ignoring errors from an already dead connection"""
+        try:
+            self.imap.logout()
+        except Exception:
+            try:
+                self.imap.shutdown()
+            except Exception:
+                pass
+
+
+class IMAPSessionPool:
+    """
+    Pool of authenticated, selected IMAP sessions keyed by EmailAccount.id
+
+    At most one idle session is kept per account and at most `max_sessions`
+    in total; the least recently used one is closed to make room. A reused
+    session is probed with NOOP, which also makes the server report mail that
+    arrived since it was last used. Sessions idle longer than `idle_timeout`
+    are closed by `close_idle()`. With `max_sessions` 0 nothing is kept.
+    """
+
+    def __init__(self, max_sessions=50, idle_timeout=600, timeout=60):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _settings_key(account):
+        return (account.imap_server, account.imap_port, account.imap_username, account.imap_password)
+
+    def _connect(self, account, timeout=None):
+        """Open and authenticate a new IMAP session for an account"""
+        logger.info(f"Opening IMAP session to {account.imap_server}:{account.imap_port} for account {account.id}")
+        imap = connect_imap(account.imap_server, account.imap_port, timeout=timeout or self.timeout)
+        session = PooledIMAPSession(account.id, imap, self._settings_key(account))
+        try:
+            imap.login(account.imap_username, account.imap_password)
+        except Exception:
+            session.close()
+            raise
+        return session
+
+    def _is_alive(self, session):
+        """Probe a session with NOOP"""
+        try:
+            status, _ = session.imap.noop()
+            return status == 'OK'
+        except Exception:
+            return False
+
+    def acquire(self, account, folder='INBOX', timeout=None):
+        """
+        Check out a session for an account with `folder` selected read-only,
+        reusing an idle one when it is still healthy
+
+        Args:
+            account (EmailAccount): Account whose mailbox is read
+            folder (str): Folder to have selected
+            timeout (float): Socket timeout for a new connection
+
+        Returns:
+            PooledIMAPSession: An authenticated session
+        """
+        with self._lock:
+            session = self._idle.pop(account.id, None)
+
+        if session is not None:
+            if session.settings_key != self._settings_key(account):
+                logger.info(f"IMAP settings changed for account {account.id}, reconnecting")
+                session.close()
+            elif not self._is_alive(session):
+                logger.info(f"Pooled IMAP session for account {account.id} is stale, reconnecting")
+                session.close()
+            else:
+                session.reused = True
+                try:
+                    if session.folder != folder:
+                        session.select(folder)
+                    else:
+                        # A rebuilt mailbox is announced with a new UIDVALIDITY code
+                        _, data = session.imap.response('UIDVALIDITY')
+                        if data and data[0]:
+                            session.uidvalidity = int(data[0])
+                    # Don't let EXISTS/RECENT notices pile up over a long-lived session
+                    session.imap.untagged_responses.clear()
+                    return session
+                except Exception as e:
+                    logger.info(f"Could not select {folder} on the pooled IMAP session for account {account.id}: {str(e)}")
+                    session.close()
+
+        session = self._connect(account, timeout)
+        try:
+            session.select(folder)
+        except Exception:
+            session.close()
+            raise
+        return session
+
+    def release(self, session, reusable=True):
+        """
+        Return a session to the pool
+
+        Args:
+            session (PooledIMAPSession): Session obtained from acquire()
+            reusable (bool): False if the session is known to be broken
+        """
+        session.last_used = time.monotonic()
+        if not reusable or self.max_sessions <= 0:
+            session.close()
+            return
+
+        evicted = []
+        with self._lock:
+            if session.account_id in self._idle:
+                # Another session for this account is already pooled
+                evicted.append(session)
+            else:
+                self._idle[session.account_id] = session
+                while len(self._idle) > self.max_sessions:
+                    oldest = min(self._idle.values(), key=lambda pooled: pooled.last_used)
+                    evicted.append(self._idle.pop(oldest.account_id))
+
+        for evicted_session in evicted:
+            evicted_session.close()
+
+    def discard(self, account_id):
+        """Close the pooled session for an account, e.g. after its settings change"""
+        with self._lock:
+            session = self._idle.pop(account_id, None)
+        if session is not None:
+            session.close()
+
+    def close_idle(self):
+        """
+        Close sessions that have been idle longer than the idle timeout
+
+        Returns:
+            int: Number of sessions closed
+        """
+        with self._lock:
+            expired = [account_id for account_id, session in self._idle.items()
+                       if session.idle_seconds() > self.idle_timeout]
+            sessions = [self._idle.pop(account_id) for account_id in expired]
+
+        for session in sessions:
+            logger.debug(f"Closing idle IMAP session for account {session.account_id}")
+            session.close()
+        return len(sessions)
+
+    def close_all(self):
+        """Close every pooled session"""
+        with self._lock:
+            sessions = list(self._idle.values())
+            self._idle.clear()
+
+        for session in sessions:
+            session.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_imap_pool():
+    """
+    Get the process-wide IMAP session pool
+
+    Returns:
+        IMAPSessionPool: The shared pool
+    """
+    global _pool
+    if _pool is None:
+        from app import app
+        with _pool_lock:
+            if _pool is None:
+                _pool = IMAPSessionPool(
+                    max_sessions=app.config['IMAP_POOL_MAX_SESSIONS'] if app.config['IMAP_POOL_ENABLED'] else 0,
+                    idle_timeout=app.config['IMAP_POOL_IDLE_TIMEOUT'],
+                    timeout=app.config['REPLY_CHECK_TIMEOUT_SECONDS']
+                )
+                atexit.register(_pool.close_all)
+    return _pool
@@ -0,0 +1,613 @@
+"""
+IMAP helpers for reply checking on the Beakon Solutions platform.
+
+Reply checks read each folder incrementally: the folder's UIDVALIDITY and the
+highest UID already processed are stored per account, so a cycle only asks the
+server for UIDs above that watermark. When UIDVALIDITY changes (the folder was
+rebuilt and old UIDs mean nothing) the account is resynced over a bounded
+window of recent mail instead.
+
+New messages are read header first: only the few headers reply matching needs
+are fetched for every message, and the text part of a message is downloaded
+only once it has matched a sent email. Both are fetched in batches of UIDs, one
+UID FETCH command per batch, and header batches are handed on as they arrive
+so matching starts before the last one is downloaded. Everything is fetched
+with BODY.PEEK on a read-only selected folder, so inspecting a message never
+marks it as read.
+
+When few enough senders are awaited, the server is asked for only the new
+messages that can be replies: those from a recipient's domain, or referencing
+one of our Message-IDs. Everything else is never fetched.
+
+Memory stays bounded whatever the mailbox holds: a body is downloaded only up
+to a byte cap with a partial FETCH, attachments are never downloaded or
+decoded, and the extracted text is cut at a maximum length.
+"""
+
+import re
+import base64
+import quopri
+import imaplib
+import logging
+from datetime import datetime, timedelta
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+from email.feedparser import BytesFeedParser
+from email.utils import parseaddr
+
+from app import db
+from app.models.models import ImapSyncState
+
+logger = logging.getLogger(__name__)
+
+UIDVALIDITY_RE = re.compile(rb'UIDVALIDITY (\d+)')
+MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+FETCH_START_RE = re.compile(rb'^\d+ \(')
+LITERAL_RE = re.compile(rb'\{(\d+)\}')
+
+# Headers reply matching reads from each new message
+HEADER_FIELDS = 'FROM SUBJECT MESSAGE-ID IN-REPLY-TO REFERENCES DATE'
+
+# UIDs per FETCH command unless configured otherwise
+FETCH_BATCH_SIZE = 200
+
+# Most body bytes asked for in one FETCH command
+FETCH_BATCH_BYTES = 8 * 1024 * 1024
+
+# Appended to text cut at its maximum length
+TRUNCATED_MARK = '\n[...]'
+
+# Longest SEARCH criteria sent in one command; RFC 2683 advises clients to
+# keep command lines within 1000 octets
+SEARCH_MAX_LENGTH = 1000
+
+
+def select_folder(imap, folder='INBOX', readonly=False):
+    """
+    Select a folder and read its UIDVALIDITY
+
+    Args:
+        imap (IMAP4): Authenticated IMAP session
+        folder (str): Folder to select
+        readonly (bool): Open it with EXAMINE, so no flags can change
+
+    Returns:
+        int: The folder's UIDVALIDITY, or None if the server didn't report one
+    """
+    status, _ = imap.select(folder, readonly=readonly)
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"Could not select folder {folder}")
+
+    _, data = imap.response('UIDVALIDITY')
+    if data and data[0]:
+        return int(data[0])
+
+    # Some servers only report it on request
+    status, data = imap.status(folder, '(UIDVALIDITY)')
+    if status == 'OK' and data and data[0]:
+        match = UIDVALIDITY_RE.search(data[0])
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def get_sync_state(account_id, folder='INBOX'):
+    """
+    Get (or start) the sync position of an account's folder
+
+    Args:
+        account_id (int): ID of the email account
+        folder (str): IMAP folder name
+
+    Returns:
+        ImapSyncState: The state row, added to the session if new
+    """
+    state = ImapSyncState.query.filter_by(account_id=account_id, folder=folder).first()
+    if state is None:
+        state = ImapSyncState(account_id=account_id, folder=folder, last_uid=0)
+        db.session.add(state)
+    return state
+
+
+def uid_search(imap, criteria):
+    """
+    Run UID SEARCH
+
+    Returns:
+        list: Matching UIDs in ascending order
+    """
+    status, data = imap.uid('SEARCH', None, criteria)
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"UID SEARCH {criteria} failed")
+    return sorted(int(uid) for uid in (data[0] or b'').split())
+
+
+def find_new_uids(imap, state, uidvalidity, resync_days=30):
+    """
+    UIDs that arrived since the last processed one
+
+    A first sync, or one after UIDVALIDITY changed, only looks back
+    `resync_days` so the cost stays bounded on large mailboxes.
+
+    Args:
+        imap (IMAP4): Session with the state's folder selected
+        state (ImapSyncState): Sync position of the folder
+        uidvalidity (int): UIDVALIDITY reported by SELECT
+        resync_days (int): How far back a full resync looks
+
+    Returns:
+        list: New UIDs in ascending order
+    """
+    if state.uidvalidity is None or uidvalidity is None or state.uidvalidity != uidvalidity:
+        if state.uidvalidity is not None:
+            logger.info(f"UIDVALIDITY of {state.folder} changed for account {state.account_id} - resyncing last {resync_days} days")
+        since = (datetime.now() - timedelta(days=resync_days)).strftime("%d-%b-%Y")
+        state.uidvalidity = uidvalidity
+        state.last_uid = 0
+        return uid_search(imap, f'(SINCE {since})')
+
+    # "n:*" always matches the newest message, even when its UID is below n
+    return [uid for uid in uid_search(imap, f'(UID {state.last_uid + 1}:*)') if uid > state.last_uid]
+
+
+def _quoted(value):
+    """IMAP quoted string, or None when the value needs a literal"""
+    if not value.isascii() or any(char in value for char in '\r\n'):
+        return None
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _or_chain(terms):
+    """SEARCH key matching any of the terms"""
+    return 'OR ' * (len(terms) - 1) + ' '.join(terms)
+
+
+def plan_reply_searches(senders, thread_domains=(), max_senders=200, max_length=SEARCH_MAX_LENGTH):
+    """
+    SEARCH keys that together find every message that may be a reply
+
+    A message qualifies when its From header contains one of `senders`, or
+    its In-Reply-To or References header contains one of `thread_domains`.
+    The keys are OR-chains cut so that none is longer than `max_length`.
+
+    Args:
+        senders (iterable): Addresses or domains replies can come from
+        thread_domains (iterable): Domains of the Message-IDs we sent
+        max_senders (int): Most senders to search for; beyond that the
+            broad search is cheaper
+        max_length (int): Longest key
+
+    Returns:
+        list: SEARCH keys to run (empty when nothing can be a reply), or
+            None when every new message has to be read
+    """
+    senders = sorted(set(senders))
+    if len(senders) > max_senders:
+        return None
+
+    terms = []
+    for sender in senders:
+        quoted = _quoted(sender)
+        if quoted is None:
+            return None
+        terms.append(f'FROM {quoted}')
+    for domain in sorted(set(thread_domains)):
+        quoted = _quoted(f'@{domain}')
+        if quoted is None:
+            return None
+        terms.append(f'HEADER In-Reply-To {quoted}')
+        terms.append(f'HEADER References {quoted}')
+
+    searches = []
+    chunk, length = [], 0
+    for term in terms:
+        # Every further term costs "OR " and a separating space
+        if chunk and length + len(term) + 4 > max_length:
+            searches.append(_or_chain(chunk))
+            chunk, length = [], 0
+        chunk.append(term)
+        length += len(term) + (4 if len(chunk) > 1 else 0)
+    if chunk:
+        searches.append(_or_chain(chunk))
+    return searches
+
+
+def narrow_uids(imap, uids, searches):
+    """
+    The new UIDs matched by any of the planned SEARCH keys
+
+    Args:
+        imap (IMAP4): Session with the folder selected
+        uids (list): New UIDs in ascending order
+        searches (list): Keys from plan_reply_searches()
+
+    Returns:
+        list: UIDs worth fetching in ascending order
+    """
+    if not uids:
+        return []
+    new = set(uids)
+    found = set()
+    for search in searches:
+        found.update(uid for uid in uid_search(imap, f'(UID {uids[0]}:{uids[-1]} {search})') if uid in new)
+    return sorted(found)
+
+
+def advance_watermark(state, uid):
+    """Record that every UID up to `uid` has been processed"""
+    if uid > (state.last_uid or 0):
+        state.last_uid = uid
+
+
+def uid_set(uids):
+    """
+    Compact IMAP sequence set for a list of UIDs, e.g. [1, 2, 3, 7] -> "1:3,7"
+    """
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(start) if start == end else f'{start}:{end}' for start, end in ranges)
+
+
+def _parse_list(text, pos, literals):
+    """Parse IMAP list items from text[pos:] up to the closing parenthesis"""
+    items = []
+    while pos < len(text):
+        char = text[pos:pos + 1]
+        if char in (b' ', b'\r', b'\n'):
+            pos += 1
+        elif char == b'(':
+            item, pos = _parse_list(text, pos + 1, literals)
+            items.append(item)
+        elif char == b')':
+            return items, pos + 1
+        elif char == b'"':
+            value = bytearray()
+            pos += 1
+            while pos < len(text) and text[pos:pos + 1] != b'"':
+                if text[pos:pos + 1] == b'\\':
+                    pos += 1
+                value += text[pos:pos + 1]
+                pos += 1
+            items.append(bytes(value).decode('utf-8', errors='replace'))
+            pos += 1
+        elif char == b'{':
+            match = LITERAL_RE.match(text, pos)
+            items.append(next(literals, b''))
+            pos = match.end() if match else pos + 1
+        else:
+            # Atom; a section like BODY[HEADER.FIELDS (FROM)] is kept whole
+            start = pos
+            while pos < len(text) and text[pos:pos + 1] not in (b' ', b'(', b')'):
+                if text[pos:pos + 1] == b'[':
+                    end = text.find(b']', pos)
+                    pos = end if end != -1 else len(text) - 1
+                pos += 1
+            atom = text[start:pos].decode('utf-8', errors='replace')
+            items.append(None if atom.upper() == 'NIL' else atom)
+    return items, pos
+
+
+def parse_imap_list(text, literals=()):
+    """
+    Parse an IMAP parenthesized list into nested Python lists
+
+    Args:
+        text (bytes): Response text, with literals left as {n} markers
+        literals (iterable): The literal values, in order
+
+    Returns:
+        list: Items as str (atoms and quoted strings), bytes (literals),
+              None (NIL) or list (nested lists)
+    """
+    items, _ = _parse_list(text, 0, iter(literals))
+    return items
+
+
+def parse_fetch_response(data):
+    """
+    Split the data of a FETCH response into one dict per message
+
+    Args:
+        data (list): Data returned by imaplib for UID FETCH
+
+    Returns:
+        list: Dicts of data item name (upper case) to value
+    """
+    messages = []
+    text, literals = None, []
+
+    def finish():
+        if text is not None:
+            items = parse_imap_list(text[text.index(b'(') + 1:], literals)
+            messages.append({
+                str(items[i]).upper(): items[i + 1] for i in range(0, len(items) - 1, 2)
+            })
+
+    for part in data:
+        if part is None:
+            continue
+        head, literal = part if isinstance(part, tuple) else (part, None)
+        if FETCH_START_RE.match(head):
+            finish()
+            text, literals = b'', []
+        if text is None:
+            continue
+        text += head
+        if literal is not None:
+            literals.append(literal)
+    finish()
+    return messages
+
+
+def _decode_header_value(value):
+    """Header value with RFC 2047 encoded words decoded"""
+    if not value:
+        return ''
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return str(value)
+
+
+class MessageHeaders:
+    """What reply matching knows about a message before its body is downloaded"""
+
+    def __init__(self, uid, size, headers, structure=None):
+        self.uid = uid
+        self.size = size
+        # BODYSTRUCTURE, to find the text part without another round trip
+        self.structure = structure
+        self.sender = parseaddr(_decode_header_value(headers['From']))[1]
+        self.subject = _decode_header_value(headers['Subject']) or '(No subject)'
+        self.message_id = (headers['Message-ID'] or '').strip()
+        self.in_reply_to = (headers['In-Reply-To'] or '').strip()
+        self.references = (headers['References'] or '').strip()
+        self.date = headers['Date']
+
+    @property
+    def thread_ids(self):
+        """
+        Message-IDs this message answers: In-Reply-To first, then References
+        from the most recent back to the start of the thread
+        """
+        ids = MESSAGE_ID_RE.findall(self.in_reply_to) + MESSAGE_ID_RE.findall(self.references)[::-1]
+        return list(dict.fromkeys(ids))
+
+    def __repr__(self):
+        return f'<MessageHeaders uid={self.uid} from={self.sender} subject={self.subject!r}>'
+
+
+def batches(uids, size=FETCH_BATCH_SIZE):
+    """Split UIDs into consecutive chunks of at most `size`"""
+    size = max(1, size)
+    for start in range(0, len(uids), size):
+        yield uids[start:start + size]
+
+
+def iter_header_batches(imap, uids, batch_size=FETCH_BATCH_SIZE):
+    """
+    Fetch the matching headers, size and structure of messages, without their
+    bodies, one UID FETCH per batch
+
+    Each batch is yielded as soon as its response is parsed, so callers can
+    process it before the next one is requested.
+
+    Args:
+        imap (IMAP4): Session with the folder selected
+        uids (list): UIDs to fetch, ascending
+        batch_size (int): UIDs per FETCH command
+
+    Yields:
+        list: MessageHeaders of one batch in ascending UID order
+    """
+    parser = BytesHeaderParser()
+    for batch in batches(uids, batch_size):
+        status, data = imap.uid(
+            'FETCH', uid_set(batch),
+            f'(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])'
+        )
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"UID FETCH of headers {batch[0]}:{batch[-1]} failed")
+
+        messages = []
+        for item in parse_fetch_response(data):
+            header_bytes = next((value for key, value in item.items() if key.startswith('BODY[')), None)
+            if item.get('UID') is None or header_bytes is None:
+                continue
+            if isinstance(header_bytes, str):
+                header_bytes = header_bytes.encode('utf-8')
+            messages.append(MessageHeaders(
+                int(item['UID']), int(item.get('RFC822.SIZE') or 0),
+                parser.parsebytes(header_bytes), item.get('BODYSTRUCTURE')
+            ))
+        yield sorted(messages, key=lambda message: message.uid)
+
+
+def find_text_part(structure, section=''):
+    """
+    Find the first inline text/plain part of a BODYSTRUCTURE
+
+    Args:
+        structure (list): Parsed BODYSTRUCTURE
+        section (str): Section number of `structure` itself, '' for the message
+
+    Returns:
+        tuple: (section, transfer encoding, charset), or None without a text part
+    """
+    if structure and isinstance(structure[0], list):
+        # Multipart: the child parts come first, then the subtype and extensions
+        children = []
+        for item in structure:
+            if not isinstance(item, list):
+                break
+            children.append(item)
+        for number, child in enumerate(children, 1):
+            found = find_text_part(child, f'{section}.{number}' if section else str(number))
+            if found:
+                return found
+        return None
+
+    if len(structure) < 6 or str(structure[0]).lower() != 'text' or str(structure[1]).lower() != 'plain':
+        return None
+
+    # Extension data: md5, then the disposition
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and str(disposition[0]).lower() == 'attachment':
+        return None
+
+    params = structure[2] if isinstance(structure[2], list) else []
+    charset = next((str(params[i + 1]) for i in range(0, len(params) - 1, 2) if str(params[i]).lower() == 'charset'), None)
+    # A message that isn't multipart has its text as BODY[TEXT]
+    return section or 'TEXT', structure[5], charset
+
+
+def truncate_text(text, max_length):
+    """
+    Cut text to at most `max_length` characters, marking that it was cut
+
+    Text that already fits, including text cut before, is returned unchanged.
+    A `max_length` of 0 means no limit.
+    """
+    if not text or max_length <= 0 or len(text) <= max_length:
+        return text
+    return text[:max(0, max_length - len(TRUNCATED_MARK))] + TRUNCATED_MARK
+
+
+def decode_part(payload, encoding, charset, truncated=False):
+    """
+    Decode a body part downloaded in its transfer encoding
+
+    Args:
+        payload (bytes): Raw part content
+        encoding (str): Content-Transfer-Encoding from BODYSTRUCTURE
+        charset (str): Charset from BODYSTRUCTURE
+        truncated (bool): The payload is only the start of the part
+
+    Returns:
+        str: The text
+    """
+    encoding = (encoding or '7bit').lower()
+    try:
+        if encoding == 'base64':
+            if truncated:
+                # Drop the incomplete group of four at the cut
+                payload = b''.join(payload.split())
+                payload = payload[:len(payload) - len(payload) % 4]
+            payload = base64.b64decode(payload)
+        elif encoding == 'quoted-printable':
+            if truncated:
+                payload = re.sub(rb'=[0-9A-Fa-f]?$', b'', payload)
+            payload = quopri.decodestring(payload)
+    except Exception as e:
+        logger.warning(f"Failed to decode {encoding} part: {str(e)}")
+    try:
+        text = payload.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        text = payload.decode('utf-8', errors='replace')
+    # A character split by the cut can't be decoded
+    return text.rstrip('\ufffd') if truncated else text
+
+
+def extract_text(raw, truncated=False):
+    """
+    Text of the first inline text/plain part of a raw message, for messages
+    whose BODYSTRUCTURE isn't known
+
+    Attachments and other non-text parts are skipped without being decoded.
+
+    Args:
+        raw (bytes): The message, or its first bytes
+        truncated (bool): `raw` is only the start of the message
+
+    Returns:
+        str: The text, or "" without a plain text part
+    """
+    parser = BytesFeedParser()
+    parser.feed(raw)
+    message = parser.close()
+    for part in message.walk():
+        if part.is_multipart() or part.get_content_type() != 'text/plain':
+            continue
+        if part.get_content_disposition() == 'attachment':
+            continue
+        payload = part.get_payload()
+        if isinstance(payload, str):
+            payload = payload.encode('ascii', errors='surrogateescape')
+        return decode_part(payload, part.get('Content-Transfer-Encoding'), part.get_content_charset(), truncated)
+    return ''
+
+
+def _body_batches(messages, batch_size, max_bytes):
+    """Split messages so that no FETCH asks for more than FETCH_BATCH_BYTES"""
+    batch, batch_bytes = [], 0
+    for message in messages:
+        expected = min(message.size or max_bytes, max_bytes) if max_bytes > 0 else message.size
+        if batch and (len(batch) >= batch_size or batch_bytes + expected > FETCH_BATCH_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(message)
+        batch_bytes += expected
+    if batch:
+        yield batch
+
+
+def fetch_text_bodies(imap, messages, batch_size=FETCH_BATCH_SIZE, max_bytes=0, max_length=0):
+    """
+    Download only the plain text part of messages
+
+    Messages whose text sits in the same section are fetched together, in
+    batches of UIDs, so a handful of messages costs one or two round trips.
+    A message without a known BODYSTRUCTURE is fetched whole and parsed.
+
+    Args:
+        imap (IMAP4): Session with the folder selected
+        messages (list): MessageHeaders, fetched with their BODYSTRUCTURE
+        batch_size (int): UIDs per FETCH command
+        max_bytes (int): Bytes downloaded per message at most, 0 for no limit
+        max_length (int): Characters of text kept per message, 0 for no limit
+
+    Returns:
+        dict: UID to text; "" when a message has no plain text part
+    """
+    texts = {}
+    parts = {}
+    by_section = {}
+    for message in messages:
+        texts[message.uid] = ''
+        if not message.structure:
+            # Parsed from the raw message, the "" section
+            parts[message.uid] = None
+            by_section.setdefault('', []).append(message)
+            continue
+        part = find_text_part(message.structure)
+        if part is not None:
+            parts[message.uid] = part
+            by_section.setdefault(part[0], []).append(message)
+
+    partial = f'<0.{max_bytes}>' if max_bytes > 0 else ''
+    for section, section_messages in by_section.items():
+        section_messages.sort(key=lambda message: message.uid)
+        for batch in _body_batches(section_messages, batch_size, max_bytes):
+            batch = [message.uid for message in batch]
+            status, data = imap.uid('FETCH', uid_set(batch), f'(BODY.PEEK[{section}]{partial})')
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"UID FETCH of BODY[{section}] {batch[0]}:{batch[-1]} failed")
+            for item in parse_fetch_response(data):
+                uid = int(item['UID']) if item.get('UID') is not None else None
+                payload = next((value for key, value in item.items() if key.startswith('BODY[')), None)
+                if uid not in parts or not payload:
+                    continue
+                if isinstance(payload, str):
+                    payload = payload.encode('utf-8')
+                truncated = 0 < max_bytes <= len(payload)
+                if parts[uid] is None:
+                    text = extract_text(payload, truncated)
+                else:
+                    _, encoding, charset = parts[uid]
+                    text = decode_part(payload, encoding, charset, truncated)
+                texts[uid] = truncate_text(text, max_length)
+    return texts
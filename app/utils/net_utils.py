@@ -0,0 +1,242 @@
+"""
+Shared networking for the Beakon Solutions platform's SMTP and IMAP connections.
+
+Holds one TLS context per process instead of loading the CA bundle for every
+connection, caches DNS lookups of account hosts for a short time, and keeps the
+last TLS session per host so reconnects can resume it instead of doing a full
+handshake.
+"""
+
+import ssl
+import time
+import socket
+import imaplib
+import logging
+import smtplib
+import threading
+
+logger = logging.getLogger(__name__)
+
+_context = None
+_context_lock = threading.Lock()
+
+
+def get_ssl_context():
+    """
+    Get the process-wide client TLS context
+
+    Returns:
+        ssl.SSLContext: Context with the default CA bundle loaded
+    """
+    global _context
+    if _context is None:
+        with _context_lock:
+            if _context is None:
+                _context = ssl.create_default_context()
+    return _context
+
+
+class DNSCache:
+    """
+    getaddrinfo() results per (host, port), kept for `ttl` seconds.
+    A ttl of 0 or less disables caching.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """
+        Look up the addresses of a host
+
+        Args:
+            host (str): Host name
+            port (int): Port to connect to
+
+        Returns:
+            list: getaddrinfo() tuples for TCP connections
+        """
+        key = (host, port)
+        if self.ttl > 0:
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[key] = (time.monotonic() + self.ttl, addresses)
+        return addresses
+
+    def invalidate(self, host, port):
+        """Forget a host's addresses, e.g. after none of them could be reached"""
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+class TLSSessionCache:
+    """The most recent TLS session per (host, port), for resumption on reconnect"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, port):
+        with self._lock:
+            return self._sessions.get((host, port))
+
+    def remember(self, host, port, sock):
+        """Keep the session of an established connection"""
+        session = getattr(sock, 'session', None)
+        if session is not None:
+            with self._lock:
+                self._sessions[(host, port)] = session
+
+    def forget(self, host, port):
+        with self._lock:
+            self._sessions.pop((host, port), None)
+
+
+_dns_cache = None
+_dns_cache_lock = threading.Lock()
+_tls_sessions = TLSSessionCache()
+
+
+def get_dns_cache():
+    """
+    Get the process-wide DNS cache
+
+    Returns:
+        DNSCache: The shared cache
+    """
+    global _dns_cache
+    if _dns_cache is None:
+        from app import app
+        with _dns_cache_lock:
+            if _dns_cache is None:
+                _dns_cache = DNSCache(ttl=app.config['NET_DNS_CACHE_TTL'])
+    return _dns_cache
+
+
+def create_connection(host, port, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """
+    Open a TCP connection like socket.create_connection(), using cached DNS results
+
+    Args:
+        host (str): Host name
+        port (int): Port
+        timeout (float): Socket timeout
+        source_address (tuple): Local (host, port) to bind to
+
+    Returns:
+        socket.socket: Connected socket
+    """
+    dns_cache = get_dns_cache()
+    error = None
+    for family, socktype, proto, _, sockaddr in dns_cache.resolve(host, port):
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            error = e
+            if sock is not None:
+                sock.close()
+
+    # The host may have moved - look it up again next time
+    dns_cache.invalidate(host, port)
+    raise error or OSError(f"No addresses found for {host}")
+
+
+def wrap_tls(sock, host, port):
+    """
+    Start TLS on a connected socket, resuming the host's last session when possible
+
+    Args:
+        sock (socket.socket): Connected socket
+        host (str): Host name to verify the certificate against
+        port (int): Port, part of the session cache key
+
+    Returns:
+        ssl.SSLSocket: The TLS socket
+    """
+    session = _tls_sessions.get(host, port)
+    try:
+        return get_ssl_context().wrap_socket(sock, server_hostname=host, session=session)
+    except ssl.SSLError:
+        # Don't offer a session the server choked on again
+        if session is not None:
+            _tls_sessions.forget(host, port)
+        raise
+
+
+class _SMTP_SSL(smtplib.SMTP_SSL):
+    """smtplib.SMTP_SSL on the shared context, DNS cache and TLS session cache"""
+
+    def __init__(self, host='', port=0, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        super().__init__(host, port, timeout=timeout, context=get_ssl_context())
+
+    def _get_socket(self, host, port, timeout):
+        sock = create_connection(host, port, timeout, self.source_address)
+        self._tls_port = port
+        return wrap_tls(sock, self._host, port)
+
+    def login(self, user, password, **kwargs):
+        result = super().login(user, password, **kwargs)
+        # Session tickets have arrived by the time the server answered AUTH
+        _tls_sessions.remember(self._host, self._tls_port, self.sock)
+        return result
+
+
+class _IMAP4_SSL(imaplib.IMAP4_SSL):
+    """imaplib.IMAP4_SSL on the shared context, DNS cache and TLS session cache"""
+
+    def __init__(self, host='', port=imaplib.IMAP4_SSL_PORT, timeout=None):
+        super().__init__(host, port, ssl_context=get_ssl_context(), timeout=timeout)
+
+    def _create_socket(self, timeout):
+        sock = create_connection(self.host, self.port, timeout if timeout is not None else socket._GLOBAL_DEFAULT_TIMEOUT)
+        return wrap_tls(sock, self.host, self.port)
+
+    def login(self, user, password):
+        result = super().login(user, password)
+        _tls_sessions.remember(self.host, self.port, self.sock)
+        return result
+
+
+def connect_smtp(host, port, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    """
+    Open an implicit-TLS SMTP connection
+
+    Args:
+        host (str): SMTP server
+        port (int): SMTP port
+        timeout (float): Socket timeout
+
+    Returns:
+        smtplib.SMTP_SSL: Connected, not yet authenticated session
+    """
+    return _SMTP_SSL(host, port, timeout=timeout)
+
+
+def connect_imap(host, port, timeout=None):
+    """
+    Open an IMAP over TLS connection
+
+    Args:
+        host (str): IMAP server
+        port (int): IMAP port
+        timeout (float): Socket timeout
+
+    Returns:
+        imaplib.IMAP4_SSL: Connected, not yet authenticated session
+    """
+    return _IMAP4_SSL(host, port, timeout=timeout)
@@ -0,0 +1,192 @@
+"""
+Send rate limiting for the Beakon Solutions platform.
+
+Every send takes a token from its account's bucket and from its SMTP host's
+bucket, so each lane waits only as long as its own provider requires. Buckets
+slow down when a server answers 421/451 and recover gradually on success.
+"""
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# SMTP reply codes that mean "slow down" rather than "this message is bad"
+THROTTLE_CODES = (421, 451)
+
+# Default (rate per second, burst) by provider, matched against the SMTP host name
+PROVIDER_RATE_LIMITS = {
+    'hostinger': {'account': (0.5, 3), 'host': (2.0, 10)},
+    'gmail': {'account': (1.0, 5), 'host': (5.0, 20)},
+}
+DEFAULT_RATE_LIMITS = {'account': (0.5, 1), 'host': (5.0, 10)}
+
+# Adaptive slowdown: halve the rate on throttling, never below 1/16th of the
+# configured rate, and win back 5% of the configured rate per successful send
+SLOWDOWN_FACTOR = 0.5
+MIN_RATE_FRACTION = 1 / 16
+RECOVERY_FRACTION = 0.05
+
+
+class TokenBucket:
+    """
+    Token bucket allowing `burst` sends at once and `rate` sends per second after that.
+    A rate of 0 or less disables the bucket.
+    """
+
+    def __init__(self, rate, burst):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """
+        Take a token, going into debt if none is left
+
+        Returns:
+            float: Seconds to wait before sending
+        """
+        if self.base_rate <= 0:
+            return 0.0
+
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def give_back(self):
+        """Return a reserved token that wasn't used for a send"""
+        if self.base_rate <= 0:
+            return
+
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    def slow_down(self):
+        """Lower the rate after the server asked us to back off"""
+        if self.base_rate <= 0:
+            return
+
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.base_rate * MIN_RATE_FRACTION, self.rate * SLOWDOWN_FACTOR)
+            # Don't let saved-up tokens undo the slowdown
+            self.tokens = min(self.tokens, 0.0)
+
+    def recover(self):
+        """Raise a lowered rate back towards the configured one"""
+        if self.rate >= self.base_rate:
+            return
+
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = min(self.base_rate, self.rate + self.base_rate * RECOVERY_FRACTION)
+
+
+class SendRateLimiter:
+    """Token buckets per email account and per SMTP host"""
+
+    def __init__(self, account_limit=None, host_limit=None):
+        self.account_limit = account_limit
+        self.host_limit = host_limit
+        self._accounts = {}
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _limits_for(self, host, scope):
+        """(rate, burst) for a host, from config overrides or provider defaults"""
+        override = self.account_limit if scope == 'account' else self.host_limit
+        if override is not None:
+            return override
+
+        for provider, limits in PROVIDER_RATE_LIMITS.items():
+            if provider in host:
+                return limits[scope]
+        return DEFAULT_RATE_LIMITS[scope]
+
+    def _buckets(self, account):
+        host = (account.smtp_server or '').lower()
+        # Key account buckets by host too, so changing an account's server picks up new limits
+        account_key = (account.id, host)
+        with self._lock:
+            if account_key not in self._accounts:
+                self._accounts[account_key] = TokenBucket(*self._limits_for(host, 'account'))
+            if host not in self._hosts:
+                self._hosts[host] = TokenBucket(*self._limits_for(host, 'host'))
+            return self._accounts[account_key], self._hosts[host]
+
+    def reserve(self, account):
+        """
+        Take a send token for an account and its SMTP host
+
+        Args:
+            account (EmailAccount): Account about to send
+
+        Returns:
+            float: Seconds to wait before sending
+        """
+        account_bucket, host_bucket = self._buckets(account)
+        return max(account_bucket.reserve(), host_bucket.reserve())
+
+    def give_back(self, account):
+        """
+        Return the tokens of a reserve() that didn't lead to a send, e.g. a lane
+        stopping at its deadline, so the account and host don't lose the capacity
+
+        Args:
+            account (EmailAccount): Account that reserved the tokens
+        """
+        account_bucket, host_bucket = self._buckets(account)
+        account_bucket.give_back()
+        host_bucket.give_back()
+
+    def record_throttle(self, account, code):
+        """
+        Slow down an account and its host after a 421/451 reply
+
+        Args:
+            account (EmailAccount): Account that was throttled
+            code (int): SMTP reply code
+        """
+        logger.warning(f"SMTP server {account.smtp_server} replied {code} for account {account.id} - slowing down")
+        for bucket in self._buckets(account):
+            bucket.slow_down()
+
+    def record_success(self, account):
+        """Let a slowed-down account and host speed back up"""
+        for bucket in self._buckets(account):
+            bucket.recover()
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """
+    Get the process-wide send rate limiter
+
+    Returns:
+        SendRateLimiter: The shared limiter
+    """
+    global _limiter
+    if _limiter is None:
+        from app import app
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = SendRateLimiter(
+                    account_limit=app.config['SEND_ACCOUNT_RATE_LIMIT'],
+                    host_limit=app.config['SEND_HOST_RATE_LIMIT']
+                )
+    return _limiter
@@ -0,0 +1,128 @@
+"""
+Sender/subject reply matching for the Beakon Solutions platform.
+
+Replies that don't reference one of our Message-IDs are matched by who sent
+them and what their subject says. SentEmailIndex prepares an account's emails
+awaiting a reply once per check: subjects are cleaned up front, and emails are
+looked up by recipient address, recipient domain and subject word, so each
+incoming message is only compared with the few emails it could answer.
+"""
+
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+REPLY_PREFIX_RE = re.compile(r'^(re|fwd|fw):\s*')
+WORD_RE = re.compile(r'\b\w+\b')
+
+
+def clean_subject(subject):
+    """Lower-case a subject and drop one leading Re:/Fwd:/Fw:"""
+    return REPLY_PREFIX_RE.sub('', subject.lower())
+
+
+def _domain(address):
+    try:
+        return address.split('@')[1]
+    except IndexError:
+        return None
+
+
+class SentEmailIndex:
+    """
+    Emails awaiting a reply, indexed for sender and subject matching.
+
+    Positions follow the order of the list the index was built from, and
+    match() returns the earliest matching email just like a scan of that list.
+    """
+
+    def __init__(self, sent_emails):
+        """
+        Args:
+            sent_emails (list): Emails awaiting a reply, with recipients loaded
+        """
+        self.emails = list(sent_emails)
+        self.subjects = []
+        self.by_address = {}
+        self.by_domain = {}
+        self.by_word = {}
+        # Subjects without any words can only be matched by comparing them
+        self.wordless = set()
+        self.live = set(range(len(self.emails)))
+        self.positions = {id(email): position for position, email in enumerate(self.emails)}
+
+        for position, email in enumerate(self.emails):
+            address = email.recipient.email.lower()
+            subject = clean_subject(email.subject)
+            self.subjects.append(subject)
+
+            self.by_address.setdefault(address, set()).add(position)
+            domain = _domain(address)
+            if domain is not None:
+                self.by_domain.setdefault(domain, set()).add(position)
+
+            words = set(WORD_RE.findall(subject))
+            if not words:
+                self.wordless.add(position)
+            for word in words:
+                self.by_word.setdefault(word, set()).add(position)
+
+    def discard(self, email):
+        """Stop matching an email, e.g. once its reply was recorded"""
+        position = self.positions.get(id(email))
+        if position is not None:
+            self.live.discard(position)
+
+    def _with_words(self, words):
+        positions = set(self.wordless)
+        for word in words:
+            positions |= self.by_word.get(word, set())
+        return positions
+
+    def match(self, sender_email, subject, is_hostinger=False):
+        """
+        Find the email an incoming message answers, by sender and subject
+
+        A message counts as a reply when it comes from the recipient's address
+        or domain and either its subject says "Re:" or the subjects (without
+        reply prefixes) contain one another. For Hostinger accounts a message
+        from the exact address also matches when the subjects share a word of
+        four or more letters.
+
+        Args:
+            sender_email (str): Address the message came from
+            subject (str): Subject of the message
+
+        Returns:
+            Email: The matching email, or None
+        """
+        sender_email = sender_email.lower()
+        current_subject = subject.lower()
+        cleaned_current = REPLY_PREFIX_RE.sub('', current_subject)
+
+        exact = self.by_address.get(sender_email, set()) & self.live
+        domain = _domain(sender_email)
+        candidates = exact | (self.by_domain.get(domain, set()) & self.live if domain is not None else set())
+        if not candidates:
+            return None
+
+        if "re:" in current_subject:
+            return self.emails[min(candidates)]
+
+        # Subjects containing one another share a word, unless one has none
+        words = set(WORD_RE.findall(cleaned_current))
+        possible = candidates & self._with_words(words) if words else candidates
+        matches = [
+            position for position in possible
+            if cleaned_current in self.subjects[position] or self.subjects[position] in cleaned_current
+        ]
+
+        if is_hostinger:
+            long_words = {word for word in words if len(word) > 3}
+            overlapping = exact & self._with_words(long_words) - self.wordless
+            if overlapping and (not matches or min(overlapping) < min(matches)):
+                logger.info("Hostinger special match: sender matches and found word overlap in subjects")
+                return self.emails[min(overlapping)]
+
+        return self.emails[min(matches)] if matches else None
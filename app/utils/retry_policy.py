@@ -0,0 +1,142 @@
+"""
+Send retry policy for the Beakon Solutions platform.
+
+Failed sends are classified by SMTP reply code and exception type. Transient
+failures are rescheduled with exponential backoff and jitter, permanent ones
+fail at once, and authentication failures suspend the account's sending so the
+rest of its queue isn't tried against the same bad credentials.
+"""
+
+import socket
+import random
+import smtplib
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+AUTH = 'auth'
+
+# Reply codes that mean the credentials were rejected
+AUTH_CODES = (530, 534, 535)
+
+
+def _reply_code(error):
+    """The SMTP reply code carried by an exception, if any"""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and error.recipients:
+        # Retrying can only help if every refusal was temporary
+        codes = [code for code, _ in error.recipients.values()]
+        return max(codes)
+    if aiosmtplib is not None:
+        if isinstance(error, aiosmtplib.SMTPRecipientsRefused) and error.recipients:
+            return max(recipient.code for recipient in error.recipients)
+        if isinstance(error, aiosmtplib.SMTPResponseException):
+            return error.code
+    return None
+
+
+def classify_send_error(error):
+    """
+    Decide whether a failed send is worth retrying
+
+    Args:
+        error (Exception): The exception raised while sending
+
+    Returns:
+        str: TRANSIENT, PERMANENT or AUTH
+    """
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return AUTH
+    if aiosmtplib is not None and isinstance(error, aiosmtplib.SMTPAuthenticationError):
+        return AUTH
+
+    code = _reply_code(error)
+    if code is not None:
+        if code in AUTH_CODES:
+            return AUTH
+        if 400 <= code < 500:
+            return TRANSIENT
+        if code >= 500:
+            return PERMANENT
+
+    # No reply code - connection level problems (DNS, refused, timeouts, dropped sessions)
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, socket.gaierror,
+                          socket.timeout, ConnectionError, TimeoutError)):
+        return TRANSIENT
+    if aiosmtplib is not None and isinstance(error, (aiosmtplib.SMTPServerDisconnected,
+                                                     aiosmtplib.SMTPConnectError, aiosmtplib.SMTPTimeoutError)):
+        return TRANSIENT
+    if isinstance(error, OSError):
+        return TRANSIENT
+
+    # Anything else (e.g. a message that can't be encoded) will fail the same way again
+    return PERMANENT
+
+
+def retry_delay(attempt, base_seconds, max_seconds):
+    """
+    Backoff before the next attempt: exponential in the attempt number with +/-50% jitter
+
+    Args:
+        attempt (int): Number of attempts made so far (1 after the first failure)
+        base_seconds (int): Delay after the first failure
+        max_seconds (int): Upper bound on the delay before jitter
+
+    Returns:
+        timedelta: How long to wait
+    """
+    delay = min(max_seconds, base_seconds * (2 ** (attempt - 1)))
+    return timedelta(seconds=delay * random.uniform(0.5, 1.5))
+
+
+class AccountSuspensions:
+    """Accounts whose sending is paused after an authentication failure"""
+
+    def __init__(self):
+        self._until = {}
+        self._lock = threading.Lock()
+
+    def suspend(self, account_id, seconds):
+        with self._lock:
+            self._until[account_id] = time.monotonic() + seconds
+        logger.warning(f"Sending suspended for account {account_id} for {seconds}s after an authentication failure")
+
+    def resume(self, account_id):
+        """Lift a suspension, e.g. after the account's credentials were edited"""
+        with self._lock:
+            self._until.pop(account_id, None)
+
+    def is_suspended(self, account_id):
+        with self._lock:
+            until = self._until.get(account_id)
+            if until is None:
+                return False
+            if time.monotonic() >= until:
+                del self._until[account_id]
+                return False
+            return True
+
+    def resumes_at(self, account_id):
+        """
+        Returns:
+            datetime: When a suspended account may send again, or None
+        """
+        with self._lock:
+            until = self._until.get(account_id)
+        if until is None:
+            return None
+        return datetime.now() + timedelta(seconds=max(0.0, until - time.monotonic()))
+
+
+account_suspensions = AccountSuspensions()
@@ -4,16 +4,32 @@ Scheduler utilities for the Beakon Solutions platform.
 
 import os
 import time
+import uuid
+import socket
 import logging
 import threading
-from datetime import datetime, timedelta
-from sqlalchemy import text
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from datetime import datetime, date, timedelta
+from sqlalchemy import text, select, update
+from sqlalchemy.orm import joinedload
 from app import app, db
-from app.models.models import Email, EmailTemplate, EmailAccount, Recipient, EmailStatus, Campaign
-from app.utils.email_utils import send_email, check_for_replies
+from app.models.models import Email, EmailTemplate, EmailAccount, Recipient, EmailStatus, Campaign, AccountDailyUsage, EmailSpool
+from app.utils.email_utils import deliver_email, save_send_status, render_message, message_fingerprint, check_for_replies
+from app.utils.status_buffer import get_status_buffer
+from app.utils.rate_limiter import get_rate_limiter
+from app.utils.dispatcher import start_dispatcher
+from app.utils.retry_policy import account_suspensions
+from app.utils.circuit_breaker import get_circuit_breakers
+from app.utils.transports import get_transport
+from app.utils.smtp_pool import get_smtp_pool
+from app.utils.imap_pool import get_imap_pool
+from app.utils.imap_idle import get_idle_manager
 
 logger = logging.getLogger(__name__)
 
+# Seconds before a lease expires after which a lane stops starting new sends
+SEND_LEASE_SAFETY_MARGIN = 30
+
 def get_local_time():
     """
     Get the current time in the system's local timezone
@@ -31,43 +47,67 @@ def initialize_scheduler():
     """
     logger.info("Initializing email scheduler")
     
-    def process_emails_thread():
-        """Background process to check and send emails"""
-        while True:
-            try:
-                process_email_queue()
-            except Exception as e:
-                logger.error(f"Error in email processing: {str(e)}")
-            
-            # Sleep for 30 seconds before checking again
-            time.sleep(30)
-    
     def check_replies_thread():
         """Background process to check for email replies"""
         while True:
             try:
-                check_all_replies()
+                # Accounts with a working IDLE session already see new mail as it arrives
+                idle_account_ids = set()
+                if app.config['IMAP_IDLE_ENABLED']:
+                    idle_manager = get_idle_manager()
+                    idle_manager.refresh()
+                    idle_account_ids = idle_manager.listening_account_ids()
+                check_all_replies(exclude_account_ids=idle_account_ids)
             except Exception as e:
                 logger.error(f"Error checking replies: {str(e)}")
             
             # Check replies every 2 minutes
             time.sleep(120)
     
-    # Start email processing thread
-    email_thread = threading.Thread(target=process_emails_thread)
-    email_thread.daemon = True
-    email_thread.start()
+    # Start the dispatcher that sends emails as they become due
+    start_dispatcher(process_email_queue)
     
     # Start reply checking thread
     reply_thread = threading.Thread(target=check_replies_thread)
     reply_thread.daemon = True
     reply_thread.start()
     
-    logger.info("Email scheduler initialized - emails checked every 30s, replies every 2min")
+    logger.info(f"Email scheduler initialized - emails sent when due (reconciled every {app.config['SEND_DISPATCH_RECONCILE_SECONDS']}s), replies every 2min"
+                f"{' and through IMAP IDLE' if app.config['IMAP_IDLE_ENABLED'] else ''}")
+
+# Accounts whose reply check is still running, possibly past its timeout
+_reply_checks_running = set()
+_reply_checks_lock = threading.Lock()
+
+def check_account_replies(account_id, timeout=None):
+    """
+    Check one account for replies, for check_all_replies' worker pool.
+    check_for_replies runs in its own app context, so each worker has its own database session.
+    
+    Args:
+        account_id (int): ID of the email account
+        timeout (float): Socket timeout for the IMAP session
+        
+    Returns:
+        int: Number of new replies found
+    """
+    try:
+        return check_for_replies(account_id, raise_errors=True, timeout=timeout)
+    finally:
+        with _reply_checks_lock:
+            _reply_checks_running.discard(account_id)
 
-def check_all_replies():
+def check_all_replies(exclude_account_ids=None):
     """
-    Check all accounts for email replies
+    Check all accounts for email replies.
+    Accounts are checked concurrently by up to REPLY_CHECK_MAX_WORKERS workers;
+    a check still running after REPLY_CHECK_TIMEOUT_SECONDS is reported as timed out.
+    
+    Args:
+        exclude_account_ids (set): Accounts not to poll, e.g. those with an IDLE listener
+        
+    Returns:
+        int: Number of new replies found
     """
     try:
         with app.app_context():
@@ -78,90 +118,326 @@ def check_all_replies():
                 logger.info("No active email accounts found to check for replies")
                 return 0
                 
-            logger.info(f"Checking {len(accounts)} accounts for email replies")
-            
-            total_replies = 0
+            circuit_breakers = get_circuit_breakers()
+            results = {}
+            to_check = []
             for account in accounts:
-                try:
-                    logger.info(f"Checking replies for account: {account.email}")
-                    replies = check_for_replies(account.id)
-                    total_replies += replies
-                    if replies > 0:
-                        logger.info(f"Found {replies} new replies for account {account.email}")
-                except Exception as e:
-                    logger.error(f"Error checking replies for account {account.id}: {str(e)}")
+                if exclude_account_ids and account.id in exclude_account_ids:
                     continue
+                if account.imap_server and circuit_breakers.is_skipped('imap', account.imap_server):
+                    logger.info(f"Skipping replies for account {account.email} - IMAP host {account.imap_server} is unreachable")
+                    results[account.id] = (account.email, 'skipped', 0, 0.0)
+                    continue
+                to_check.append((account.id, account.email))
                 
-            if total_replies > 0:
-                logger.info(f"Found and processed {total_replies} total replies across all accounts")
-            else:
-                logger.debug("No replies found during check")
+        timeout = app.config['REPLY_CHECK_TIMEOUT_SECONDS']
+        max_workers = max(1, min(app.config['REPLY_CHECK_MAX_WORKERS'], len(to_check) or 1))
+        logger.info(f"Checking {len(to_check)} accounts for email replies with {max_workers} workers")
+        
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='reply-check')
+        started = {}
+        futures = {}
+        
+        def run(account_id):
+            started[account_id] = time.monotonic()
+            return check_account_replies(account_id, timeout=timeout)
+            
+        for account_id, account_email in to_check:
+            with _reply_checks_lock:
+                if account_id in _reply_checks_running:
+                    # The previous cycle's check of this account hasn't finished
+                    results[account_id] = (account_email, 'still running', 0, 0.0)
+                    continue
+                _reply_checks_running.add(account_id)
+            futures[executor.submit(run, account_id)] = (account_id, account_email)
+            
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                now = time.monotonic()
+                for future in done:
+                    account_id, account_email = futures[future]
+                    duration = now - started.get(account_id, now)
+                    try:
+                        results[account_id] = (account_email, 'ok', future.result(), duration)
+                    except Exception as e:
+                        results[account_id] = (account_email, f'error: {str(e)}', 0, duration)
+                        
+                # Stop waiting for checks that ran past their timeout; their threads finish on their own
+                for future in list(pending):
+                    account_id, account_email = futures[future]
+                    if account_id in started and now - started[account_id] > timeout:
+                        pending.discard(future)
+                        results[account_id] = (account_email, 'timeout', 0, now - started[account_id])
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            with _reply_checks_lock:
+                for future, (account_id, _) in futures.items():
+                    if future.cancelled():
+                        _reply_checks_running.discard(account_id)
             
-            return total_replies
+        total_replies = 0
+        for account_id, (account_email, outcome, replies, duration) in results.items():
+            total_replies += replies
+            log = logger.info if outcome in ('ok', 'skipped') else logger.warning
+            log(f"Reply check for account {account_email}: {outcome}, {replies} replies in {duration:.1f}s")
+            
+        if total_replies > 0:
+            logger.info(f"Found and processed {total_replies} total replies across all accounts")
+        else:
+            logger.debug("No replies found during check")
+            
+        return total_replies
         
     except Exception as e:
         logger.error(f"Error checking all replies: {str(e)}")
         return 0
+    finally:
+        release_imap_sessions()
 
-def process_email(email):
+def process_email(email, reserved_on=None, status_buffer=None):
     """
     Process a single email for sending
     
     Args:
-        email (Email): The email to process
+        email (Email): The email to process, with recipient and account loaded
+        reserved_on (date): Day daily-limit capacity was reserved for this send
+        status_buffer (StatusWriteBuffer): Buffer for the final status, if writes are grouped
         
     Returns:
         bool: True if the email was sent successfully, False otherwise
     """
     try:
-        # Ensure email is properly personalized
-        ensure_personalization(email.id)
+        # Ensure email is properly personalized (saved with the status update)
+        ensure_personalization(email)
         
-        # Attempt to send the email
-        success = send_email(email.id)
+        # Attempt to send the email - a successful send saves its own status
+        success, message = deliver_email(email, reserved_on=reserved_on, status_buffer=status_buffer)
         
         if success:
-            # Update email status
-            email.status = EmailStatus.SENT
-            email.sent_at = datetime.now()
-            db.session.commit()
             logger.info(f"Email {email.id} sent successfully")
             return True
+        elif email.status == EmailStatus.SENDING:
+            # Mark as failed unless deliver_email already moved it elsewhere (e.g. rescheduled)
+            save_send_status(email, EmailStatus.FAILED, error=message, status_buffer=status_buffer)
+            logger.warning(f"Failed to send email {email.id}: {message}")
+            return False
         else:
-            # Mark as failed
-            email.status = EmailStatus.FAILED
-            db.session.commit()
-            logger.warning(f"Failed to send email {email.id}")
+            logger.warning(f"Email {email.id} not sent: {message}")
             return False
             
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error processing email {email.id}: {str(e)}")
         return False
 
+def new_worker_id():
+    """
+    Build a unique identifier for one queue run, used to mark the emails it claims
+    
+    Returns:
+        str: Worker identifier of the form host:pid:random
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def reclaim_expired_leases():
+    """
+    Return emails whose send lease has expired to the pending queue.
+    Covers queue runners that crashed or were killed while holding claims.
+    
+    The daily-limit capacity the expired claims still hold is given back in the
+    same transaction, counted from the rows this call actually changed, on the
+    day it was reserved. Rows another runner reclaims first, or that their lane
+    already settled, are not counted again.
+    
+    Returns:
+        int: Number of emails reclaimed
+    """
+    now = datetime.now()
+    expired = db.session.execute(
+        select(Email.claimed_by, Email.account_id, Email.reserved_on)
+        .where(Email.status == EmailStatus.SENDING, Email.lease_expires_at < now)
+        .group_by(Email.claimed_by, Email.account_id, Email.reserved_on)
+    ).all()
+    
+    if not expired:
+        return 0
+        
+    reclaimed = 0
+    for claimed_by, account_id, reserved_on in expired:
+        result = db.session.execute(
+            update(Email)
+            .where(
+                Email.status == EmailStatus.SENDING,
+                Email.lease_expires_at < now,
+                Email.claimed_by == claimed_by,
+                Email.account_id == account_id,
+                Email.reserved_on == reserved_on
+            )
+            .values(status=EmailStatus.PENDING, claimed_by=None, lease_expires_at=None, reserved_on=None)
+            .execution_options(synchronize_session=False)
+        )
+        reclaimed += result.rowcount
+        # The expired runner's reservations for these emails were never used
+        if reserved_on is not None:
+            AccountDailyUsage.release(account_id, result.rowcount, reserved_on, connection=db.session)
+    db.session.commit()
+    
+    if reclaimed:
+        logger.warning(f"Reclaimed {reclaimed} emails with expired send leases")
+    return reclaimed
+
+def reserve_capacity(account, emails, worker_id, day):
+    """
+    Reserve daily-limit capacity for a lane's claimed emails and record the
+    reservation on each email it covers, in one transaction
+    
+    Args:
+        account (EmailAccount): The lane's account
+        emails (list): Claimed emails in send order
+        worker_id (str): Identifier of the queue run holding the claims
+        day (date): Day to reserve on
+        
+    Returns:
+        list: The leading emails that hold a reservation
+    """
+    table = Email.__table__
+    with db.engine.begin() as conn:
+        granted = AccountDailyUsage.reserve(account.id, len(emails), account.daily_limit, day, connection=conn)
+        if granted <= 0:
+            return []
+            
+        marked = conn.execute(
+            update(table)
+            .where(table.c.id.in_([email.id for email in emails[:granted]]),
+                   table.c.claimed_by == worker_id,
+                   table.c.status == EmailStatus.SENDING)
+            .values(reserved_on=day)
+        ).rowcount
+        # Claims lost in the meantime don't keep capacity
+        AccountDailyUsage.release(account.id, granted - marked, day, connection=conn)
+    return emails[:granted]
+
+def release_reservations(account_id, email_ids, day):
+    """
+    Give back the daily-limit capacity still held by emails a lane didn't send
+    
+    Args:
+        account_id (int): ID of the email account
+        email_ids (list): IDs of the emails
+        day (date): Day the capacity was reserved on
+    """
+    released = AccountDailyUsage.take_reservations(email_ids, day)
+    AccountDailyUsage.release(account_id, released, day, connection=db.session)
+    db.session.commit()
+
+def claim_due_emails(worker_id, limit, lease_seconds):
+    """
+    Atomically claim due pending emails for a worker with a single bulk UPDATE.
+    Claimed emails move to SENDING so concurrent queue runners skip them.
+    
+    Args:
+        worker_id (str): Identifier of the claiming queue run
+        limit (int): Maximum number of emails to claim
+        lease_seconds (int): How long the claim is valid
+        
+    Returns:
+        tuple: (claimed emails ordered by scheduled time, lease expiry datetime)
+    """
+    now = datetime.now()
+    lease_expires_at = now + timedelta(seconds=lease_seconds)
+    
+    due_ids = (
+        select(Email.id)
+        .where(Email.status == EmailStatus.PENDING, Email.scheduled_at <= now)
+        .order_by(Email.scheduled_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    
+    # Re-check the status in the outer statement so rows claimed by another
+    # runner between the subquery and the update are left alone
+    db.session.execute(
+        update(Email)
+        .where(Email.id.in_(due_ids), Email.status == EmailStatus.PENDING)
+        .values(status=EmailStatus.SENDING, claimed_by=worker_id, lease_expires_at=lease_expires_at, reserved_on=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    
+    # Load the whole batch once, with recipients, accounts, spooled messages and thread parents joined in
+    claimed = Email.query.options(
+        joinedload(Email.recipient),
+        joinedload(Email.account),
+        joinedload(Email.spool),
+        joinedload(Email.parent)
+    ).filter(
+        Email.claimed_by == worker_id,
+        Email.status == EmailStatus.SENDING
+    ).order_by(Email.scheduled_at).all()
+    
+    return claimed, lease_expires_at
+
+def release_claims(worker_id, email_ids, scheduled_at=None):
+    """
+    Return claimed but unsent emails to the pending queue
+    
+    Args:
+        worker_id (str): Identifier of the queue run holding the claims
+        email_ids (list): IDs of the emails to release
+        scheduled_at (datetime): New due time, if they shouldn't be sent right away
+    """
+    if not email_ids:
+        return
+        
+    values = {'status': EmailStatus.PENDING, 'claimed_by': None, 'lease_expires_at': None}
+    if scheduled_at is not None:
+        values['scheduled_at'] = scheduled_at
+        
+    db.session.execute(
+        update(Email)
+        .where(Email.id.in_(email_ids), Email.claimed_by == worker_id, Email.status == EmailStatus.SENDING)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
 def process_email_queue():
     """
     Process the email queue. This should be run regularly as a scheduled job.
+    Due emails are claimed under a lease first, so several queue runners can
+    split the queue between them without sending the same email twice.
     
     Returns:
         int: Number of emails processed
     """
     try:
         with app.app_context():
-            # Find pending emails that are due to be sent
-            now = datetime.now()
+            worker_id = new_worker_id()
             
-            # Get pending emails that are scheduled for now or in the past
-            pending_emails = Email.query.filter(
-                Email.status == EmailStatus.PENDING,
-                Email.scheduled_at <= now
-            ).order_by(Email.scheduled_at).all()
+            # Commit sends that crashed runners got accepted but never saved, and
+            # our own buffered ones (or keep their leases if that fails), then put
+            # the emails abandoned by crashed runners back in the queue
+            status_buffer = get_status_buffer()
+            status_buffer.replay_journal()
+            status_buffer.flush_or_hold()
+            reclaim_expired_leases()
+            
+            # Claim pending emails that are scheduled for now or in the past
+            pending_emails, lease_expires_at = claim_due_emails(
+                worker_id,
+                limit=app.config['SEND_CLAIM_BATCH_SIZE'],
+                lease_seconds=app.config['SEND_LEASE_SECONDS']
+            )
             
             if not pending_emails:
                 return 0
                 
-            logger.info(f"Processing {len(pending_emails)} pending emails")
+            logger.info(f"Worker {worker_id} claimed {len(pending_emails)} pending emails")
             
-            # Group emails by account to respect limits
+            # Group emails by account so each account gets its own send lane
             emails_by_account = {}
             for email in pending_emails:
                 if email.account_id not in emails_by_account:
@@ -169,34 +445,23 @@ def process_email_queue():
                     
                 emails_by_account[email.account_id].append(email)
                 
-            processed_count = 0
+            claimed_ids = [email.id for email in pending_emails]
             
-            # Process emails for each account
-            for account_id, emails in emails_by_account.items():
-                account = EmailAccount.query.get(account_id)
+            # Detach the loaded batch so each lane can adopt its share into its own session
+            db.session.expunge_all()
                 
-                if not account or not account.is_active:
-                    logger.warning(f"Account {account_id} is inactive or not found - skipping {len(emails)} emails")
-                    continue
-                    
-                # Check daily limit
-                sent_today = account.get_sent_today()
-                remaining = account.daily_limit - sent_today
-                
-                if remaining <= 0:
-                    logger.warning(f"Account {account_id} has reached daily limit - skipping {len(emails)} emails")
-                    continue
-                    
-                # Process up to the remaining limit
-                emails_to_process = emails[:remaining]
-                
-                for email in emails_to_process:
-                    success = process_email(email)
-                    if success:
-                        processed_count += 1
-                        
-                    # Add a small delay between emails
-                    time.sleep(2)
+            try:
+                if app.config['SEND_ENGINE'] == 'asyncio':
+                    from app.utils.async_sender import run_async_send_lanes
+                    processed_count = run_async_send_lanes(emails_by_account, worker_id, lease_expires_at, status_buffer)
+                else:
+                    processed_count = run_send_lanes(emails_by_account, worker_id, lease_expires_at, status_buffer)
+            finally:
+                # Commit buffered statuses, then put anything still claimed by this run
+                # back in the queue - except sends whose status couldn't be committed yet
+                status_buffer.close()
+                release_claims(worker_id, [email_id for email_id in claimed_ids
+                                           if not status_buffer.is_pending(email_id)])
                     
             logger.info(f"Processed {processed_count} emails")
             return processed_count
@@ -204,19 +469,204 @@ def process_email_queue():
     except Exception as e:
         logger.error(f"Error processing email queue: {str(e)}")
         return 0
+    finally:
+        release_smtp_sessions()
 
-def ensure_personalization(email_id):
+def run_send_lanes(emails_by_account, worker_id, lease_expires_at, status_buffer=None):
     """
-    Ensure email has proper personalization before sending
+    Send due emails with one worker lane per account.
+    Lanes run concurrently on a bounded thread pool so a slow SMTP server only
+    delays its own account; the call returns once every lane has drained.
     
     Args:
-        email_id (int): ID of the email to check
+        emails_by_account (dict): Account ID -> list of claimed, detached emails in send order
+        worker_id (str): Identifier of the queue run holding the claims
+        lease_expires_at (datetime): When the claims expire
+        status_buffer (StatusWriteBuffer): Buffer shared by the lanes for final statuses
+        
+    Returns:
+        int: Number of emails sent across all lanes
     """
-    try:
-        email = Email.query.get(email_id)
-        if not email:
-            return
+    max_lanes = min(app.config['SEND_MAX_LANES'], len(emails_by_account))
+    
+    if max_lanes <= 1:
+        return sum(process_account_lane(account_id, emails, worker_id, lease_expires_at, status_buffer)
+                   for account_id, emails in emails_by_account.items())
+    
+    processed_count = 0
+    with ThreadPoolExecutor(max_workers=max_lanes, thread_name_prefix='send-lane') as executor:
+        futures = {
+            executor.submit(process_account_lane, account_id, emails, worker_id, lease_expires_at, status_buffer): account_id
+            for account_id, emails in emails_by_account.items()
+        }
+        for future in as_completed(futures):
+            try:
+                processed_count += future.result()
+            except Exception as e:
+                logger.error(f"Send lane for account {futures[future]} failed: {str(e)}")
+                
+    return processed_count
+
+def process_account_lane(account_id, claimed_emails, worker_id, lease_expires_at, status_buffer=None):
+    """
+    Send the claimed emails of a single account, pacing sends within the lane.
+    Runs in its own app context so each lane has its own database session.
+    Emails the lane does not get to are released back to the pending queue.
+    
+    Args:
+        account_id (int): ID of the email account
+        claimed_emails (list): Detached, claimed emails for this account in send order
+        worker_id (str): Identifier of the queue run holding the claims
+        lease_expires_at (datetime): When the claims expire
+        status_buffer (StatusWriteBuffer): Buffer for final statuses, if writes are grouped
+        
+    Returns:
+        int: Number of emails sent
+    """
+    with app.app_context():
+        # The lane owns its claimed rows, so keep them loaded across commits
+        # instead of re-reading the account and recipients after every send
+        session = db.session()
+        session.expire_on_commit = False
+        
+        emails = [session.merge(email, load=False) for email in claimed_emails]
+        unsent_ids = [email.id for email in emails]
+        reserved_on = date.today()
+        emails_to_process = []
+        sent_ids = set()
+        processed_count = 0
+        try:
+            account = emails[0].account if emails else None
             
+            if not account or not account.is_active:
+                logger.warning(f"Account {account_id} is inactive or not found - skipping {len(emails)} emails")
+                return 0
+                
+            if account_suspensions.is_suspended(account.id):
+                logger.warning(f"Sending for account {account_id} is suspended - skipping {len(emails)} emails")
+                return 0
+                
+            # Only SMTP sends report to the host's circuit, other transports never close a probe
+            circuit_breakers = get_circuit_breakers()
+            uses_circuit = get_transport(account).name == 'smtp'
+            if uses_circuit and circuit_breakers.is_skipped('smtp', account.smtp_server):
+                logger.warning(f"SMTP host {account.smtp_server} is unreachable - skipping {len(emails)} emails for account {account_id}")
+                return 0
+                
+            # Reserve daily-limit capacity so concurrent runners can't overshoot it,
+            # and process up to the reserved capacity
+            emails_to_process = reserve_capacity(account, emails, worker_id, reserved_on)
+            
+            if not emails_to_process:
+                logger.warning(f"Account {account_id} has reached daily limit - skipping {len(emails)} emails")
+                return 0
+                
+            rate_limiter = get_rate_limiter()
+            # Stop early enough that no send can still be running when the lease expires
+            lane_deadline = lease_expires_at - timedelta(seconds=SEND_LEASE_SAFETY_MARGIN)
+            
+            for email in emails_to_process:
+                if email.status != EmailStatus.SENDING or email.claimed_by != worker_id:
+                    unsent_ids.remove(email.id)
+                    continue
+                    
+                # Wait for this account's and SMTP host's rate limits only
+                wait = rate_limiter.reserve(account)
+                if datetime.now() + timedelta(seconds=wait) >= lane_deadline:
+                    rate_limiter.give_back(account)
+                    logger.warning(f"Send lease for account {account_id} is about to expire - releasing remaining emails")
+                    break
+                if wait:
+                    time.sleep(wait)
+                    
+                # Only one probe gets through while the host's circuit is half-open
+                if uses_circuit and not circuit_breakers.allow('smtp', account.smtp_server):
+                    rate_limiter.give_back(account)
+                    logger.warning(f"SMTP host {account.smtp_server} is unreachable - releasing remaining emails for account {account_id}")
+                    break
+                    
+                unsent_ids.remove(email.id)
+                success = process_email(email, reserved_on=reserved_on, status_buffer=status_buffer)
+                if success:
+                    processed_count += 1
+                    sent_ids.add(email.id)
+                elif account_suspensions.is_suspended(account.id):
+                    # Authentication failed - don't try the rest against the same credentials
+                    logger.warning(f"Sending for account {account_id} was suspended - releasing remaining emails")
+                    break
+                elif uses_circuit and circuit_breakers.is_skipped('smtp', account.smtp_server):
+                    # Don't spend a connect timeout per email on a host that is down
+                    logger.warning(f"Circuit for SMTP host {account.smtp_server} opened - releasing remaining emails for account {account_id}")
+                    break
+                    
+            return processed_count
+        finally:
+            try:
+                # Emails of a suspended account or unreachable host wait until they may be tried again
+                release_claims(worker_id, unsent_ids, scheduled_at=lane_resumes_at(emails[0].account if emails else None))
+                # Successful sends consume their reservation when their status is written, give back the rest
+                release_reservations(account_id, [email.id for email in emails_to_process if email.id not in sent_ids],
+                                     reserved_on)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error releasing claims for account {account_id}: {str(e)}")
+
+def lane_resumes_at(account):
+    """
+    When a lane that stopped early may send again
+    
+    Args:
+        account (EmailAccount): The lane's account
+        
+    Returns:
+        datetime: When the account's suspension ends or its SMTP host is probed again,
+                  or None if neither applies
+    """
+    if account is None:
+        return None
+    times = [account_suspensions.resumes_at(account.id)]
+    if get_transport(account).name == 'smtp':
+        times.append(get_circuit_breakers().retry_at('smtp', account.smtp_server))
+    times = [t for t in times if t is not None]
+    return max(times) if times else None
+
+def release_imap_sessions():
+    """
+    Close pooled IMAP sessions after a reply check, like release_smtp_sessions()
+    """
+    try:
+        pool = get_imap_pool()
+        if app.config['USE_BACKGROUND_THREADS']:
+            pool.close_idle()
+        else:
+            pool.close_all()
+    except Exception as e:
+        logger.error(f"Error closing IMAP sessions: {str(e)}")
+
+def release_smtp_sessions():
+    """
+    Close pooled SMTP sessions at the end of a queue run.
+    Long-running processes keep recently used sessions for the next run and only
+    close idle ones; cron-style runs close everything before the process exits.
+    """
+    try:
+        pool = get_smtp_pool()
+        if app.config['USE_BACKGROUND_THREADS']:
+            pool.close_idle()
+        else:
+            pool.close_all()
+    except Exception as e:
+        logger.error(f"Error closing SMTP sessions: {str(e)}")
+
+def ensure_personalization(email):
+    """
+    Ensure email has proper personalization before sending.
+    Changes are made on the loaded email and saved with its next status update.
+    
+    Args:
+        email (Email): The email to check, with its recipient loaded
+    """
+    try:
         # Check if first name is properly personalized
         recipient = email.recipient
         first_name = recipient.derived_first_name
@@ -227,17 +677,15 @@ def ensure_personalization(email_id):
         for variant in variants:
             if variant in email.body:
                 email.body = email.body.replace(variant, first_name)
-                logger.info(f"Applied body personalization ({variant}) to email {email_id} for {recipient.email}")
+                logger.info(f"Applied body personalization ({variant}) to email {email.id} for {recipient.email}")
             
             # Also check and replace in subject
             if variant in email.subject:
                 email.subject = email.subject.replace(variant, first_name)
-                logger.info(f"Applied subject personalization ({variant}) to email {email_id} for {recipient.email}")
-        
-        db.session.commit()
+                logger.info(f"Applied subject personalization ({variant}) to email {email.id} for {recipient.email}")
             
     except Exception as e:
-        logger.error(f"Error ensuring personalization for email {email_id}: {str(e)}")
+        logger.error(f"Error ensuring personalization for email {email.id}: {str(e)}")
 
 def check_for_followups():
     """
@@ -394,8 +842,14 @@ def schedule_email_batch(recipient_ids, template_id, account_id, delay_minutes=0
                     current_time += timedelta(minutes=interval_minutes)
                     scheduled_count += 1
             
+            db.session.flush()
+            scheduled_ids = [email.id for email in emails_to_schedule if email.scheduled_at]
             db.session.commit()
             
+            # Render the final messages now so the send loop only has to stream bytes
+            if app.config['SEND_PRERENDER'] and scheduled_ids:
+                spool_emails(scheduled_ids)
+            
             # Log scheduling approach
             if human_like:
                 logger.info(f"Scheduled {scheduled_count} emails with human-like pattern ({pattern})")
@@ -409,6 +863,44 @@ def schedule_email_batch(recipient_ids, template_id, account_id, delay_minutes=0
         db.session.rollback()
         return 0
 
+def spool_emails(email_ids):
+    """
+    Pre-render the final message bytes of scheduled emails into the spool.
+    Emails are personalized first, so the spooled bytes match what would be
+    rendered at send time. Failures only cost the speedup - unspooled emails
+    are rendered when they are sent.
+    
+    Args:
+        email_ids (list): IDs of the emails to render
+        
+    Returns:
+        int: Number of emails spooled
+    """
+    try:
+        emails = Email.query.options(
+            joinedload(Email.recipient),
+            joinedload(Email.account),
+            joinedload(Email.spool),
+            joinedload(Email.parent)
+        ).filter(Email.id.in_(email_ids)).all()
+        
+        for email in emails:
+            ensure_personalization(email)
+            if email.spool is None:
+                email.spool = EmailSpool()
+            email.spool.fingerprint = message_fingerprint(email)
+            email.spool.message = render_message(email)
+            email.spool.created_at = datetime.utcnow()
+            
+        db.session.commit()
+        logger.info(f"Spooled {len(emails)} pre-rendered messages")
+        return len(emails)
+        
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error spooling pre-rendered messages: {str(e)}")
+        return 0
+
 def update_email_status(email_id, status):
     """
     Update the status of an email
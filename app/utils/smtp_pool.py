@@ -0,0 +1,248 @@
+"""
+SMTP connection pooling for the Beakon Solutions platform.
+
+Keeps authenticated SMTP sessions open per email account so that consecutive
+sends from the same account skip the TLS handshake and login.
+"""
+
+import time
+import atexit
+import logging
+import smtplib
+import threading
+
+from app.utils.net_utils import connect_smtp
+
+logger = logging.getLogger(__name__)
+
+# SMTP reply codes after which the server will not accept further commands
+SESSION_CLOSING_CODES = (421,)
+
+
+class PooledConnection:
+    """An authenticated SMTP session owned by the pool"""
+
+    def __init__(self, account_id, server, settings_key):
+        self.account_id = account_id
+        self.server = server
+        self.settings_key = settings_key
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages_sent = 0
+        self.reused = False
+
+    def idle_seconds(self):
+        return time.monotonic() - self.last_used
+
+    def close(self):
+        """Close the session, ignoring errors from an already dead socket"""
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+
+
+class SMTPConnectionPool:
+    """
+    Pool of authenticated SMTP sessions keyed by EmailAccount.id
+
+    At most one idle session is kept per account. Sessions that have been idle
+    longer than `noop_interval` are probed with NOOP before reuse, and sessions
+    idle longer than `idle_timeout` are closed by `close_idle()`.
+    """
+
+    def __init__(self, idle_timeout=60, noop_interval=15, max_messages=100, timeout=30):
+        self.idle_timeout = idle_timeout
+        self.noop_interval = noop_interval
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _settings_key(account):
+        return (account.smtp_server, account.smtp_port, account.smtp_username, account.smtp_password)
+
+    def _connect(self, account):
+        """Open and authenticate a new SMTP session for an account"""
+        logger.info(f"Opening pooled SMTP session to {account.smtp_server}:{account.smtp_port} for account {account.id}")
+        server = connect_smtp(account.smtp_server, account.smtp_port, timeout=self.timeout)
+        try:
+            server.login(account.smtp_username, account.smtp_password)
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+            raise
+        return PooledConnection(account.id, server, self._settings_key(account))
+
+    def _is_alive(self, conn):
+        """Probe a session with NOOP"""
+        try:
+            code, _ = conn.server.noop()
+            return code == 250
+        except Exception:
+            return False
+
+    def acquire(self, account):
+        """
+        Check out a session for an account, reusing an idle one when possible
+
+        Args:
+            account (EmailAccount): Account to send from
+
+        Returns:
+            PooledConnection: An authenticated session
+        """
+        with self._lock:
+            conn = self._idle.pop(account.id, None)
+
+        if conn is not None:
+            if conn.settings_key != self._settings_key(account):
+                logger.info(f"SMTP settings changed for account {account.id}, reconnecting")
+                conn.close()
+            elif conn.idle_seconds() > self.noop_interval and not self._is_alive(conn):
+                logger.info(f"Pooled SMTP session for account {account.id} is stale, reconnecting")
+                conn.close()
+            else:
+                conn.reused = True
+                return conn
+
+        return self._connect(account)
+
+    def release(self, conn, reusable=True):
+        """
+        Return a session to the pool
+
+        Args:
+            conn (PooledConnection): Session obtained from acquire()
+            reusable (bool): False if the session is known to be broken
+        """
+        conn.last_used = time.monotonic()
+        if not reusable or conn.messages_sent >= self.max_messages:
+            conn.close()
+            return
+
+        with self._lock:
+            existing = self._idle.get(conn.account_id)
+            if existing is None:
+                self._idle[conn.account_id] = conn
+                return
+
+        # Another session for this account is already pooled
+        conn.close()
+
+    def send_message(self, account, msg, from_addr=None, to_addrs=None):
+        """
+        Send a message over a pooled session for the account
+
+        A reused session that turns out to be disconnected is replaced once
+        with a fresh connection before the error is raised to the caller.
+
+        Args:
+            account (EmailAccount): Account to send from
+            msg (Message): The message to send
+            from_addr (str): Envelope sender, defaults to the From header
+            to_addrs (list): Envelope recipients, defaults to the To header
+        """
+        self._send(account, lambda server: server.send_message(msg, from_addr=from_addr, to_addrs=to_addrs))
+
+    def sendmail(self, account, from_addr, to_addrs, data):
+        """
+        Send an already serialized message over a pooled session for the account
+
+        Args:
+            account (EmailAccount): Account to send from
+            from_addr (str): Envelope sender
+            to_addrs (list): Envelope recipients
+            data (bytes): The RFC 5322 message
+        """
+        self._send(account, lambda server: server.sendmail(from_addr, to_addrs, data))
+
+    def _send(self, account, send):
+        while True:
+            conn = self.acquire(account)
+            try:
+                send(conn.server)
+            except smtplib.SMTPServerDisconnected:
+                self.release(conn, reusable=False)
+                if not conn.reused:
+                    raise
+                logger.info(f"Pooled SMTP session for account {account.id} was disconnected, retrying on a new session")
+                continue
+            except smtplib.SMTPResponseException as e:
+                # The server rejected this message but the session is still usable
+                # unless it announced that it is closing the channel
+                self.release(conn, reusable=e.smtp_code not in SESSION_CLOSING_CODES)
+                raise
+            except smtplib.SMTPRecipientsRefused:
+                self.release(conn)
+                raise
+            except Exception:
+                self.release(conn, reusable=False)
+                raise
+
+            conn.messages_sent += 1
+            self.release(conn)
+            return
+
+    def discard(self, account_id):
+        """Close the pooled session for an account, e.g. after its settings change"""
+        with self._lock:
+            conn = self._idle.pop(account_id, None)
+        if conn is not None:
+            conn.close()
+
+    def close_idle(self):
+        """
+        Close sessions that have been idle longer than the idle timeout
+
+        Returns:
+            int: Number of sessions closed
+        """
+        with self._lock:
+            expired = [account_id for account_id, conn in self._idle.items()
+                       if conn.idle_seconds() > self.idle_timeout]
+            conns = [self._idle.pop(account_id) for account_id in expired]
+
+        for conn in conns:
+            logger.debug(f"Closing idle SMTP session for account {conn.account_id}")
+            conn.close()
+        return len(conns)
+
+    def close_all(self):
+        """Close every pooled session"""
+        with self._lock:
+            conns = list(self._idle.values())
+            self._idle.clear()
+
+        for conn in conns:
+            conn.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_smtp_pool():
+    """
+    Get the process-wide SMTP connection pool
+
+    Returns:
+        SMTPConnectionPool: The shared pool
+    """
+    global _pool
+    if _pool is None:
+        from app import app
+        with _pool_lock:
+            if _pool is None:
+                _pool = SMTPConnectionPool(
+                    idle_timeout=app.config['SMTP_POOL_IDLE_TIMEOUT'],
+                    noop_interval=app.config['SMTP_POOL_NOOP_INTERVAL']
+                )
+                atexit.register(_pool.close_all)
+    return _pool
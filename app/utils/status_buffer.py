@@ -0,0 +1,411 @@
+"""
+Write-behind buffer for final send statuses in the Beakon Solutions platform.
+
+Send lanes hand the SENT/FAILED state of each email to the buffer, which
+commits them in groups instead of one transaction per message. Every email the
+SMTP server accepted is first appended to an on-disk journal, so a crash before
+the group commit can't make an accepted email look unsent; the journal is
+replayed before expired send leases are reclaimed.
+"""
+
+import os
+import glob
+import uuid
+import atexit
+import logging
+import threading
+from datetime import datetime, date, timedelta
+
+from sqlalchemy import inspect, update, delete, bindparam, or_
+from sqlalchemy.orm.attributes import set_committed_value
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from app import app, db
+from app.models.models import Email, EmailStatus, EmailSpool, AccountDailyUsage
+
+logger = logging.getLogger(__name__)
+
+
+class PendingStatus:
+    """A final email status waiting to be committed"""
+
+    def __init__(self, email_id, account_id, values, reserved_on=None):
+        self.email_id = email_id
+        self.account_id = account_id
+        self.values = values
+        self.reserved_on = reserved_on
+
+    @property
+    def is_sent(self):
+        return self.values.get('status') == EmailStatus.SENT
+
+
+class StatusWriteBuffer:
+    """
+    Collects final email statuses and commits them in one transaction
+    every `batch_size` emails or `flush_ms` milliseconds, whichever comes first.
+
+    Each process journals to its own file in `journal_dir`. The file is locked
+    for the life of the process, so a journal that can be locked by someone else
+    belongs to a process that died with accepted sends it never committed.
+
+    While a flush keeps failing, the send leases of the buffered emails are
+    extended by `lease_seconds`, so no runner reclaims and resends them.
+    """
+
+    def __init__(self, batch_size=50, flush_ms=500, journal_dir=None, fsync=True, lease_seconds=900):
+        self.batch_size = max(1, batch_size)
+        self.flush_ms = flush_ms
+        self.journal_dir = journal_dir
+        self.fsync = fsync
+        self.lease_seconds = lease_seconds
+        self._pending = []
+        self._lock = threading.RLock()
+        self._timer = None
+        self._journal_fd = None
+        self._journal_path = None
+
+    # Journal
+
+    def _open_journal(self):
+        """Open this process's journal file, creating the directory if needed"""
+        if self._journal_fd is not None or not self.journal_dir:
+            return self._journal_fd
+
+        os.makedirs(self.journal_dir, exist_ok=True)
+        # Unique per process start, so a reused PID never appends to a dead process's journal
+        self._journal_path = os.path.join(self.journal_dir, f'sent-{os.getpid()}-{uuid.uuid4().hex}.journal')
+        self._journal_fd = os.open(self._journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o644)
+        if fcntl:
+            fcntl.flock(self._journal_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        # Sends can be journaled before any queue run replayed crashed processes' journals
+        try:
+            self.replay_journal()
+        except Exception as e:
+            logger.error(f"Replaying orphaned send journals failed: {str(e)}")
+        return self._journal_fd
+
+    def _journal(self, entry):
+        """Durably record that an email was accepted by the SMTP server"""
+        fd = self._open_journal()
+        if fd is None:
+            return
+
+        sent_at = entry.values.get('sent_at') or datetime.now()
+        reserved_on = entry.reserved_on.isoformat() if entry.reserved_on else '-'
+        message_id = entry.values.get('message_id') or '-'
+        line = f"{entry.email_id} {entry.account_id} {reserved_on} {sent_at.isoformat()} {message_id}\n"
+        os.write(fd, line.encode('ascii'))
+        if self.fsync:
+            os.fsync(fd)
+
+    def _truncate_journal(self):
+        if self._journal_fd is not None:
+            os.ftruncate(self._journal_fd, 0)
+
+    @staticmethod
+    def _read_journal(path):
+        """
+        Parse a journal file, skipping a torn last line
+
+        Returns:
+            list: PendingStatus entries for SENT emails
+        """
+        entries = []
+        with open(path, 'r', encoding='ascii', errors='ignore') as f:
+            for line in f:
+                parts = line.split()
+                # Journals written before Message-IDs were recorded have four fields
+                if len(parts) not in (4, 5) or not line.endswith('\n'):
+                    continue
+                try:
+                    email_id, account_id = int(parts[0]), int(parts[1])
+                    reserved_on = None if parts[2] == '-' else date.fromisoformat(parts[2])
+                    sent_at = datetime.fromisoformat(parts[3])
+                except ValueError:
+                    continue
+                values = {
+                    'status': EmailStatus.SENT,
+                    'sent_at': sent_at,
+                    'claimed_by': None,
+                    'lease_expires_at': None,
+                }
+                if len(parts) == 5 and parts[4] != '-':
+                    values['message_id'] = parts[4]
+                entries.append(PendingStatus(email_id, account_id, values, reserved_on))
+        return entries
+
+    def _orphaned_journals(self):
+        """Journal files whose owning process is no longer running"""
+        if not self.journal_dir or not os.path.isdir(self.journal_dir):
+            return []
+
+        orphans = []
+        for path in glob.glob(os.path.join(self.journal_dir, 'sent-*.journal')):
+            if path == self._journal_path:
+                # Our own open journal - its entries are still buffered
+                continue
+            if not fcntl:
+                # Without file locks we can't tell if the owner is still alive
+                continue
+            fd = os.open(path, os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            orphans.append((path, fd))
+        return orphans
+
+    def replay_journal(self):
+        """
+        Commit accepted sends left in the journals of crashed processes.
+        Run this before reclaiming expired leases so accepted emails aren't
+        sent a second time.
+
+        Returns:
+            int: Number of emails marked as sent
+        """
+        with self._lock:
+            replayed = 0
+            for path, fd in self._orphaned_journals():
+                try:
+                    entries = self._read_journal(path)
+                    if entries:
+                        replayed += self._write(entries, only_unsent=True)
+                        logger.warning(f"Replayed {len(entries)} accepted sends from orphaned journal {path}")
+                    os.remove(path)
+                finally:
+                    os.close(fd)
+            return replayed
+
+    # Buffering
+
+    def record(self, email, values, reserved_on=None):
+        """
+        Queue a final status for an email.
+
+        The email takes on the new values at once, and any other unsaved changes
+        to it (e.g. personalization) are moved into the buffered write, so the
+        caller's session won't write the row again.
+
+        Args:
+            email (Email): The email, attached to the caller's session
+            values (dict): Column values to write, including 'status'
+            reserved_on (date): Day daily-limit capacity was reserved for the send
+        """
+        values = unsaved_values(email, values)
+        for key, value in values.items():
+            set_committed_value(email, key, value)
+        self.record_values(email.id, email.account_id, values, reserved_on)
+
+    def record_values(self, email_id, account_id, values, reserved_on=None):
+        """
+        Queue a final status for an email that isn't attached to a session,
+        e.g. one whose own commit failed
+
+        Args:
+            email_id (int): ID of the email
+            account_id (int): ID of the email's account
+            values (dict): Column values to write, including 'status'
+            reserved_on (date): Day daily-limit capacity was reserved for the send
+        """
+        entry = PendingStatus(email_id, account_id, values, reserved_on)
+        with self._lock:
+            self._pending.append(entry)
+            if entry.is_sent:
+                try:
+                    self._journal(entry)
+                except OSError as e:
+                    logger.error(f"Could not journal sent email {email_id}, committing it now: {str(e)}")
+                    self.flush_or_hold()
+                    return
+
+            if len(self._pending) >= self.batch_size:
+                self.flush_or_hold()
+            elif self._timer is None and self.flush_ms > 0:
+                self._timer = threading.Timer(self.flush_ms / 1000.0, self.flush_or_hold)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush_or_hold(self):
+        """
+        Flush without raising. Failed statuses stay buffered for the next flush,
+        and their emails' leases are extended so they aren't reclaimed meanwhile.
+        Run this before reclaiming expired leases.
+        """
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Flushing buffered send statuses failed: {str(e)}")
+            self._hold_leases()
+
+    def _hold_leases(self):
+        """Extend the send leases of emails whose final status is still buffered"""
+        with self._lock:
+            email_ids = list({entry.email_id for entry in self._pending})
+        if not email_ids:
+            return
+
+        table = Email.__table__
+        try:
+            with app.app_context(), db.engine.begin() as conn:
+                conn.execute(
+                    update(table)
+                    .where(table.c.id.in_(email_ids), table.c.status == EmailStatus.SENDING)
+                    .values(lease_expires_at=datetime.now() + timedelta(seconds=self.lease_seconds))
+                )
+        except Exception as e:
+            logger.error(f"Could not extend the leases of {len(email_ids)} emails with buffered statuses: {str(e)}")
+
+    def is_pending(self, email_id):
+        """Check whether an email's final status is still waiting to be committed"""
+        with self._lock:
+            return any(entry.email_id == email_id for entry in self._pending)
+
+    def flush(self):
+        """
+        Commit all buffered statuses and daily counter increments in one transaction.
+        On failure the statuses stay buffered (and journaled) for the next flush.
+
+        Returns:
+            int: Number of statuses committed
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            if not self._pending:
+                return 0
+
+            entries = self._pending
+            self._pending = []
+            try:
+                self._write(entries)
+            except Exception:
+                self._pending = entries + self._pending
+                raise
+
+            self._truncate_journal()
+            logger.debug(f"Committed {len(entries)} buffered send statuses")
+            return len(entries)
+
+    def _write(self, entries, only_unsent=False):
+        """
+        Write statuses and count SENT emails against their account's daily usage
+
+        Args:
+            entries (list): PendingStatus entries to write
+            only_unsent (bool): Only update emails that are not already final (journal replay)
+
+        Returns:
+            int: Number of SENT emails counted
+        """
+        table = Email.__table__
+        with app.app_context():
+            # Counter rows are created on their own connection, before the write lock is taken
+            for account_id in {entry.account_id for entry in entries if entry.is_sent}:
+                AccountDailyUsage.ensure_row(account_id)
+
+            with db.engine.begin() as conn:
+                # (account_id, reserved_on) -> IDs of the emails marked SENT
+                sent = {}
+                if only_unsent:
+                    for entry in entries:
+                        result = conn.execute(
+                            update(table)
+                            .where(table.c.id == entry.email_id,
+                                   table.c.status.in_([EmailStatus.SENDING, EmailStatus.PENDING]))
+                            .values(**entry.values)
+                        )
+                        if result.rowcount and entry.is_sent:
+                            sent.setdefault((entry.account_id, entry.reserved_on), []).append(entry.email_id)
+                else:
+                    # One executemany per distinct set of columns
+                    groups = {}
+                    for entry in entries:
+                        groups.setdefault(tuple(sorted(entry.values)), []).append(entry)
+                        if entry.is_sent:
+                            sent.setdefault((entry.account_id, entry.reserved_on), []).append(entry.email_id)
+
+                    for columns, group in groups.items():
+                        # Leave rows alone that were changed meanwhile, e.g. cancelled by a user
+                        stmt = (
+                            update(table)
+                            .where(table.c.id == bindparam('email_id'),
+                                   or_(table.c.status == EmailStatus.SENDING, table.c.status == EmailStatus.PENDING))
+                            .values({column: bindparam(f'new_{column}') for column in columns})
+                        )
+                        conn.execute(stmt, [
+                            dict({f'new_{column}': entry.values[column] for column in columns}, email_id=entry.email_id)
+                            for entry in group
+                        ])
+
+                for (account_id, reserved_on), email_ids in sent.items():
+                    # Only emails that still hold their reservation use it - a reclaimed one's was given back
+                    reserved = AccountDailyUsage.take_reservations(email_ids, reserved_on, connection=conn)
+                    AccountDailyUsage.record_sent(account_id, reserved_on=reserved_on, count=len(email_ids),
+                                                  connection=conn, reserved=reserved)
+
+                # Pre-rendered messages of sent emails are no longer needed
+                sent_ids = [entry.email_id for entry in entries if entry.is_sent]
+                if sent_ids:
+                    spool_table = EmailSpool.__table__
+                    conn.execute(delete(spool_table).where(spool_table.c.email_id.in_(sent_ids)))
+
+        return sum(len(email_ids) for email_ids in sent.values())
+
+    def close(self):
+        """Flush on shutdown - anything that can't be committed stays in the journal"""
+        self.flush_or_hold()
+
+
+def unsaved_values(email, values):
+    """
+    Values to write for an email: `values` plus any other unsaved changes to
+    it (e.g. personalization), so they are written along with its status
+
+    Args:
+        email (Email): The email, attached to a session
+        values (dict): Column values to write
+
+    Returns:
+        dict: `values`, with the other changed columns added
+    """
+    state = inspect(email)
+    for key in state.mapper.column_attrs.keys():
+        if key not in values and state.attrs[key].history.has_changes():
+            values[key] = getattr(email, key)
+    return values
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_status_buffer():
+    """
+    Get the process-wide send status buffer
+
+    Returns:
+        StatusWriteBuffer: The shared buffer
+    """
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = StatusWriteBuffer(
+                    batch_size=app.config['SEND_STATUS_BATCH_SIZE'],
+                    flush_ms=app.config['SEND_STATUS_FLUSH_MS'],
+                    journal_dir=app.config['SEND_JOURNAL_DIR'],
+                    fsync=app.config['SEND_JOURNAL_FSYNC'],
+                    lease_seconds=app.config['SEND_LEASE_SECONDS']
+                )
+                atexit.register(_buffer.close)
+    return _buffer
@@ -0,0 +1,132 @@
+"""
+Send transports for the Beakon Solutions platform.
+
+A transport takes a fully rendered message and hands it to its destination:
+the account's SMTP server, a maildir spool on disk, or nowhere at all. The
+file and null transports run the whole send pipeline (claims, rendering,
+rate limits, status writes) without an outside mail server, for dry runs and
+load tests. The transport is chosen per account, falling back to SEND_TRANSPORT.
+"""
+
+import os
+import logging
+import mailbox
+import threading
+
+from app import app
+from app.utils.net_utils import connect_smtp
+from app.utils.smtp_pool import get_smtp_pool
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPTransport:
+    """Delivers over the account's SMTP server, through the session pool when enabled"""
+
+    name = 'smtp'
+
+    def send(self, account, from_addr, to_addrs, message_bytes):
+        """
+        Send a serialized message
+
+        Args:
+            account (EmailAccount): Account to send from
+            from_addr (str): Envelope sender
+            to_addrs (list): Envelope recipients
+            message_bytes (bytes): The RFC 5322 message
+        """
+        if app.config.get('SMTP_POOL_ENABLED'):
+            # Reuse an authenticated session for this account when one is open
+            logger.info(f"Sending email from {from_addr} to {to_addrs} via pooled SMTP session")
+            get_smtp_pool().sendmail(account, from_addr, to_addrs, message_bytes)
+            return
+
+        logger.info(f"REAL SEND: Connecting to SMTP server: {account.smtp_server}:{account.smtp_port}")
+        with connect_smtp(account.smtp_server, account.smtp_port) as server:
+            logger.info(f"Logging in with username: {account.smtp_username}")
+            server.login(account.smtp_username, account.smtp_password)
+
+            logger.info(f"Sending email from {from_addr} to {to_addrs}")
+            server.sendmail(from_addr, to_addrs, message_bytes)
+
+
+class FileTransport:
+    """
+    Writes each message into a maildir per sending account under `directory`,
+    so the output can be inspected with any mail client
+    """
+
+    name = 'file'
+
+    def __init__(self, directory):
+        self.directory = directory
+        # Account ID -> (Maildir, lock held around writes, as Maildir isn't thread-safe)
+        self._maildirs = {}
+        self._lock = threading.Lock()
+
+    def _maildir(self, account):
+        with self._lock:
+            if account.id not in self._maildirs:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, account.email)
+                self._maildirs[account.id] = (mailbox.Maildir(path, factory=None, create=True), threading.Lock())
+            return self._maildirs[account.id]
+
+    def send(self, account, from_addr, to_addrs, message_bytes):
+        maildir, lock = self._maildir(account)
+        with lock:
+            key = maildir.add(message_bytes)
+        logger.info(f"Spooled email from {from_addr} to {to_addrs} as {key}")
+
+
+class NullTransport:
+    """Accepts every message and discards it - everything but the network write"""
+
+    name = 'null'
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def send(self, account, from_addr, to_addrs, message_bytes):
+        with self._lock:
+            self.messages += 1
+            self.bytes += len(message_bytes)
+        logger.debug(f"Discarded email from {from_addr} to {to_addrs} ({len(message_bytes)} bytes)")
+
+
+TRANSPORT_NAMES = ('smtp', 'file', 'null')
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def _create_transport(name):
+    if name == 'file':
+        return FileTransport(app.config['SEND_SPOOL_DIR'])
+    if name == 'null':
+        return NullTransport()
+    return SMTPTransport()
+
+
+def get_transport(account):
+    """
+    Get the transport an account sends through
+
+    Args:
+        account (EmailAccount): Account to send from
+
+    Returns:
+        SMTPTransport, FileTransport or NullTransport: The shared transport instance
+    """
+    name = (account.transport or app.config['SEND_TRANSPORT'] or 'smtp').lower()
+    if name not in TRANSPORT_NAMES:
+        logger.warning(f"Unknown transport '{name}' for account {account.id} - using smtp")
+        name = 'smtp'
+
+    if name not in _transports:
+        with _transports_lock:
+            if name not in _transports:
+                _transports[name] = _create_transport(name)
+    return _transports[name]
@@ -0,0 +1,298 @@
+"""
+Send throughput benchmark
+
+Starts a local implicit-TLS SMTP server in-process, seeds a throwaway SQLite
+database with accounts and due emails, and drives process_email_queue end to
+end for each send mode. Reports messages/sec, p50/p99 per-send latency and
+database queries per message, so send-path changes can be measured before
+they are deployed.
+
+Usage:
+    python benchmark_send.py --accounts 4 --emails 400
+    python benchmark_send.py --modes sequential,pooled --latency-ms 20 --error-rate 0.05
+"""
+
+import os
+import sys
+import ssl
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import socketserver
+from datetime import datetime, timedelta
+
+# Send modes: app.config overrides applied before each run
+MODES = {
+    'sequential': {'SEND_ENGINE': 'threaded', 'SEND_MAX_LANES': 1, 'SMTP_POOL_ENABLED': False},
+    'pooled': {'SEND_ENGINE': 'threaded', 'SEND_MAX_LANES': 1, 'SMTP_POOL_ENABLED': True},
+    'lanes': {'SEND_ENGINE': 'threaded', 'SEND_MAX_LANES': 8, 'SMTP_POOL_ENABLED': True},
+    'asyncio': {'SEND_ENGINE': 'asyncio', 'SEND_MAX_LANES': 8, 'SMTP_POOL_ENABLED': True},
+    # Parallel lanes with the null transport: the send pipeline without any network I/O
+    'null': {'SEND_ENGINE': 'threaded', 'SEND_MAX_LANES': 8, 'SMTP_POOL_ENABLED': True, 'SEND_TRANSPORT': 'null'},
+}
+
+
+class BenchmarkSMTPHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server side: accepts any login and message, with optional latency and 451 errors"""
+
+    def reply(self, line):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write(line.encode() + b'\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        self.reply('220 localhost benchmark ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250-localhost\r\n250-AUTH PLAIN\r\n250 8BITMIME')
+            elif verb == 'AUTH':
+                self.reply('235 2.7.0 Authentication successful')
+            elif verb == 'RCPT':
+                if random.random() < self.server.error_rate:
+                    self.reply('451 4.3.0 Try again later')
+                else:
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.received += 1
+                self.reply('250 OK queued')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                # MAIL, RSET, NOOP
+                self.reply('250 OK')
+
+
+class BenchmarkSMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, certfile, keyfile, latency_ms=0, error_rate=0.0):
+        super().__init__(('localhost', port), BenchmarkSMTPHandler)
+        self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.context.load_cert_chain(certfile, keyfile)
+        self.latency = latency_ms / 1000.0
+        self.error_rate = error_rate
+        self.received = 0
+
+    def get_request(self):
+        sock, address = super().get_request()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self.context.wrap_socket(sock, server_side=True), address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='benchmark-smtp')
+        thread.daemon = True
+        thread.start()
+
+
+def generate_certificate(directory):
+    """Create a self-signed certificate for localhost with the openssl command line tool"""
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+        '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+        '-keyout', keyfile, '-out', certfile
+    ], check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def seed(db, models, accounts, emails, port, prerender):
+    """Reset the database and add `accounts` accounts sharing `emails` due emails"""
+    db.drop_all()
+    db.create_all()
+    # Forget daily counter rows of the previous run's database
+    models.AccountDailyUsage._known_rows.clear()
+
+    account_rows = [
+        models.EmailAccount(name=f'Bench {i}', email=f'sender{i}@bench.local', smtp_server='localhost',
+                            smtp_port=port, smtp_username=f'sender{i}', smtp_password='secret', daily_limit=emails)
+        for i in range(accounts)
+    ]
+    db.session.add_all(account_rows)
+    db.session.flush()
+
+    due = datetime.now() - timedelta(minutes=1)
+    for i in range(emails):
+        recipient = models.Recipient(email=f'recipient{i}@bench.local', first_name=f'Recipient{i}')
+        db.session.add(recipient)
+        db.session.flush()
+        db.session.add(models.Email(
+            account_id=account_rows[i % accounts].id, recipient_id=recipient.id,
+            subject=f'Benchmark message {i}', body=f'Hello Recipient{i},\n\nThis is benchmark message {i}.\n',
+            status=models.EmailStatus.PENDING, scheduled_at=due
+        ))
+    db.session.commit()
+
+    if prerender:
+        from app.utils.scheduler_utils import spool_emails
+        spool_emails([email_id for (email_id,) in db.session.query(models.Email.id).all()])
+
+
+def run_mode(name, args, port, app, db, models):
+    """Seed, send everything due with one mode and return its measurements"""
+    from sqlalchemy import event
+    from app.utils import scheduler_utils, async_sender
+    from app.utils.smtp_pool import get_smtp_pool
+
+    app.config['SEND_TRANSPORT'] = 'smtp'
+    app.config.update(MODES[name])
+    if name == 'lanes':
+        app.config['SEND_MAX_LANES'] = args.lanes
+    get_smtp_pool().close_all()
+
+    with app.app_context():
+        seed(db, models, args.accounts, args.emails, port, args.prerender)
+        engine = db.engine
+
+    # Count every statement sent to the database and time each send
+    queries = [0]
+    latencies = []
+    lock = threading.Lock()
+
+    def count_query(*_):
+        with lock:
+            queries[0] += 1
+
+    def timed(func):
+        def wrapper(*a, **kw):
+            started = time.perf_counter()
+            try:
+                return func(*a, **kw)
+            finally:
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+        return wrapper
+
+    def timed_async(func):
+        async def wrapper(*a, **kw):
+            started = time.perf_counter()
+            try:
+                return await func(*a, **kw)
+            finally:
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+        return wrapper
+
+    original_process_email = scheduler_utils.process_email
+    original_deliver_async = async_sender.deliver_email_async
+    scheduler_utils.process_email = timed(original_process_email)
+    async_sender.deliver_email_async = timed_async(original_deliver_async)
+    event.listen(engine, 'before_cursor_execute', count_query)
+
+    started = time.perf_counter()
+    try:
+        # Each run claims up to SEND_CLAIM_BATCH_SIZE emails; failed sends are
+        # rescheduled into the future, so a run that sends nothing means we're done
+        for _ in range(args.max_runs):
+            if not scheduler_utils.process_email_queue():
+                break
+    finally:
+        elapsed = time.perf_counter() - started
+        event.remove(engine, 'before_cursor_execute', count_query)
+        scheduler_utils.process_email = original_process_email
+        async_sender.deliver_email_async = original_deliver_async
+
+    with app.app_context():
+        statuses = dict(db.session.query(models.Email.status, db.func.count()).group_by(models.Email.status).all())
+    sent = statuses.get(models.EmailStatus.SENT, 0)
+
+    return {
+        'mode': name,
+        'sent': sent,
+        'retry': statuses.get(models.EmailStatus.PENDING, 0),
+        'failed': statuses.get(models.EmailStatus.FAILED, 0),
+        'seconds': elapsed,
+        'rate': sent / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'queries': queries[0] / sent if sent else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure email send throughput against a local SMTP server')
+    parser.add_argument('--accounts', type=int, default=4, help='number of sending accounts')
+    parser.add_argument('--emails', type=int, default=200, help='number of due emails')
+    parser.add_argument('--modes', default=','.join(MODES), help=f'comma separated, from: {", ".join(MODES)}')
+    parser.add_argument('--lanes', type=int, default=8, help='parallel lanes for the "lanes" mode')
+    parser.add_argument('--latency-ms', type=float, default=0, help='delay the server adds to every reply')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of recipients refused with 451')
+    parser.add_argument('--prerender', action='store_true', help='pre-render messages into the spool before sending')
+    parser.add_argument('--max-runs', type=int, default=50, help='queue runs per mode before giving up')
+    parser.add_argument('--cert', help='server certificate (PEM), generated with openssl if omitted')
+    parser.add_argument('--key', help='server private key (PEM)')
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        parser.error(f"Unknown modes: {', '.join(unknown)}")
+
+    workdir = tempfile.mkdtemp(prefix='beakon-bench-')
+    certfile, keyfile = (args.cert, args.key) if args.cert else generate_certificate(workdir)
+
+    # Configure the app for a throwaway database before it is imported
+    os.environ['DATABASE_URI'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['EMAIL_TEST_MODE'] = 'False'
+    os.environ['SEND_ACCOUNT_RATE'] = '0'
+    os.environ['SEND_HOST_RATE'] = '0'
+    os.environ['SEND_JOURNAL_DIR'] = os.path.join(workdir, 'journal')
+    os.environ['CIRCUIT_FAILURE_THRESHOLD'] = str(10 ** 6)
+
+    from app import app, db
+    from app.models import models
+    from app.utils.net_utils import get_ssl_context
+
+    # Trust the benchmark server's certificate
+    get_ssl_context().load_verify_locations(cafile=certfile)
+
+    port = free_port()
+    server = BenchmarkSMTPServer(port, certfile, keyfile, args.latency_ms, args.error_rate)
+    server.start()
+
+    print(f"{args.emails} emails from {args.accounts} accounts, server latency {args.latency_ms}ms, "
+          f"error rate {args.error_rate:.0%}, prerender {'on' if args.prerender else 'off'}")
+    print(f"{'mode':<12}{'sent':>7}{'retry':>7}{'failed':>8}{'seconds':>10}{'msg/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'queries/msg':>13}")
+    try:
+        for mode in modes:
+            result = run_mode(mode, args, port, app, db, models)
+            print(f"{result['mode']:<12}{result['sent']:>7}{result['retry']:>7}{result['failed']:>8}"
+                  f"{result['seconds']:>10.2f}{result['rate']:>10.1f}{result['p50']:>10.1f}{result['p99']:>10.1f}"
+                  f"{result['queries']:>13.1f}")
+    finally:
+        server.shutdown()
+    print(f"Server received {server.received} messages")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""
+Database migration script to add send lease fields to the email table.
+"""
+
+import os
+import sys
+import sqlite3
+import logging
+
+# Add parent directory to path
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if parent_dir not in sys.path:
+    sys.path.append(parent_dir)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def migrate():
+    """
+    Add claimed_by and lease_expires_at columns to the email table
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    try:
+        # Import app configuration
+        from app import app
+
+        logger.info("Running migration to add send lease fields to email table")
+
+        # Get database URI from app config
+        db_uri = app.config['SQLALCHEMY_DATABASE_URI']
+
+        # Only works for SQLite
+        if not db_uri.startswith('sqlite:///'):
+            logger.error("Migration only supports SQLite databases")
+            return False
+
+        # Extract database path
+        db_path = db_uri.replace('sqlite:///', '')
+        if not os.path.isabs(db_path):
+            db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), db_path)
+
+        logger.info(f"Using database at {db_path}")
+
+        # Connect to SQLite database
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+        try:
+            # Check if the columns already exist
+            cursor.execute("PRAGMA table_info(email)")
+            columns = [col[1] for col in cursor.fetchall()]
+
+            changes_made = False
+
+            # Add the claimed_by column if it doesn't exist
+            if 'claimed_by' not in columns:
+                logger.info("Adding claimed_by column")
+                cursor.execute("ALTER TABLE email ADD COLUMN claimed_by VARCHAR(100)")
+                changes_made = True
+
+            # Add the lease_expires_at column if it doesn't exist
+            if 'lease_expires_at' not in columns:
+                logger.info("Adding lease_expires_at column")
+                cursor.execute("ALTER TABLE email ADD COLUMN lease_expires_at DATETIME")
+                changes_made = True
+
+            # Index used when claiming due emails and reclaiming expired leases
+            cursor.execute("CREATE INDEX IF NOT EXISTS ix_email_status_scheduled_at ON email (status, scheduled_at)")
+
+            conn.commit()
+
+            if changes_made:
+                logger.info("Successfully added send lease fields to email table")
+            else:
+                logger.info("Send lease fields already exist, no changes needed")
+
+            return True
+
+        except Exception as e:
+            logger.error(f"Error during migration: {str(e)}")
+            return False
+        finally:
+            conn.close()
+
+    except Exception as e:
+        logger.error(f"Migration error: {str(e)}")
+        return False
+
+if __name__ == "__main__":
+    if migrate():
+        print("Migration completed successfully")
+    else:
+        print("Migration failed")